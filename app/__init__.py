@@ -7,12 +7,20 @@ from models import db
 
 auth = lib.Auth()
 hashid = lib.HashID()
+request_id = lib.RequestId()
+metrics = lib.Metrics()
+sql_profiler = lib.SQLProfiler()
+slow_queries = lib.SlowQueryLog()
+request_timer = lib.RequestTimer()
+sampling_profiler = lib.SamplingProfiler()
 
 
 # TODO consistent error responses
 
 
-def create_app(config_name='default'):
+def create_app(config_name='default', warmup=False):
+    '''Create the app. With `warmup` the workers forked from this process
+    share what it builds for the first requests, see `app.warmup`.'''
     app = Flask(__name__)
     app.config.from_object(config[config_name])
     app.response_class = lib.HandleJSONReponse
@@ -21,6 +29,12 @@ def create_app(config_name='default'):
 
     hashid.init_app(app)
     db.init_app(app)
+    request_id.init_app(app)
+    metrics.init_app(app, db.engines)
+    sql_profiler.init_app(app, db.engines)
+    slow_queries.init_app(app, db.engines)
+    request_timer.init_app(app, db.engines)
+    sampling_profiler.init_app(app)
     CORS(app, origins="http://localhost:*")
 
     # API v1
@@ -32,4 +46,8 @@ def create_app(config_name='default'):
         error = dict(status_code=404, message='Resource not found')
         return dict(errors=error), 404
 
+    if warmup:
+        from app.warmup import warmup as warmup_app
+        warmup_app(app)
+
     return app
@@ -1,11 +1,14 @@
-from flask import request, abort
-from sqlalchemy.orm import contains_eager
-from sqlalchemy import and_
+from flask import request
+from sqlalchemy.exc import IntegrityError
 
 from app import auth, db
 from app.models import Questionnaire, QuestionnaireResponse
 from app.serializers import (
     Serializer,
+    BulkResponsesSchema,
+    BulkResultSchema,
+    ProgressQuerySchema,
+    ProgressSchema,
     QuestionnaireSchema,
     QuestionnaireResponseSchema,
 )
@@ -15,19 +18,19 @@ from app.lib import Pagination, get_or_404
 from . import v1
 
 
+def own_responses():
+    '''Expanded responses are those of the current user only.'''
+    user_id = auth.current_user.id if auth.current_user else None
+    return dict(responses=QuestionnaireResponse.user_id == user_id)
+
+
 @v1.route('/questionnaires', methods=['GET'])
 @auth.token_required
 def get_questionnaires():
     '''Get questionnaires.'''
-    serializer = Serializer(QuestionnaireSchema, request.args)
-    query = Questionnaire.query.\
-        outerjoin(QuestionnaireResponse, and_(
-            QuestionnaireResponse.user_id == auth.current_user.id,
-            QuestionnaireResponse.questionnaire_id == Questionnaire.id
-        )).\
-        options(contains_eager(Questionnaire.responses))
-
-    page = Pagination(request, query=query)
+    serializer = Serializer(QuestionnaireSchema, request.args,
+                            expand_criteria=own_responses())
+    page = Pagination(request, query=Questionnaire.query)
     return serializer.dump_page(page)
 
 
@@ -35,19 +38,9 @@ def get_questionnaires():
 @auth.token_optional
 def get_questionnaire(id):
     '''Get questionnaire.'''
-
-    questionnaire = Questionnaire.query.\
-        outerjoin(QuestionnaireResponse, and_(
-            QuestionnaireResponse.user_id == auth.current_user.id,
-            QuestionnaireResponse.questionnaire_id == Questionnaire.id
-        )).\
-        filter(Questionnaire.id == id).\
-        options(contains_eager(Questionnaire.responses)).first()
-
-    if not questionnaire:
-        abort(404)
-
-    serializer = Serializer(QuestionnaireSchema, request.args)
+    questionnaire = get_or_404(Questionnaire, id)
+    serializer = Serializer(QuestionnaireSchema, request.args,
+                            expand_criteria=own_responses())
     return serializer.dump(questionnaire)
 
 
@@ -68,10 +61,43 @@ def post_response(id):
     return serializer.dump(response)
 
 
+@v1.route('/questionnaires/responses', methods=['POST'])
+@auth.token_required
+def post_responses():
+    '''Post responses to any questionnaire in bulk, to sync responses that
+    were filled in offline. Every response has an idempotency key, responses
+    that were posted before are skipped so a sync can safely be retried.'''
+    data = Serializer(BulkResponsesSchema).load(request.get_json())
+    responses = data['responses']
+
+    # A concurrent sync of the same responses makes the insert fail on the
+    # unique idempotency key, retrying skips them.
+    for retry in (False, True):
+        try:
+            created, existing = QuestionnaireResponse.bulk_create(
+                db.session, auth.current_user.id, responses)
+            db.session.commit()
+            break
+        except IntegrityError:
+            db.session.rollback()
+            if retry:
+                raise
+
+    results = [dict(idempotency_key=key,
+                    id=created.get(key) or existing.get(key),
+                    created=key in created)
+               for key in (response['idempotency_key']
+                           for response in responses)]
+    items = BulkResultSchema(many=True).dump(results).data
+    return dict(items=items), 201 if created else 200
+
+
 @v1.route('/questionnaires/<hashid:id>/responses', methods=['GET'])
 @auth.token_required
 def get_responses(id):
     '''Get responses.'''
+    # the choices of the responses are read with its definition.
+    get_or_404(Questionnaire, id)
     serializer = Serializer(QuestionnaireResponseSchema, request.args)
     query = QuestionnaireResponse.query.\
         filter(QuestionnaireResponse.user_id == auth.current_user.id).\
@@ -79,3 +105,20 @@ def get_responses(id):
         order_by(QuestionnaireResponse.created_at.desc())
     page = Pagination(request, query=query)
     return serializer.dump_page(page)
+
+
+@v1.route('/questionnaires/<hashid:id>/progress', methods=['GET'])
+@auth.token_required
+def get_progress(id):
+    '''Get the progress of the current user, optionally per week or month
+    with `?bucket=week`. The moving average is over `?window=3` totals.'''
+    questionnaire = get_or_404(Questionnaire, id)
+    params = Serializer(ProgressQuerySchema).load(request.args.to_dict())
+    params.setdefault('window', 3)
+    query = QuestionnaireResponse.progress(db.session,
+                                           user_id=auth.current_user.id,
+                                           questionnaire_id=id,
+                                           **params)
+    items = ProgressSchema(many=True).dump(query.all()).data
+    meta = dict(params, max_score=questionnaire.definition.max_score)
+    return dict(items=items, meta=meta)
@@ -1,4 +1,9 @@
 from auth import *  # noqa
 from hashid import *  # noqa
+from logs import *  # noqa
+from metrics import *  # noqa
 from pagination import *  # noqa
+from profiler import *  # noqa
+from sampling import *  # noqa
+from timing import *  # noqa
 from utils import *  # noqa
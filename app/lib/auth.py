@@ -3,6 +3,8 @@ import functools
 from flask import request
 from werkzeug.local import LocalProxy
 
+from timing import timed
+
 
 class Auth(object):
     '''AUthorization class that manages an OAuth authorization flow following
@@ -53,6 +55,7 @@ class Auth(object):
         '''Register a current_user callback as a werkzeug LocalProxy.'''
         self.current_user = LocalProxy(f)
 
+    @timed('auth')
     def authorize_with_token(self, auth_header):
         if request.method != 'OPTIONS':
             try:
@@ -15,14 +15,12 @@ class HashID(object):
     '''
 
     def __init__(self, app=None):
+        self.salt = ''
+        # Building a Hashids shuffles its alphabet, it is built once per salt.
+        self.hashid = hashids.Hashids(salt=self.salt)
         if app:
-            self.salt = ''
             self.init_app(app)
 
-    @property
-    def hashid(self):
-        return hashids.Hashids(salt=self.salt)
-
     def decode(self, value):
         return self.hashid.decode(value)
 
@@ -31,6 +29,7 @@ class HashID(object):
 
     def init_app(self, app):
         self.salt = app.config.get('HASHID_SALT', '')
+        self.hashid = hashids.Hashids(salt=self.salt)
 
         class HashIDConverter(BaseConverter):
             def to_python(self_, value):
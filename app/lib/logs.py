@@ -0,0 +1,181 @@
+import atexit
+import json
+import logging
+import os
+import Queue
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from flask import g, has_request_context, request
+
+from metrics import CounterMetric
+
+discarded_records = CounterMetric(
+    'log_records_discarded_total',
+    'Log records that were sampled out or dropped because the log queue '
+    'was full.', ['logger', 'reason'])
+
+
+class JSONFormatter(logging.Formatter):
+    '''Formats records as a line of JSON, with the request they were logged
+    in. Structured data is passed in `extra=dict(data=...)`.'''
+    def format(self, record):
+        rv = dict(time=datetime.utcfromtimestamp(record.created).isoformat(),
+                  level=record.levelname,
+                  logger=record.name,
+                  message=record.getMessage(),
+                  source='%s:%s' % (record.pathname, record.lineno),
+                  thread=record.threadName)
+        for key in ('request_id', 'elapsed_ms', 'dropped', 'data'):
+            if hasattr(record, key):
+                rv[key] = getattr(record, key)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            rv['exception'] = record.exc_text
+        return json.dumps(rv, default=repr)
+
+
+class LogQueue(object):
+    '''Hands log records to a background thread that writes them, so logging
+    never waits for the disk.
+
+    Records that don't fit in the queue of `size` records are dropped. The
+    drops are counted in the `log_records_discarded_total` metric and the next
+    record that is written to the same handler says how many were dropped.
+    '''
+    def __init__(self, size=10000):
+        self.size = size
+        self.queue = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def put(self, handler, record):
+        '''Queue `record` for `handler`, returns whether it fit.'''
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait((handler, record))
+            return True
+        except Queue.Full:
+            return False
+
+    def start(self):
+        '''Start the writer of this process.'''
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.queue = Queue.Queue(maxsize=self.size)
+            writer = threading.Thread(target=self.run, name='log-writer')
+            writer.daemon = True
+            writer.start()
+            atexit.register(self.stop, self.queue, writer)
+
+    def run(self):
+        queue = self.queue
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            handler, record = item
+            handler.write(record)
+
+    def stop(self, queue, writer, timeout=5):
+        '''Write what is queued before the process exits.'''
+        try:
+            queue.put(None, timeout=timeout)
+        except Queue.Full:
+            return
+        writer.join(timeout)
+
+
+class QueueHandler(logging.Handler):
+    '''A handler that queues records for `target`, a handler that is only
+    called by the writer thread of `queue`.
+
+    Records below WARNING are kept at the rate of their logger, or its
+    nearest parent, in `sample_rates`. The request id and the time since the
+    start of the request are added to the record and its message is merged
+    with its arguments, in the thread that logs it: the arguments may be
+    objects of the request or of its session. The rest is formatted by the
+    writer.
+    '''
+    def __init__(self, target, queue, sample_rates=None):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = queue
+        self.sample_rates = sample_rates or {}
+        self.dropped = 0
+
+    def sample_rate(self, name):
+        while name not in self.sample_rates:
+            if '.' not in name:
+                return 1
+            name = name.rsplit('.', 1)[0]
+        return self.sample_rates[name]
+
+    def emit(self, record):
+        if record.levelno < logging.WARNING and self.sample_rates and \
+                random.random() >= self.sample_rate(record.name):
+            discarded_records.inc(logger=record.name, reason='sampled')
+            return
+
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            start = g.get('request_start')
+            if start is not None:
+                record.elapsed_ms = round((time.time() - start) * 1000, 2)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # the traceback has to be formatted while its frames exist
+            formatter = self.target.formatter or logging.Formatter()
+            record.exc_text = formatter.formatException(record.exc_info)
+            record.exc_info = None
+
+        if not self.queue.put(self, record):
+            # Handler.handle holds the lock of this handler
+            self.dropped += 1
+            discarded_records.inc(logger=record.name, reason='dropped')
+
+    def write(self, record):
+        '''Write `record` to the target, in the writer thread.'''
+        with self.lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            self.target.handle(logging.makeLogRecord(dict(
+                name=record.name, levelno=logging.WARNING,
+                levelname='WARNING', msg='Dropped %s log records, the log '
+                'queue was full.' % dropped, dropped=dropped)))
+        self.target.handle(record)
+
+
+class RequestId(object):
+    '''Gives every request an id, from the `X-Request-Id` header when the
+    proxy sets one. It is logged with every record and sent back in the
+    response.'''
+    HEADER = 'X-Request-Id'
+
+    def __init__(self, app=None):
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self.start)
+        app.after_request(self.finish)
+
+    def start(self):
+        g.request_start = time.time()
+        g.request_id = request.headers.get(self.HEADER) or uuid.uuid4().hex
+
+    def finish(self, response):
+        if 'request_id' in g:
+            response.headers[self.HEADER] = g.request_id
+        return response
+
+
+log_queue = LogQueue()
@@ -0,0 +1,396 @@
+import bisect
+import contextlib
+import errno
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, request
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                     0.25, 0.5, 1)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class ValueFile(object):
+    '''The values of the metrics of one process in a memory mapped file, so
+    that updating a value costs no more than updating a dict.
+
+    The file starts with the amount of bytes in use, followed by entries of
+    the length of a key, the key padded to 8 bytes and the value as a double.
+    Entries are only ever appended.
+    '''
+    HEADER = struct.Struct('i4x')
+    LENGTH = struct.Struct('i')
+    VALUE = struct.Struct('d')
+    INITIAL_SIZE = 2 ** 16
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'a+b')
+        if os.fstat(self.f.fileno()).st_size == 0:
+            self.f.truncate(self.INITIAL_SIZE)
+        self.size = os.fstat(self.f.fileno()).st_size
+        self.mm = mmap.mmap(self.f.fileno(), self.size)
+        self.used = self.HEADER.unpack_from(self.mm)[0] or self.HEADER.size
+        self.positions = dict((key, position) for key, position, value in
+                              self.read_entries(self.mm, self.used))
+
+    @classmethod
+    def read_entries(cls, data, used):
+        offset = cls.HEADER.size
+        while offset < used:
+            length = cls.LENGTH.unpack_from(data, offset)[0]
+            key = data[offset + 4:offset + 4 + length]
+            offset += 4 + length + (-(4 + length) % 8)
+            yield key, offset, cls.VALUE.unpack_from(data, offset)[0]
+            offset += 8
+
+    @classmethod
+    def read(cls, path):
+        '''The keys and values in the file at `path`.'''
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < cls.HEADER.size:
+            return []
+        return [(key, value) for key, position, value in
+                cls.read_entries(data, cls.HEADER.unpack_from(data)[0])]
+
+    def position(self, key):
+        position = self.positions.get(key)
+        if position is None:
+            padding = -(4 + len(key)) % 8
+            entry = self.LENGTH.pack(len(key)) + key + '\0' * padding + \
+                self.VALUE.pack(0.0)
+            if self.used + len(entry) > self.size:
+                while self.used + len(entry) > self.size:
+                    self.size *= 2
+                self.f.truncate(self.size)
+                self.mm.close()
+                self.mm = mmap.mmap(self.f.fileno(), self.size)
+            self.mm[self.used:self.used + len(entry)] = entry
+            position = self.used + len(entry) - 8
+            self.used += len(entry)
+            # written last, so readers never see a partial entry
+            self.HEADER.pack_into(self.mm, 0, self.used)
+            self.positions[key] = position
+        return position
+
+    def get(self, key):
+        position = self.position(key)
+        return self.VALUE.unpack_from(self.mm, position)[0]
+
+    def add(self, key, amount):
+        position = self.position(key)
+        self.VALUE.pack_into(self.mm, position,
+                             self.VALUE.unpack_from(self.mm, position)[0] +
+                             amount)
+
+    def set(self, key, value):
+        position = self.position(key)
+        self.VALUE.pack_into(self.mm, position, value)
+
+
+class DictValues(dict):
+    '''The values of the metrics of a process that is not shared, for a
+    single process.'''
+    def add(self, key, amount):
+        self[key] = self.get(key, 0.0) + amount
+
+    def set(self, key, value):
+        self[key] = value
+
+
+class Registry(object):
+    '''The metrics of the app and their values.
+
+    Every process of a uwsgi app keeps its values in its own file in
+    `directory`, `collect` adds the values of all processes up. Gauges of
+    processes that exited are left out. Without a directory the values are
+    kept in memory and only this process is reported.
+    '''
+    def __init__(self):
+        self.metrics = {}
+        self.directory = None
+        # Reentrant, connections that are garbage collected while a value is
+        # updated are checked in, which updates a value.
+        self.lock = threading.RLock()
+        self.pid = None
+        self._values = None
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+
+    @property
+    def values(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            if self.directory:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                self._values = ValueFile(os.path.join(
+                    self.directory, 'metrics.%s.db' % self.pid))
+            else:
+                self._values = DictValues()
+        return self._values
+
+    def add(self, *pairs):
+        '''Add the amounts to the values of the keys of the `(key, amount)`
+        pairs.'''
+        with self.lock:
+            values = self.values
+            for key, amount in pairs:
+                values.add(key, amount)
+
+    def set(self, key, value):
+        with self.lock:
+            self.values.set(key, value)
+
+    def processes(self):
+        '''The values of every process by pid.'''
+        if not self.directory:
+            with self.lock:
+                return {os.getpid(): self.values.items()}
+        processes = {}
+        for path in glob.glob(os.path.join(self.directory, 'metrics.*.db')):
+            pid = int(path.rsplit('.', 2)[1])
+            processes[pid] = ValueFile.read(path)
+        return processes
+
+    def collect(self):
+        '''The values of all processes added up, by metric name and by the
+        sample name and labels.'''
+        samples = defaultdict(lambda: defaultdict(float))
+        for pid, values in self.processes().iteritems():
+            alive = None
+            for key, value in values:
+                name, sample, labels = json.loads(key)
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                if isinstance(metric, GaugeMetric):
+                    if alive is None:
+                        alive = pid_alive(pid)
+                    if not alive:
+                        continue
+                samples[name][sample, tuple(map(tuple, labels))] += value
+        return samples
+
+    def render(self):
+        '''The metrics in the Prometheus text format.'''
+        lines = []
+        samples = self.collect()
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.TYPE))
+            for sample, labels, value in metric.samples(samples[name]):
+                if labels:
+                    sample += '{%s}' % ','.join(
+                        '%s="%s"' % (label, unicode(label_value).
+                                     replace('\\', r'\\').
+                                     replace('"', r'\"'))
+                        for label, label_value in labels)
+                lines.append('%s %r' % (sample, value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+    TYPE = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.registry = registry
+        self._keys = {}
+        registry.register(self)
+
+    def keys(self, labels):
+        '''The keys of the samples of `labels` in the stored values, see
+        `make_keys`. They are made once per combination of labels.'''
+        try:
+            values = tuple([labels[label] for label in self.labels])
+        except KeyError:
+            values = None
+        if values is None or len(labels) != len(self.labels):
+            raise ValueError('%s has the labels %s' % (self.name,
+                                                       ', '.join(self.labels)))
+        keys = self._keys.get(values)
+        if keys is None:
+            keys = self._keys[values] = self.make_keys(zip(self.labels,
+                                                           values))
+        return keys
+
+    def key(self, sample, labels):
+        return json.dumps([self.name, sample, labels])
+
+    def make_keys(self, labels):
+        return self.key(self.name, labels)
+
+    def samples(self, values):
+        '''The samples to render of the added up `values`.'''
+        for (sample, labels), value in sorted(values.iteritems()):
+            yield sample, labels, value
+
+
+class CounterMetric(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self.registry.add((self.keys(labels), amount))
+
+
+class GaugeMetric(Metric):
+    '''A gauge, the values of the processes are added up.'''
+    TYPE = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        self.registry.add((self.keys(labels), amount))
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        self.registry.set(self.keys(labels), value)
+
+
+class HistogramMetric(Metric):
+    '''A histogram. The count of each bucket is stored on its own, the
+    cumulative counts and the total count are computed when it is
+    rendered.'''
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS,
+                 **kwargs):
+        super(HistogramMetric, self).__init__(name, help, labels, **kwargs)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def make_keys(self, labels):
+        return ([self.key(self.name + '_bucket', labels + [('le', bound)])
+                 for bound in self.buckets],
+                self.key(self.name + '_sum', labels))
+
+    def observe(self, value, **labels):
+        buckets, total = self.keys(labels)
+        self.registry.add((buckets[bisect.bisect_left(self.buckets, value)], 1),
+                          (total, value))
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self, values):
+        series = defaultdict(dict)
+        for (sample, labels), value in values.iteritems():
+            if sample.endswith('_bucket'):
+                labels, bound = labels[:-1], labels[-1][1]
+                series[labels][bound] = value
+            else:
+                series[labels][sample] = value
+
+        for labels in sorted(series):
+            counts = series[labels]
+            cumulative = 0.0
+            for bound in self.buckets:
+                cumulative += counts.get(bound, 0.0)
+                yield self.name + '_bucket', labels + (
+                    ('le', '+Inf' if bound == float('inf') else repr(bound)),
+                ), cumulative
+            yield self.name + '_sum', labels, counts.get(self.name + '_sum',
+                                                         0.0)
+            yield self.name + '_count', labels, cumulative
+
+
+class Metrics(object):
+    '''Exposes the metrics of all processes at `/metrics` in the Prometheus
+    text format.
+
+    Every metric update writes to a memory mapped file of the process, in
+    `METRICS_DIR`, that a scrape reads and adds up. Remove the directory when
+    the app is (re)started, the counters of the previous processes are
+    reported until it is.
+
+    Measures the latency of requests by endpoint and status, the time of
+    statements and the connections checked out of the pools of `engines`.
+    '''
+    def __init__(self, app=None, engines=None):
+        self.registry = REGISTRY
+        if app:
+            self.init_app(app, engines)
+
+    def init_app(self, app, engines):
+        self.registry.directory = app.config.get('METRICS_DIR')
+
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self.before_execute)
+            event.listen(engine, 'after_cursor_execute', self.after_execute)
+            event.listen(engine, 'checkout', self.checkout)
+            event.listen(engine, 'checkin', self.checkin)
+
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+
+    def start(self):
+        g.metrics_start = time.time()
+
+    def finish(self, response):
+        start = g.get('metrics_start')
+        if start is not None:
+            request_duration.observe(time.time() - start,
+                                     endpoint=request.endpoint or 'unknown',
+                                     status=response.status_code)
+        return response
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        if context is not None:
+            context.metrics_start = time.time()
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        start = getattr(context, 'metrics_start', None)
+        if start is not None:
+            statement_duration.observe(time.time() - start)
+
+    def checkout(self, dbapi_connection, connection_record, connection_proxy):
+        pool_checked_out.inc()
+
+    def checkin(self, dbapi_connection, connection_record):
+        pool_checked_out.dec()
+
+    def view(self):
+        return self.registry.render(), 200, {
+            'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+request_duration = HistogramMetric(
+    'http_request_duration_seconds', 'Latency of requests.',
+    ['endpoint', 'status'])
+statement_duration = HistogramMetric(
+    'db_statement_duration_seconds', 'Execution time of SQL statements.',
+    buckets=STATEMENT_BUCKETS)
+pool_checked_out = GaugeMetric(
+    'db_pool_checked_out', 'Connections checked out of the pools.')
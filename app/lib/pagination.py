@@ -1,6 +1,7 @@
 import math
 
 from flask import url_for
+from timing import span, timed
 from utils import merge_sqla_results
 
 
@@ -25,8 +26,10 @@ class Pagination(object):
             raise PaginationError(self)
 
         query_results = query.offset(self.offset).limit(self.limit).all()
-        self.items = merge_sqla_results(query_results)
+        with span('merge'):
+            self.items = list(merge_sqla_results(query_results))
 
+    @timed('url')
     def generate_url(self, **pagination_params):
         param_dicts = (pagination_params,
                        self.view_args,
@@ -0,0 +1,373 @@
+import errno
+import glob
+import json
+import logging
+import os
+import Queue
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import g, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Patterns that normalize a statement into a fingerprint. Statements that only
+# differ in their literals or parameters share a fingerprint.
+FINGERPRINT_PATTERNS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\(\w+\)s|%s'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\s+'), ' '),
+    (re.compile(r'\bIN \((?:\?, )*\?\)', re.IGNORECASE), 'IN (...)'),
+]
+
+
+def fingerprint(statement):
+    '''Normalize a statement by replacing literals and parameters with `?`,
+    collapsing whitespace and collapsing `IN` lists.
+    '''
+    for pattern, replacement in FINGERPRINT_PATTERNS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+class Profile(object):
+    '''The statements executed during a single request.'''
+    def __init__(self):
+        self.statements = 0
+        self.duration = 0.0
+        self.counts = Counter()
+        self.durations = defaultdict(float)
+
+    def add(self, statement, duration):
+        key = fingerprint(statement)
+        self.statements += 1
+        self.duration += duration
+        self.counts[key] += 1
+        self.durations[key] += duration
+
+    def n_plus_one(self, threshold):
+        '''Return the SELECT fingerprints repeated at least `threshold` times,
+        most repeated first. These are likely lazy loads in a loop.
+        '''
+        return [(key, count) for key, count in self.counts.most_common()
+                if count >= threshold and key.upper().startswith('SELECT')]
+
+    def as_dict(self, threshold):
+        return dict(
+            statements=self.statements,
+            db_time_ms=round(self.duration * 1000, 2),
+            fingerprints=[dict(fingerprint=key,
+                               count=count,
+                               time_ms=round(self.durations[key] * 1000, 2))
+                          for key, count in self.counts.most_common()],
+            n_plus_one=[key for key, count in self.n_plus_one(threshold)],
+        )
+
+
+class SQLProfiler(object):
+    '''Profiles the SQL of a sample of requests using engine events.
+
+    A profile records the amount of statements, the total time spent executing
+    them and the repeat counts of their fingerprints. Fingerprints repeated
+    `SQL_PROFILER_N_PLUS_ONE_THRESHOLD` times are flagged as N+1 candidates.
+    The profile is logged as JSON to the `app.sql` logger, N+1 candidates as a
+    warning, and if `SQL_PROFILER_HEADER` is set it is summarized in the
+    `X-SQL-Profile` response header.
+
+    `SQL_PROFILER_SAMPLE_RATE` is the fraction of requests to profile.
+    '''
+    HEADER = 'X-SQL-Profile'
+
+    def __init__(self, app=None, engines=None):
+        self.sample_rate = 0
+        self.header = False
+        self.threshold = 3
+        self.logger = logging.getLogger('app.sql')
+        if app:
+            self.init_app(app, engines)
+
+    def init_app(self, app, engines):
+        self.sample_rate = app.config.get('SQL_PROFILER_SAMPLE_RATE', 0)
+        self.header = app.config.get('SQL_PROFILER_HEADER', False)
+        self.threshold = app.config.get('SQL_PROFILER_N_PLUS_ONE_THRESHOLD', 3)
+
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self.before_execute)
+            event.listen(engine, 'after_cursor_execute', self.after_execute)
+
+        app.before_request(self.start)
+        app.after_request(self.finish)
+
+    @property
+    def profile(self):
+        '''The profile of the current request or None.'''
+        if has_app_context():
+            return g.get('sql_profile')
+
+    def start(self):
+        if random.random() < self.sample_rate:
+            g.sql_profile = Profile()
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        if self.profile is not None and context is not None:
+            context.profile_start = time.time()
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        profile = self.profile
+        start = getattr(context, 'profile_start', None)
+        if profile is not None and start is not None:
+            profile.add(statement, time.time() - start)
+
+    def finish(self, response):
+        profile = self.profile
+        if profile is None:
+            return response
+
+        record = dict(profile.as_dict(self.threshold),
+                      method=request.method,
+                      path=request.path,
+                      endpoint=request.endpoint,
+                      status=response.status_code)
+        self.logger.info('SQL profile', extra=dict(data=record))
+        if record['n_plus_one']:
+            self.logger.warning('N+1 query candidates', extra=dict(data=dict(
+                endpoint=request.endpoint,
+                n_plus_one=record['n_plus_one'])))
+
+        if self.header:
+            response.headers[self.HEADER] = \
+                'statements=%s; time=%sms; n+1=%s' % (
+                    record['statements'],
+                    record['db_time_ms'],
+                    len(record['n_plus_one']))
+        return response
+
+
+class SlowQueryLog(object):
+    '''Explains statements that take longer than `SLOW_QUERY_THRESHOLD`
+    seconds, using engine events.
+
+    The plan is made by a background thread on a connection of its own, so
+    the request that ran the statement is not slowed down any further.
+    SELECTs are explained with `EXPLAIN (ANALYZE, BUFFERS)` in a read only
+    transaction, other statements would be executed a second time by ANALYZE
+    and are only planned. The explain is cancelled after
+    `SLOW_QUERY_TIMEOUT` seconds.
+
+    To not add to the load of a database that is already slow every process
+    explains at most `SLOW_QUERY_EXPLAINS_PER_MINUTE` statements, a
+    fingerprint at most once per `SLOW_QUERY_FINGERPRINT_INTERVAL` seconds,
+    and slow statements that come in while the thread is busy are dropped.
+
+    Captures are JSON files in `SLOW_QUERY_DIR`, only the newest
+    `SLOW_QUERY_BUFFER` are kept. Inspect them with `app profile queries`.
+    '''
+    EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+    # parameters of which the values are not captured
+    HIDDEN_PARAMETERS = re.compile('password|token|email', re.IGNORECASE)
+
+    def __init__(self, app=None, engines=None):
+        self.threshold = None
+        self.interval = 10
+        self.fingerprint_interval = 300
+        self.timeout = 10
+        self.size = 100
+        self.directory = None
+        self.next_explain = 0
+        self.explained = {}
+        self.lock = threading.Lock()
+        self.queue = None
+        self.pid = None
+        self.logger = logging.getLogger('app.sql')
+        if app:
+            self.init_app(app, engines)
+
+    def init_app(self, app, engines):
+        self.threshold = app.config.get('SLOW_QUERY_THRESHOLD')
+        self.interval = 60.0 / app.config.get('SLOW_QUERY_EXPLAINS_PER_MINUTE',
+                                              6)
+        self.fingerprint_interval = app.config.get(
+            'SLOW_QUERY_FINGERPRINT_INTERVAL', 300)
+        self.timeout = app.config.get('SLOW_QUERY_TIMEOUT', 10)
+        self.size = app.config.get('SLOW_QUERY_BUFFER', 100)
+        self.directory = app.config.get('SLOW_QUERY_DIR')
+        if self.threshold is None or not self.directory:
+            return
+
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self.before_execute)
+            event.listen(engine, 'after_cursor_execute', self.after_execute)
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        if context is not None:
+            context.slow_query_start = time.time()
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        start = getattr(context, 'slow_query_start', None)
+        if start is None:
+            return
+        duration = time.time() - start
+        if duration < self.threshold or executemany or \
+                not statement.lstrip().upper().startswith(self.EXPLAINABLE):
+            return
+
+        key = fingerprint(statement)
+        if not self.allow(key, time.time()):
+            return
+        capture = dict(fingerprint=key,
+                       statement=statement,
+                       parameters=self.visible_parameters(parameters),
+                       duration_ms=round(duration * 1000, 2),
+                       captured_at=time.time())
+        if has_request_context():
+            capture.update(method=request.method, path=request.path,
+                           endpoint=request.endpoint)
+        try:
+            self.start().put_nowait((conn.engine, parameters, capture))
+        except Queue.Full:
+            pass
+
+    def allow(self, key, now):
+        '''Whether a statement with the fingerprint `key` may be explained
+        `now`, if so the time is taken.'''
+        with self.lock:
+            last = self.explained.get(key)
+            if now < self.next_explain or (
+                    last is not None and now < last + self.fingerprint_interval):
+                return False
+            self.next_explain = now + self.interval
+            self.explained[key] = now
+            return True
+
+    def visible_parameters(self, parameters):
+        if isinstance(parameters, dict):
+            return dict((key, '***' if self.HIDDEN_PARAMETERS.search(key)
+                         else repr(value))
+                        for key, value in parameters.iteritems())
+        return [repr(value) for value in parameters or ()]
+
+    def start(self):
+        '''The queue of the explaining thread, started once per process.'''
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.queue = Queue.Queue(maxsize=1)
+                worker = threading.Thread(target=self.run, name='explain')
+                worker.daemon = True
+                worker.start()
+        return self.queue
+
+    def run(self):
+        while True:
+            engine, parameters, capture = self.queue.get()
+            try:
+                capture['plan'] = self.explain(engine, capture['statement'],
+                                               parameters)
+            except Exception as e:
+                # anything, the thread has to keep going
+                capture['error'] = str(e).strip()
+            self.write(capture)
+
+    def explain(self, engine, statement, parameters):
+        '''The plan of `statement`, from a connection of its own. SELECTs
+        are executed.'''
+        analyze = statement.lstrip().upper().startswith('SELECT')
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SET TRANSACTION READ ONLY')
+            cursor.execute('SET LOCAL statement_timeout = %s',
+                           (int(self.timeout * 1000),))
+            cursor.execute(('EXPLAIN (ANALYZE, BUFFERS) ' if analyze
+                            else 'EXPLAIN ') + statement, parameters)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+        finally:
+            connection.rollback()
+            connection.close()
+
+    def write(self, capture):
+        '''Add `capture` to the ring buffer, removing the oldest captures.'''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        name = '%d-%d' % (capture['captured_at'] * 10 ** 6, os.getpid())
+        path = os.path.join(self.directory, name + '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(dict(capture, id=name), f, indent=2)
+        os.rename(path + '.tmp', path)
+        self.logger.warning('Slow statement', extra=dict(data=dict(
+            id=name,
+            fingerprint=capture['fingerprint'],
+            duration_ms=capture['duration_ms'])))
+
+        for old in self.paths(self.directory)[:-self.size]:
+            try:
+                os.remove(old)
+            except OSError as e:
+                # removed by another process
+                if e.errno != errno.ENOENT:
+                    raise
+
+    @staticmethod
+    def paths(directory):
+        '''The paths of the captures in `directory`, oldest first.'''
+        return sorted(glob.glob(os.path.join(directory, '*.json')),
+                      key=lambda path: int(os.path.basename(path).split('-')[0]))
+
+    @classmethod
+    def captures(cls, directory):
+        '''The captures in `directory`, oldest first.'''
+        captures = []
+        for path in cls.paths(directory):
+            try:
+                with open(path) as f:
+                    captures.append(json.load(f))
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return captures
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class query_budget(object):
+    '''A context manager that raises QueryBudgetExceeded when more than `n`
+    statements are executed within it, on any engine. The statements that
+    only set up transactions, see `begin_read_only`, don't count.
+
+    >>> with query_budget(2):
+    >>>     client.get('/v1/users')
+    '''
+    IGNORED = ('SET TRANSACTION',)
+
+    def __init__(self, n):
+        self.n = n
+        self.statements = []
+        self._listener = self.record
+
+    def record(self, conn, cursor, statement, parameters, context,
+               executemany):
+        if not statement.startswith(self.IGNORED):
+            self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(Engine, 'after_cursor_execute', self._listener)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        event.remove(Engine, 'after_cursor_execute', self._listener)
+        if exc_type is None and len(self.statements) > self.n:
+            raise QueryBudgetExceeded(
+                'Executed %s statements, the budget is %s:\n%s' % (
+                    len(self.statements),
+                    self.n,
+                    '\n'.join(fingerprint(s) for s in self.statements)))
@@ -0,0 +1,182 @@
+import os
+import random
+import sys
+import thread
+import threading
+import time
+from collections import Counter, defaultdict
+
+from itsdangerous import (
+    BadSignature,
+    SignatureExpired,
+    TimedJSONWebSignatureSerializer as Serializer,
+)
+from werkzeug.exceptions import HTTPException
+
+
+def frame_name(frame):
+    '''The name of the function of `frame` in a collapsed stack.'''
+    return '%s:%s' % (frame.f_globals.get('__name__', frame.f_code.co_filename),
+                      frame.f_code.co_name)
+
+
+def collapse(frame, root_code=None):
+    '''The stack of `frame` as `outer;...;inner`, the stack starts below the
+    frame running `root_code`.'''
+    names = []
+    while frame is not None and frame.f_code is not root_code:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler(object):
+    '''Samples the stacks of a fraction of requests, as a WSGI middleware.
+
+    While a profiled request runs a background thread looks up the stack of
+    the thread serving it every `SAMPLING_PROFILER_INTERVAL` seconds. Only
+    profiled requests are sampled and no tracing hooks are installed, so the
+    other requests run at full speed and profiled requests are only slowed
+    down by the sampler taking the GIL.
+
+    `SAMPLING_PROFILER_RATE` is the fraction of requests to profile. Requests
+    with a token of `token()` in the `X-Profile` header are always profiled,
+    tokens are signed with the `SECRET_KEY`.
+
+    Stacks are counted per endpoint and written as collapsed stacks, the
+    format of flamegraph.pl and speedscope, with the endpoint as the root
+    frame. Every process writes its own `profile.<pid>.collapsed` in
+    `SAMPLING_PROFILER_DIR`, every `SAMPLING_PROFILER_FLUSH_INTERVAL` seconds
+    while it profiles and when it stops. `app profile stacks` merges them.
+    '''
+    HEADER = 'X-Profile'
+    SALT = 'sampling-profiler'
+
+    def __init__(self, app=None):
+        self.app = None
+        self.sample_rate = 0
+        self.interval = 0.005
+        self.directory = None
+        self.flush_interval = 10
+        self.stacks = defaultdict(Counter)
+        self.dirty = False
+        self.active = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pid = None
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.sample_rate = app.config.get('SAMPLING_PROFILER_RATE', 0)
+        self.interval = app.config.get('SAMPLING_PROFILER_INTERVAL', 0.005)
+        self.directory = app.config.get('SAMPLING_PROFILER_DIR')
+        self.flush_interval = app.config.get(
+            'SAMPLING_PROFILER_FLUSH_INTERVAL', 10)
+        app.wsgi_app = self.middleware(app.wsgi_app)
+
+    def token(self, expiration=3600):
+        '''A value of the `X-Profile` header that profiles requests for
+        `expiration` seconds.'''
+        s = Serializer(self.app.config['SECRET_KEY'], expires_in=expiration,
+                       salt=self.SALT)
+        return s.dumps(dict(profile=True))
+
+    def verify_token(self, token):
+        s = Serializer(self.app.config['SECRET_KEY'], salt=self.SALT)
+        try:
+            return s.loads(token).get('profile', False)
+        except (SignatureExpired, BadSignature):
+            return False
+
+    def wants_profile(self, environ):
+        token = environ.get('HTTP_X_PROFILE')
+        if token:
+            return self.verify_token(token)
+        return self.sample_rate and random.random() < self.sample_rate
+
+    def endpoint(self, environ):
+        try:
+            endpoint, args = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return 'unknown'
+        return endpoint
+
+    def middleware(self, wsgi_app):
+        def profiled_app(environ, start_response):
+            if not self.wants_profile(environ):
+                return wsgi_app(environ, start_response)
+            return self.profile(wsgi_app, environ, start_response)
+        return profiled_app
+
+    def profile(self, wsgi_app, environ, start_response):
+        # Flask buffers the responses of the api, the work is done by the time
+        # the response is returned.
+        ident = thread.get_ident()
+        with self.lock:
+            self.active[ident] = self.endpoint(environ)
+            self.start()
+        try:
+            return wsgi_app(environ, start_response)
+        finally:
+            with self.lock:
+                del self.active[ident]
+
+    def start(self):
+        '''Wake up the sampler, started once per process. Called with the
+        lock held.'''
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.stacks = defaultdict(Counter)
+            self.wakeup = threading.Event()
+            sampler = threading.Thread(target=self.run, name='sampler')
+            sampler.daemon = True
+            sampler.start()
+        self.wakeup.set()
+
+    def run(self):
+        root_code = SamplingProfiler.profile.__func__.__code__
+        flushed = time.time()
+        while True:
+            with self.lock:
+                active = self.active.items()
+                if not active:
+                    self.wakeup.clear()
+            if not active:
+                self.flush()
+                self.wakeup.wait()
+                continue
+
+            frames = sys._current_frames()
+            for ident, endpoint in active:
+                frame = frames.get(ident)
+                stack = frame and collapse(frame, root_code)
+                # empty when the middleware is about to call the app or has
+                # just returned
+                if stack:
+                    self.stacks[endpoint][stack] += 1
+                    self.dirty = True
+            del frames
+
+            if time.time() - flushed > self.flush_interval:
+                self.flush()
+                flushed = time.time()
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        '''The collapsed stacks sampled by this process, a line per stack.'''
+        return ['%s;%s %s' % (endpoint, stack, count)
+                for endpoint, counter in self.stacks.items()
+                for stack, count in counter.items()]
+
+    def flush(self):
+        if not self.directory or not self.dirty:
+            return
+        self.dirty = False
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, 'profile.%s.collapsed' % self.pid)
+        with open(path + '.tmp', 'w') as f:
+            f.writelines(line + '\n' for line in self.collapsed())
+        os.rename(path + '.tmp', path)
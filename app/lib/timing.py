@@ -0,0 +1,166 @@
+import functools
+import logging
+import random
+import time
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+
+
+def current_timings():
+    '''The timings of the current request or None.'''
+    if has_app_context():
+        return g.get('timings')
+
+
+class Timings(object):
+    '''The time spent in each phase of a request. A phase only counts its own
+    time, the time of the phases within it is left out, so the phases add up
+    to at most the total.'''
+    def __init__(self):
+        self.start = time.time()
+        self.phases = {}
+        self.order = []
+        # the time spent in the phases within each open span
+        self.nested = []
+
+    def add(self, name, seconds, elapsed=None):
+        '''Add `seconds` to the phase `name`. The open span, if any, spent
+        `elapsed` seconds in it, which defaults to `seconds`.'''
+        if name not in self.phases:
+            self.phases[name] = 0.0
+            self.order.append(name)
+        self.phases[name] += seconds
+        if self.nested:
+            self.nested[-1] += seconds if elapsed is None else elapsed
+
+    def summary(self, total):
+        '''The phases, the rest of the request as `other` and the `total`,
+        in milliseconds.'''
+        rv = [(name, self.phases[name] * 1000) for name in self.order]
+        rv.append(('other', (total - sum(self.phases.values())) * 1000))
+        rv.append(('total', total * 1000))
+        return rv
+
+
+class span(object):
+    '''Count the time of a block towards the phase `name` of the current
+    request. Outside of a timed request it does nothing.
+
+    >>> with span('serialize'):
+    >>>     schema.dump(obj)
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.timings = None
+
+    def __enter__(self):
+        self.timings = current_timings()
+        if self.timings is not None:
+            self.timings.nested.append(0.0)
+            self.start = time.time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.timings is not None:
+            elapsed = time.time() - self.start
+            self.timings.add(self.name, elapsed - self.timings.nested.pop(),
+                             elapsed)
+
+
+def timed(name):
+    '''Decorate a function to count its time towards the phase `name`.'''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class RequestTimer(object):
+    '''Times the phases of requests that code reports with `span` and `timed`.
+    The time SQLAlchemy spends compiling statements is the `query` phase and
+    the time they take to execute the `db` phase.
+
+    With `SERVER_TIMING_HEADER` the phases are sent in the `Server-Timing`
+    header, in milliseconds. A fraction of `REQUEST_TIMING_LOG_RATE` requests
+    is logged as JSON to the `app.timing` logger. Requests that are neither
+    are not timed.
+    '''
+    HEADER = 'Server-Timing'
+
+    def __init__(self, app=None, engines=None):
+        self.header = False
+        self.log_rate = 0
+        self.logger = logging.getLogger('app.timing')
+        if app:
+            self.init_app(app, engines)
+
+    def init_app(self, app, engines):
+        self.header = app.config.get('SERVER_TIMING_HEADER', False)
+        self.log_rate = app.config.get('REQUEST_TIMING_LOG_RATE', 0)
+        if not self.header and not self.log_rate:
+            return
+
+        for engine in engines:
+            event.listen(engine, 'before_execute', self.before_compile)
+            event.listen(engine, 'before_cursor_execute', self.before_execute)
+            event.listen(engine, 'after_cursor_execute', self.after_execute)
+            event.listen(engine, 'handle_error', self.handle_error)
+
+        app.before_request(self.start)
+        app.after_request(self.finish)
+
+    def start(self):
+        log = self.log_rate and random.random() < self.log_rate
+        if self.header or log:
+            g.timings = Timings()
+            g.timings_log = log
+
+    def before_compile(self, conn, clauseelement, multiparams, params):
+        if current_timings() is not None:
+            conn.info['timing_compile'] = time.time()
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        compile_start = conn.info.pop('timing_compile', None)
+        timings = current_timings()
+        if timings is None:
+            return
+        now = time.time()
+        if compile_start is not None:
+            timings.add('query', now - compile_start)
+        if context is not None:
+            context.timing_start = now
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        timings = current_timings()
+        start = getattr(context, 'timing_start', None)
+        if timings is not None and start is not None:
+            timings.add('db', time.time() - start)
+
+    def handle_error(self, exception_context):
+        # the statement failed, its compile time must not be added to the
+        # next statement on the connection
+        if exception_context.connection is not None:
+            exception_context.connection.info.pop('timing_compile', None)
+
+    def finish(self, response):
+        timings = current_timings()
+        if timings is None:
+            return response
+
+        summary = timings.summary(time.time() - timings.start)
+        if self.header:
+            response.headers[self.HEADER] = ', '.join(
+                '%s;dur=%.2f' % (name, ms) for name, ms in summary)
+        if g.timings_log:
+            self.logger.info('Request timing', extra=dict(data=dict(
+                method=request.method,
+                path=request.path,
+                endpoint=request.endpoint,
+                status=response.status_code,
+                phases=dict((name, round(ms, 2)) for name, ms in summary))))
+        return response
@@ -5,7 +5,10 @@ import inspect
 
 from flask import url_for, current_app, Response, jsonify, abort
 
+from timing import span, timed
 
+
+@timed('url')
 def make_url(route, **kwargs):
     '''Generate an external url.'''
     return url_for(route, _external=True, **kwargs)
@@ -76,6 +79,7 @@ def parse_rv(rv):
         return rv, None, None
 
 
+@timed('url')
 def get_location_header(route, **kwargs):
     '''Return a location header.
     '''
@@ -171,7 +175,8 @@ class HandleJSONReponse(Response):
     @classmethod
     def force_type(cls, rv, environ=None):
         if isinstance(rv, dict):
-            rv = jsonify(rv)
+            with span('json'):
+                rv = jsonify(rv)
         return super(HandleJSONReponse, cls).force_type(rv, environ)
 
 
@@ -0,0 +1,109 @@
+from collections import namedtuple
+
+from app.lib import CounterMetric
+
+# The answer to a question, responses store the ids of the questions and the
+# values of the answers in two arrays, see `pair_answers`.
+Choice = namedtuple('Choice', 'question_id value')
+OptionDefinition = namedtuple('OptionDefinition', 'value text')
+ScoreDefinition = namedtuple('ScoreDefinition', 'name range')
+
+
+class QuestionDefinition(namedtuple('QuestionDefinition',
+                                    'id text ordinal options values')):
+    '''A question with its options and the set of their values.'''
+    @classmethod
+    def build(cls, question):
+        options = tuple(OptionDefinition(option.value, option.text)
+                        for option in question.options)
+        return cls(id=question.id,
+                   text=question.text,
+                   ordinal=question.ordinal,
+                   options=options,
+                   values=frozenset(option.value for option in options))
+
+
+class QuestionnaireDefinition(namedtuple('QuestionnaireDefinition',
+                                         'id version questions question_ids '
+                                         'scores max_score')):
+    '''The questions, options and scores of a version of a questionnaire.
+    Everything that is derived from them, such as the maximum score, is
+    computed once when it is built.
+    '''
+    @classmethod
+    def build(cls, questionnaire, questions, scores):
+        questions = tuple(QuestionDefinition.build(question)
+                          for question in questions)
+        return cls(id=questionnaire.id,
+                   version=questionnaire.version,
+                   questions=questions,
+                   question_ids=frozenset(question.id for question in questions),
+                   scores=tuple(ScoreDefinition(score.name, score.range)
+                                for score in scores),
+                   max_score=sum(max(question.values) for question in questions
+                                 if question.values))
+
+    def answers(self, choices):
+        '''Turn `choices`, dicts with a question id and a value, into the
+        values in the order of the questions. Raises a ValueError when not
+        every question has a single valid answer.
+        '''
+        given = {choice['question_id']: choice['value'] for choice in choices}
+        if len(given) != len(choices) or self.question_ids ^ set(given):
+            raise ValueError('Response is missing questions.')
+
+        for question in self.questions:
+            if given[question.id] not in question.values:
+                raise ValueError('Invalid value for question %s.' %
+                                 question.ordinal)
+        return [given[question.id] for question in self.questions]
+
+    @property
+    def question_order(self):
+        '''The ids of the questions, in the order of their answers.'''
+        return [question.id for question in self.questions]
+
+
+def pair_answers(question_ids, answers):
+    '''Pair stored `answers` with the `question_ids` stored with them, which
+    are those of the questions when the response was given. Raises a
+    ValueError when they don't pair up.
+    '''
+    if question_ids is None or len(question_ids) != len(answers):
+        raise ValueError('%s answers for the questions %s.' % (
+            len(answers), question_ids))
+    return [Choice(question_id, value)
+            for question_id, value in zip(question_ids, answers)]
+
+
+class DefinitionCache(object):
+    '''Questionnaire definitions of this worker, keyed by questionnaire id and
+    version. A definition is built once per version, so the version has to be
+    bumped when questions, options or scores change.
+
+    Threads that miss the same key at the same time both build it, they build
+    the same thing so it doesn't matter which one is kept.
+    '''
+    def __init__(self):
+        self._definitions = {}
+
+    def get(self, questionnaire):
+        key = (questionnaire.id, questionnaire.version)
+        definition = self._definitions.get(key)
+        if definition is None:
+            definition_lookups.inc(result='miss')
+            definition = questionnaire.build_definition()
+            self._definitions[key] = definition
+        else:
+            definition_lookups.inc(result='hit')
+        return definition
+
+    def clear(self):
+        self._definitions.clear()
+
+
+definitions = DefinitionCache()
+definition_lookups = CounterMetric(
+    'questionnaire_definition_cache_total',
+    'Lookups of questionnaire definitions by whether they were cached.',
+    ['result'])
@@ -1,3 +1,5 @@
+import time
+
 import bcrypt
 from sqlalchemy import String, Column, Integer, event, Sequence
 from sqlalchemy.ext.compiler import compiles
@@ -5,22 +7,59 @@ from sqlalchemy.sql import expression
 from sqlalchemy.types import TypeDecorator
 from werkzeug.security import safe_str_cmp
 
-from app.lib import with_app_config
+from app.lib import HistogramMetric, with_app_config
 from orm import db
 
 ID_FUNCTION_NAME = 'obscure_id'
 ID_FUNCTION_SIGNATURE = '{}(value bigint)'.format(ID_FUNCTION_NAME)
 GLOBAL_SEQUENCE_NAME = 'global_id_seq'
 
+bcrypt_duration = HistogramMetric(
+    'bcrypt_duration_seconds', 'Time spent hashing passwords with bcrypt.',
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+
 # http://blog.joevandyk.com/2013/04/18/generating-random-ids-with-postgresql/
 # This is an implemenation of a feistel cipher. It is not secure but provides
 # enough obfuscation to accomplish two goals.
 # 1. It hides the sequential nature of the rows from the casual onlooker.
 # 2. It provides an integer that looks nice when run through base64/62 for
 #    good looking urls.
+#
+# The round function is round(((key * r + 150889) % modulus) / modulus * 32767)
+# in integer math, (x * 2 * 32767 + modulus) / (2 * modulus) rounds x * 32767 /
+# modulus half up. The three rounds are unrolled. It returns the same ids as
+# the original loop over numerics for every value below 2 ** 31, in a third of
+# the time. A SQL function isn't faster, it can't be inlined with the volatile
+# nextval as its argument.
 create_id_function_ddl = '''
 CREATE OR REPLACE FUNCTION {id_function_signature} returns bigint AS $$
 DECLARE
+l bigint;
+r bigint;
+t bigint;
+BEGIN
+ l := (value >> 16) & 65535;
+ r := value & 65535;
+ t := r;
+ r := l # (({coprime} * r + 150889) %% {modulus} * 65534 + {modulus}) / {double_modulus};
+ l := t;
+ t := r;
+ r := l # (({coprime} * r + 150889) %% {modulus} * 65534 + {modulus}) / {double_modulus};
+ l := t;
+ t := r;
+ r := l # (({coprime} * r + 150889) %% {modulus} * 65534 + {modulus}) / {double_modulus};
+ l := t;
+ RETURN (r << 16) + l;
+END;
+$$ LANGUAGE plpgsql strict immutable;
+'''
+drop_id_function_ddl = 'DROP FUNCTION IF EXISTS {id_function_signature}'
+
+# The original loop over numerics, create_id_function_ddl has to return the
+# same ids. The tests compare the two and `app bench ids` times them.
+looping_id_function_ddl = '''
+CREATE OR REPLACE FUNCTION {id_function_signature} returns bigint AS $$
+DECLARE
 l1 int;
 l2 int;
 r1 int;
@@ -40,7 +79,6 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql strict immutable;
 '''
-drop_id_function_ddl = 'DROP FUNCTION IF EXISTS {id_function_signature}'
 
 # Define global sequence and bind it to the metadata
 Sequence(GLOBAL_SEQUENCE_NAME, metadata=db.Base.metadata)
@@ -55,10 +93,23 @@ def create_id(target, conn, **kwargs):
         id_function_signature=ID_FUNCTION_SIGNATURE,
         coprime=kwargs['OBSCURE_ID_KEY'],
         modulus=kwargs['OBSCURE_ID_MODULUS'],
+        double_modulus=2 * int(kwargs['OBSCURE_ID_MODULUS']),
     )
     conn.execute(ddl)
 
 
+# Every connection takes OBSCURE_ID_SEQUENCE_CACHE values of the global
+# sequence at a time, so inserts don't all contend for the sequence. Values a
+# connection doesn't use are lost, which leaves gaps in the sequence.
+@event.listens_for(db.Base.metadata, 'after_create')
+@with_app_config('OBSCURE_ID_SEQUENCE_CACHE')
+def set_sequence_cache(target, conn, **kwargs):
+    conn.execute('ALTER SEQUENCE {sequence_name} CACHE {cache:d}'.format(
+        sequence_name=GLOBAL_SEQUENCE_NAME,
+        cache=int(kwargs.get('OBSCURE_ID_SEQUENCE_CACHE') or 1),
+    ))
+
+
 # Register an event on the metadata that executes the drop_id_function_ddl on
 # the database after everything else is dropped. This way we avoid dependency
 # errors as the function will be used as a server default for certain columns.
@@ -91,7 +142,9 @@ class BcryptStr(str):
         if isinstance(value, unicode):
             value = value.encode('utf-8')
         if crypt:
+            start = time.time()
             value = bcrypt.hashpw(value, salt or bcrypt.gensalt(rounds))
+            bcrypt_duration.observe(time.time() - start)
         return str.__new__(cls, value)
 
     def __eq__(self, other):
@@ -38,6 +38,38 @@ $$ LANGUAGE plpgsql strict;
 
 drop_bayesian = 'DROP FUNCTION IF EXISTS bayesian(bigint)'
 
+# What rating_trigger and bayesian compute for the exercises with ids in
+# %(ids)s, in one statement for all of them. For bulk loads that insert ratings
+# with the triggers disabled.
+_utilities = [int(u) for u in UTILITIES.split(',')]
+_pretend_votes = [int(v) for v in PRETEND_VOTES.split(',')]
+recompute_exercise_ratings = '''
+UPDATE exercise
+SET popularity=({prior_utility} + stats.utility)::FLOAT / ({prior_votes} + stats.count),
+    avg_rating=stats.avg_rating,
+    avg_fun_rating=stats.avg_fun_rating,
+    avg_effective_rating=stats.avg_effective_rating,
+    avg_clear_rating=stats.avg_clear_rating,
+    count_ratings=stats.count
+FROM (SELECT exercise.id,
+             count(rating.rating) AS count,
+             coalesce(sum(CASE WHEN rating.rating < 1.5 THEN {0}
+                               WHEN rating.rating < 2.5 THEN {1}
+                               WHEN rating.rating < 3.5 THEN {2}
+                               WHEN rating.rating < 4.5 THEN {3}
+                               WHEN rating.rating <= 5 THEN {4} END), 0) AS utility,
+             avg(rating.rating) AS avg_rating,
+             avg(rating.fun) AS avg_fun_rating,
+             avg(rating.effective) AS avg_effective_rating,
+             avg(rating.clear) AS avg_clear_rating
+      FROM exercise LEFT JOIN rating ON rating.exercise_id = exercise.id
+      WHERE exercise.id = ANY(%(ids)s)
+      GROUP BY exercise.id) AS stats
+WHERE exercise.id = stats.id
+'''.format(*_utilities,
+           prior_utility=sum(u * v for u, v in zip(_utilities, _pretend_votes)),
+           prior_votes=sum(_pretend_votes))
+
 post_create_rating = '''
 CREATE OR REPLACE FUNCTION rating_trigger() RETURNS trigger as $$
 BEGIN
@@ -100,3 +132,75 @@ ON %(table)s FOR EACH ROW EXECUTE PROCEDURE default_popularity();
 pre_drop_exercise = '''
 DROP FUNCTION IF EXISTS default_popularity() CASCADE;
 '''
+
+# Migrations of existing databases, new databases get the current schema from
+# create_all. Every migration is idempotent, they are run in order by
+# `db migrate`.
+MIGRATIONS = []
+
+add_response_total = '''
+ALTER TABLE questionnaire_response
+    ADD COLUMN IF NOT EXISTS total INTEGER NOT NULL DEFAULT 0;
+
+DO $$
+BEGIN
+    -- the choice rows are converted to answers by a later migration
+    IF to_regclass('choice') IS NOT NULL THEN
+        UPDATE questionnaire_response SET total = choices.total
+        FROM (SELECT response_id, sum(value) AS total
+              FROM choice GROUP BY response_id) AS choices
+        WHERE choices.response_id = questionnaire_response.id AND
+              questionnaire_response.total IS DISTINCT FROM choices.total;
+    END IF;
+END $$;
+
+ALTER TABLE questionnaire_response ALTER COLUMN total DROP DEFAULT;
+
+CREATE INDEX IF NOT EXISTS ix_score_questionnaire_id ON score (questionnaire_id);
+'''
+MIGRATIONS.append(add_response_total)
+
+add_response_user_index = '''
+CREATE INDEX IF NOT EXISTS ix_questionnaire_response_user_id_questionnaire_id
+    ON questionnaire_response (user_id, questionnaire_id, created_at);
+'''
+MIGRATIONS.append(add_response_user_index)
+
+# Choice rows become an array of answers and an array of the ids of their
+# questions, ordered like the questions. Responses without choice rows keep
+# NULL answers. The choice rows are kept in choice_backup, drop it once the
+# answers have been checked.
+choices_to_answers = '''
+ALTER TABLE questionnaire_response ADD COLUMN IF NOT EXISTS answers INTEGER[];
+ALTER TABLE questionnaire_response
+    ADD COLUMN IF NOT EXISTS question_ids INTEGER[];
+
+DO $$
+BEGIN
+    IF to_regclass('choice') IS NOT NULL THEN
+        UPDATE questionnaire_response
+        SET answers = choices.answers, question_ids = choices.question_ids
+        FROM (SELECT choice.response_id,
+                     array_agg(choice.value
+                               ORDER BY question.ordinal, question.id)
+                         AS answers,
+                     array_agg(choice.question_id
+                               ORDER BY question.ordinal, question.id)
+                         AS question_ids
+              FROM choice JOIN question ON question.id = choice.question_id
+              GROUP BY choice.response_id) AS choices
+        WHERE choices.response_id = questionnaire_response.id;
+        ALTER TABLE choice RENAME TO choice_backup;
+    END IF;
+END $$;
+'''
+MIGRATIONS.append(choices_to_answers)
+
+add_response_idempotency_key = '''
+ALTER TABLE questionnaire_response
+    ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64);
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_questionnaire_response_user_id_idempotency_key
+    ON questionnaire_response (user_id, idempotency_key);
+'''
+MIGRATIONS.append(add_response_idempotency_key)
@@ -0,0 +1,113 @@
+'''Client side ids for bulk writers.
+
+Rows normally get their id from the `obscure_id(nextval('global_id_seq'))`
+server default, so a writer has to insert a parent before it knows the id its
+children refer to. Reserving sequence values with `reserve_ids` and obscuring
+them with `obscure_ids`, the same permutation as the SQL function, lets a bulk
+writer assign all ids up front and `COPY` parents and children in one pass.
+'''
+import numpy as np
+
+from app.lib import with_app_config
+from columns import GLOBAL_SEQUENCE_NAME
+
+RESERVE_IDS = '''
+SELECT nextval('{sequence_name}') FROM generate_series(1, %(amount)s)
+'''.format(sequence_name=GLOBAL_SEQUENCE_NAME)
+
+# Bytes COPY reads at a time.
+COPY_SIZE = 2 ** 16
+
+# Characters with a meaning in the text format of COPY.
+COPY_ESCAPES = [('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r')]
+
+
+@with_app_config('OBSCURE_ID_KEY', 'OBSCURE_ID_MODULUS')
+def obscure_ids(values, **kwargs):
+    '''Obscure an array of sequence values like the `obscure_id` function in
+    the database, see `create_id_function_ddl`.
+    '''
+    key = int(kwargs['OBSCURE_ID_KEY'])
+    modulus = int(kwargs['OBSCURE_ID_MODULUS'])
+
+    values = np.asarray(values, dtype=np.int64)
+    l = (values >> 16) & 65535
+    r = values & 65535
+    for i in xrange(3):
+        l, r = r, l ^ ((key * r + 150889) % modulus * 65534 + modulus) // \
+            (2 * modulus)
+    return (r << 16) + l
+
+
+def reserve_ids(connection, amount):
+    '''Take `amount` values of the global sequence and return them obscured.
+    The values are reserved for good, whether they are used or not.
+    '''
+    values = connection.execute(RESERVE_IDS, amount=amount).fetchall()
+    return obscure_ids(np.fromiter((value for value, in values),
+                                   dtype=np.int64, count=amount))
+
+
+def copy_value(value):
+    '''Format a value for the text format of COPY.'''
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (list, tuple)):
+        return '{%s}' % ','.join(str(item) for item in value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    value = str(value)
+    for character, escaped in COPY_ESCAPES:
+        value = value.replace(character, escaped)
+    return value
+
+
+def copy_line(row):
+    '''Format a row as a line of COPY text.'''
+    return '\t'.join(copy_value(value) for value in row) + '\n'
+
+
+class CopyStream(object):
+    '''A file like object over an iterable of COPY text, so the text can be
+    generated while it is copied.'''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = ''
+        self.offset = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.offset >= len(self.chunk):
+                try:
+                    self.chunk, self.offset = next(self.chunks), 0
+                except StopIteration:
+                    break
+            end = len(self.chunk) if size < 0 else self.offset + size
+            part = self.chunk[self.offset:end]
+            self.offset += len(part)
+            if size > 0:
+                size -= len(part)
+            parts.append(part)
+        return ''.join(parts)
+
+
+def copy_text(connection, table, columns, chunks):
+    '''COPY an iterable of `chunks`, text in the text format of COPY with
+    columns in the order of `columns`, into `table` using the DBAPI connection
+    of `connection`.'''
+    statement = 'COPY "%s" (%s) FROM STDIN' % (
+        table, ', '.join('"%s"' % column for column in columns))
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(statement, CopyStream(chunks), size=COPY_SIZE)
+    finally:
+        cursor.close()
+
+
+def copy_rows(connection, table, columns, rows):
+    '''COPY an iterable of `rows`, tuples of values in the order of
+    `columns`, into `table`.'''
+    copy_text(connection, table, columns, (copy_line(row) for row in rows))
@@ -0,0 +1,138 @@
+from collections import defaultdict
+
+from sqlalchemy import and_, func, inspect
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import aliased, attributes, class_mapper, object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.strategies import LazyLoader
+
+
+class StrictLoadingError(InvalidRequestError):
+    pass
+
+
+def guard_lazy_loader(cls, key, is_strict):
+    '''Wrap the lazy loader of relationship `key` of `cls` so that it raises a
+    StrictLoadingError instead of emitting SQL when `is_strict(session)` is
+    True. Loads that can be satisfied from the identity map still succeed.
+
+    This is what `raiseload` does in later versions of SQLAlchemy.
+    '''
+    impl = getattr(cls, key).impl
+    load = impl.callable_
+    if getattr(load, 'guarded', False):
+        return
+
+    def guarded_load(state, passive):
+        session = object_session(state.obj())
+        if not passive & attributes.SQL_OK or not session or \
+                not is_strict(session):
+            return load(state, passive)
+
+        value = load(state, passive ^ attributes.SQL_OK)
+        if value is attributes.PASSIVE_NO_RESULT:
+            raise StrictLoadingError(
+                '%s.%s is not loaded and strict loading is on, load it '
+                'eagerly.' % (cls.__name__, key))
+        return value
+
+    guarded_load.guarded = True
+    impl.callable_ = guarded_load
+
+
+def guard_lazy_loaders(classes, is_strict):
+    '''Guard the lazy loaders of all lazily loaded relationships of the mapped
+    `classes`, relationships configured to load eagerly are left alone.
+    '''
+    for cls in classes:
+        for prop in class_mapper(cls).relationships:
+            if isinstance(prop.strategy, LazyLoader):
+                guard_lazy_loader(prop.parent.class_, prop.key, is_strict)
+
+
+def batch_load(instances, key, limit=None, criterion=None):
+    '''Load relationship `key` of all `instances` with one `IN` query, like
+    `selectinload` in later versions of SQLAlchemy. Instances that already
+    have it loaded are skipped. Only relationships joining on a single column
+    pair are supported.
+
+    With a `limit` a collection only gets its first `limit` items in the order
+    of the relationship, still in a single query. Like a `criterion` that
+    filters the related objects, it makes for an incomplete collection that is
+    meant to be read and not modified.
+
+    Returns the related objects of all instances, so paths can be loaded
+    level by level.
+    '''
+    if not instances:
+        return []
+
+    prop = class_mapper(type(instances[0])).get_property(key)
+    (local, remote), = prop.local_remote_pairs
+    local_key = prop.parent.get_property_by_column(local).key
+    remote_key = prop.mapper.get_property_by_column(remote).key
+
+    unloaded = [obj for obj in instances if key in inspect(obj).unloaded]
+    values = set(getattr(obj, local_key) for obj in unloaded)
+    values.discard(None)
+
+    related = defaultdict(list)
+    if values:
+        session = object_session(instances[0])
+        remote_attr = getattr(prop.mapper.class_, remote_key)
+        criterion = remote_attr.in_(values) if criterion is None else \
+            and_(remote_attr.in_(values), criterion)
+        if limit and prop.uselist:
+            query = top_n_query(session, prop, remote_attr, criterion, limit)
+        else:
+            query = session.query(prop.mapper).filter(criterion)
+            if prop.order_by:
+                query = query.order_by(*prop.order_by)
+        for child in query:
+            related[getattr(child, remote_key)].append(child)
+
+    for obj in unloaded:
+        children = related.get(getattr(obj, local_key), [])
+        if prop.uselist:
+            set_committed_value(obj, key, list(children))
+        else:
+            set_committed_value(obj, key, children[0] if children else None)
+
+    rv = []
+    for obj in instances:
+        value = getattr(obj, key)
+        if prop.uselist:
+            rv.extend(value)
+        elif value is not None:
+            rv.append(value)
+    return rv
+
+
+def top_n_query(session, prop, remote_attr, criterion, limit):
+    '''Query the first `limit` children of relationship `prop` matching
+    `criterion` per parent. The children are numbered per parent with a window
+    function so it takes a single query for all parents, SQLAlchemy 1.0 can't
+    express a LATERAL join.
+    '''
+    cls = prop.mapper.class_
+    order_by = prop.order_by or list(prop.mapper.primary_key)
+    row_number = func.row_number().over(partition_by=remote_attr,
+                                        order_by=order_by)
+    subquery = session.query(cls, row_number.label('row_number')).\
+        filter(criterion).\
+        subquery()
+    return session.query(aliased(cls, subquery)).\
+        filter(subquery.c.row_number <= limit).\
+        order_by(subquery.c.row_number)
+
+
+def batch_load_path(instances, path, limit=None, criterion=None):
+    '''Batch load a dotted path of relationships, for example
+    `'user_favorite_exercises.exercise'`, one query per relationship. The
+    `limit` applies to the collections along the path, the `criterion` to the
+    first relationship.
+    '''
+    for key in path.split('.'):
+        instances = batch_load(instances, key, limit=limit, criterion=criterion)
+        criterion = None
+    return instances
@@ -1,9 +1,36 @@
-from flask import _app_ctx_stack
+import contextlib
+import os
+import random
+import threading
+import time
 
-from sqlalchemy import create_engine
+from flask import _app_ctx_stack, g, has_app_context, has_request_context, \
+    request
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DBAPIError, DisconnectionError
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.orm.exc import UnmappedClassError
-from sqlalchemy.orm import sessionmaker, scoped_session, class_mapper
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import (
+    class_mapper,
+    Mapper,
+    scoped_session,
+    Session,
+    sessionmaker,
+)
+
+from app.lib import HistogramMetric, STATEMENT_BUCKETS
+from loading import guard_lazy_loaders
+
+# Requests with these methods only read, their queries may be served by a
+# replica.
+SAFE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+def is_safe_request():
+    '''Return True when inside a request that is not supposed to write.'''
+    return has_request_context() and request.method in SAFE_METHODS
 
 
 class _QueryProperty(object):
@@ -32,16 +59,226 @@ class BaseModel(object):
     query = None
 
 
+pool_wait = HistogramMetric(
+    'db_pool_wait_seconds', 'Time checkouts waited for a connection.',
+    buckets=STATEMENT_BUCKETS)
+
+
+class TimedQueuePool(QueuePool):
+    '''A QueuePool that adds the time checkouts take, waiting for a free
+    connection or opening a new one, to the pool wait of the app context.
+    '''
+    def _do_get(self):
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            wait = time.time() - start
+            pool_wait.observe(wait)
+            if has_app_context():
+                g.db_pool_wait = g.get('db_pool_wait', 0.0) + wait
+
+
+def worker_threads():
+    '''The threads of a uwsgi worker, 1 outside of uwsgi.'''
+    try:
+        import uwsgi
+    except ImportError:
+        return 1
+    return int(uwsgi.opt.get('threads', 1))
+
+
+def remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    '''Refuse connections opened by another process, the parent of a forked
+    worker. They are dropped without closing them, closing would end the
+    session of the process that opened them.'''
+    pid = os.getpid()
+    if connection_record.info['pid'] != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise DisconnectionError('Connection of pid %s checked out in pid %s' %
+                                 (connection_record.info['pid'], pid))
+
+
+class Replica(object):
+    '''A read replica. It keeps track of its own health by checking the
+    replication lag every `check_interval` seconds. A replica that lags more
+    than `max_lag` seconds or that can't be reached is unhealthy.
+
+    One thread checks at a time, the other threads use the result of the
+    previous check meanwhile.
+    '''
+    # pg_last_xact_replay_timestamp is the commit time of the last replayed
+    # transaction, on an idle primary the lag grows even though the replica is
+    # up to date. That only makes us fall back to the primary, which is safe.
+    LAG_QUERY = '''
+    SELECT CASE WHEN pg_is_in_recovery() THEN
+        COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    ELSE 0 END
+    '''
+
+    def __init__(self, engine, max_lag=5, check_interval=10):
+        self.engine = engine
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lag = None
+        self.checked_at = None
+        self._healthy = False
+        self.lock = threading.Lock()
+
+    @property
+    def healthy(self):
+        now = time.time()
+        if (self.checked_at is None or
+                now - self.checked_at >= self.check_interval) and \
+                self.lock.acquire(False):
+            try:
+                self.checked_at = now
+                self._healthy = self.check()
+            finally:
+                self.lock.release()
+        return self._healthy
+
+    def check(self):
+        try:
+            self.lag = self.engine.scalar(self.LAG_QUERY)
+        except DBAPIError:
+            self.lag = None
+            return False
+        return self.lag <= self.max_lag
+
+    def __repr__(self):
+        return 'Replica(url=%r, lag=%r)' % (self.engine.url, self.lag)
+
+
+class RoutingSession(Session):
+    '''A session that sends the reads of safe requests to a healthy replica.
+
+    Everything else goes to the primary: writes, reads outside of a request and
+    reads of unsafe requests. Once a session has flushed it sticks to the
+    primary so that a request can read its own writes.
+
+    The replica is chosen once, all reads of the session see the same
+    snapshot and hold a connection of one pool. Between transactions the
+    session moves to another replica when its replica became unhealthy, it
+    forgets its replica when it is closed.
+    '''
+    def __init__(self, db=None, **kwargs):
+        self.db = db
+        self.use_primary = False
+        self.replica = None
+        self.replica_chosen = False
+        super(RoutingSession, self).__init__(**kwargs)
+
+    def get_bind(self, mapper=None, clause=None):
+        # Only route when bound to the primary. Any other bind, such as a
+        # connection joined to an external transaction, is used as is.
+        if (self.db and self.db.replicas and
+                self.bind is self.db.engine and
+                not self.use_primary and
+                not self._flushing and
+                is_safe_request()):
+            if not self.replica_chosen:
+                if self.replica is None or not self.replica.healthy:
+                    self.replica = self.db.choose_replica()
+                self.replica_chosen = True
+            if self.replica:
+                return self.replica.engine
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+    def close(self):
+        super(RoutingSession, self).close()
+        self.replica = None
+        self.replica_chosen = False
+        self.info.pop('released', None)
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def recheck_replica(session, transaction):
+    '''Check the health of the replica again before the next transaction.'''
+    if transaction._parent is None:
+        session.replica_chosen = False
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def stick_to_primary(session, flush_context, instances):
+    session.use_primary = True
+
+
+@event.listens_for(RoutingSession, 'after_begin')
+def unrelease(session, transaction, connection):
+    '''A query after `Database.release_read_only` starts a new transaction,
+    lazy loads may use it.'''
+    session.info.pop('released', None)
+
+
+@event.listens_for(RoutingSession, 'after_begin')
+def begin_read_only(session, transaction, connection):
+    '''Start the transactions of safe requests as READ ONLY, optionally
+    DEFERRABLE. A deferrable transaction never has to wait on or abort for
+    other serializable transactions, it only applies to the primary as hot
+    standbys don't support serializable transactions.
+    '''
+    # A connection the session was bound to directly manages its own
+    # transaction, it might have done work already. A session that flushed is
+    # writing, even when it shouldn't.
+    if connection is session.bind or session.use_primary or \
+            not is_safe_request():
+        return
+
+    if session.db and session.db.read_only_deferrable and \
+            connection.engine is session.db.engine:
+        connection.execute('SET TRANSACTION ISOLATION LEVEL SERIALIZABLE, '
+                           'READ ONLY, DEFERRABLE')
+    else:
+        connection.execute('SET TRANSACTION READ ONLY')
+
+
 class Database(object):
     '''A class that serves as the accesspoint for database operations using an
     SQLAlchemy scoped_session. It also sets up an obscure id function in the
     database.
+
+    Reads of safe requests are spread over the replicas configured in
+    `SQLALCHEMY_REPLICA_URIS`, see `RoutingSession`. They run in read only
+    transactions that can be ended as soon as the data is loaded with
+    `release_read_only`.
+
+    With `SQLALCHEMY_STRICT_LOADING` lazy loads that emit SQL raise a
+    StrictLoadingError during safe requests, see `strict_loading`.
+
+    The time a request waited for connections from the pools is `pool_wait`,
+    with `SQLALCHEMY_POOL_WAIT_HEADER` it is sent in the `X-DB-Pool-Wait`
+    response header in milliseconds.
+
+    Sessions are scoped to the thread, every thread of a worker serves its
+    requests in an app context of its own that removes the session when it
+    ends. The pools hold `SQLALCHEMY_POOL_SIZE` connections, by default one
+    per thread of a uwsgi worker and one for the background threads.
+
+    Connections are tied to the process that opened them. Call `dispose`
+    before forking, a worker that checks out a connection of its parent drops
+    it and opens its own.
     '''
+    POOL_WAIT_HEADER = 'X-DB-Pool-Wait'
+
     def __init__(self, app=None):
         self.engine = None
+        self.replicas = []
+        self.pool_size = 5
+        self.max_overflow = 10
+        self.pool_timeout = 30
+        self.read_only_deferrable = False
+        self.strict = False
         self.session = None
         self.Base = self.make_declarative_base()
 
+        event.listen(Mapper, 'after_configured', lambda: guard_lazy_loaders(
+            self.Base.__subclasses__(), self.is_strict))
+
         if app:
             self.init_app(app)
 
@@ -53,18 +290,111 @@ class Database(object):
     def init_app(self, app):
         self.database_uri = app.config['SQLALCHEMY_DATABASE_URI']
         self.echo = app.config.get('SQLALCHEMY_ECHO', False)
+        self.read_only_deferrable = app.config.get(
+            'SQLALCHEMY_READ_ONLY_DEFERRABLE', False)
+        self.strict = app.config.get('SQLALCHEMY_STRICT_LOADING', False)
+        # every thread holds a connection during a request, the explaining
+        # thread of the slow query log needs one more
+        self.pool_size = app.config.get('SQLALCHEMY_POOL_SIZE') or \
+            max(5, worker_threads() + 1)
+        self.max_overflow = app.config.get('SQLALCHEMY_MAX_OVERFLOW', 10)
+        self.pool_timeout = app.config.get('SQLALCHEMY_POOL_TIMEOUT', 30)
         self.engine = self.create_engine()
+        self.replicas = [
+            Replica(self.create_engine(uri),
+                    max_lag=app.config.get('SQLALCHEMY_REPLICA_MAX_LAG', 5),
+                    check_interval=app.config.get(
+                        'SQLALCHEMY_REPLICA_CHECK_INTERVAL', 10))
+            for uri in app.config.get('SQLALCHEMY_REPLICA_URIS', [])]
         self.session = self.create_scoped_session()
 
         app.teardown_appcontext(lambda exc: self.session.remove())
+        if app.config.get('SQLALCHEMY_POOL_WAIT_HEADER', False):
+            app.after_request(self.add_pool_wait_header)
+
+    @property
+    def pool_wait(self):
+        '''Seconds the current app context waited for connections.'''
+        return g.get('db_pool_wait', 0.0)
+
+    def add_pool_wait_header(self, response):
+        response.headers[self.POOL_WAIT_HEADER] = '%.2f' % (
+            self.pool_wait * 1000)
+        return response
+
+    @property
+    def engines(self):
+        '''The primary engine followed by the replica engines.'''
+        return [self.engine] + [replica.engine for replica in self.replicas]
+
+    def choose_replica(self):
+        '''Return a random healthy replica or None if there is none.'''
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if healthy:
+            return random.choice(healthy)
+
+    def is_strict(self, session):
+        '''Whether lazy loads of `session` should raise.'''
+        strict = session.info.get('strict_loading')
+        if strict is None:
+            strict = (self.strict or session.info.get('released')) and \
+                is_safe_request()
+        # flushes load what they need to cascade
+        return strict and not session._flushing
+
+    @contextlib.contextmanager
+    def strict_loading(self, strict=True):
+        '''Turn strict loading on, or off, for the current session regardless
+        of the configuration or request. Usefull in tests.
+        '''
+        info = self.session().info
+        previous = info.get('strict_loading')
+        info['strict_loading'] = strict
+        try:
+            yield
+        finally:
+            info['strict_loading'] = previous
+
+    def release_read_only(self):
+        '''End the read only transaction of a safe request and return its
+        connections to the pool. The loaded objects are not expired so they can
+        be serialized without touching the database. Lazy loads after this
+        raise a StrictLoadingError, they would start a new transaction that
+        holds a connection until the end of the request.
+        '''
+        session = self.session()
+        if not is_safe_request() or session.use_primary:
+            return
+
+        session.expire_on_commit = False
+        try:
+            session.commit()
+        finally:
+            session.expire_on_commit = True
+        session.info['released'] = True
+
+    def dispose(self):
+        '''Close the connections in the pools of all engines, so that none are
+        inherited by forked workers.'''
+        for engine in self.engines:
+            engine.dispose()
 
-    def create_engine(self):
-        return create_engine(self.database_uri,
-                             echo=self.echo,
-                             convert_unicode=True)
+    def create_engine(self, database_uri=None):
+        engine = create_engine(database_uri or self.database_uri,
+                               echo=self.echo,
+                               convert_unicode=True,
+                               poolclass=TimedQueuePool,
+                               pool_size=self.pool_size,
+                               max_overflow=self.max_overflow,
+                               pool_timeout=self.pool_timeout)
+        event.listen(engine, 'connect', remember_pid)
+        event.listen(engine, 'checkout', check_pid)
+        return engine
 
     def create_scoped_session(self):
-        return scoped_session(sessionmaker(bind=self.engine),
+        return scoped_session(sessionmaker(class_=RoutingSession,
+                                           db=self,
+                                           bind=self.engine),
                               scopefunc=_app_ctx_stack.__ident_func__)
 
 
@@ -1,9 +1,9 @@
 from datetime import datetime, timedelta
 
-import markdown
-import bleach
 from psycopg2.extras import NumericRange
 from sqlalchemy import (
+    and_,
+    cast,
     Float,
     CheckConstraint,
     Boolean,
@@ -12,18 +12,20 @@ from sqlalchemy import (
     DDL,
     event,
     ForeignKey,
-    ForeignKeyConstraint,
+    func,
     Index,
     Integer,
+    literal,
+    literal_column,
     String,
     Text,
-    UniqueConstraint,
 )
-from sqlalchemy.dialects.postgresql import INT4RANGE, JSONB, TSVECTOR
+from sqlalchemy.dialects.postgresql import ARRAY, INT4RANGE, JSONB, TSVECTOR
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.orderinglist import ordering_list
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, joinedload, object_session
 
+from definitions import definitions, pair_answers, QuestionnaireDefinition
 from meta.columns import IDColumn, PasswordColumn
 from meta.mixins import TokenMixin, CreatedUpdatedMixin, CRUDMixin
 from meta.orm import db
@@ -44,11 +46,14 @@ class User(Base, TokenMixin, CreatedUpdatedMixin, CRUDMixin):
     email = Column(String, unique=True)
     last_login = Column(DateTime)
 
+    # Newest first, like the collections they link to when expanded with a
+    # limit.
     authored_exercises = relationship(
         'Exercise',
         cascade='all, delete-orphan',
         passive_deletes=True,
         backref=backref('author'),
+        order_by='Exercise.created_at.desc()',
     )
 
     questionnaire_responses = relationship(
@@ -62,6 +67,7 @@ class User(Base, TokenMixin, CreatedUpdatedMixin, CRUDMixin):
         'UserFavoriteExercise',
         cascade='all, delete-orphan',
         passive_deletes=True,
+        order_by='UserFavoriteExercise.added.desc()',
     )
 
     # a proxy to the exercise values of the above relationship.
@@ -87,8 +93,8 @@ class User(Base, TokenMixin, CreatedUpdatedMixin, CRUDMixin):
     def fill_in_questionnaire(self, questionnaire, **kwargs):
         '''Create a questionnaire response.
         '''
-        response = QuestionnaireResponse(questionnaire_id=questionnaire.id,
-                                         **kwargs)
+        kwargs.update(questionnaire_id=questionnaire.id)
+        response = QuestionnaireResponse.create(object_session(self), kwargs)
         self.questionnaire_responses.append(response)
         return response
 
@@ -245,11 +251,21 @@ class Exercise(Base, CRUDMixin, CreatedUpdatedMixin):
                 ))
 
 
-@event.listens_for(Exercise.description, 'set', retval=True)
-def mdtohtml(target, value, oldvalue, initiator):
+def render_description(value):
+    '''Return the cleaned markdown of a description and its html.'''
+    # imported here, they take long to import and most commands never render
+    # a description
+    import bleach
+    import markdown
+
     clean_value = bleach.clean(value)
     html = markdown.markdown(clean_value)
-    target.description_html = bleach.linkify(html)
+    return clean_value, bleach.linkify(html)
+
+
+@event.listens_for(Exercise.description, 'set', retval=True)
+def mdtohtml(target, value, oldvalue, initiator):
+    clean_value, target.description_html = render_description(value)
     return clean_value
 
 
@@ -284,7 +300,9 @@ class Questionnaire(Base):
     id = IDColumn()
     title = Column(String, nullable=False)
     description = Column(String, nullable=False)
-    version = Column(Integer)
+    # Bump the version when changing the questions, options or scores, the
+    # definitions are cached per version.
+    version = Column(Integer, default=1)
 
     possible_scores = relationship(
         'Score',
@@ -299,13 +317,13 @@ class Questionnaire(Base):
         collection_class=ordering_list('ordinal'),
         cascade='all, delete-orphan',
         passive_deletes=True,
-        lazy='joined'
     )
     responses = relationship(
         'QuestionnaireResponse',
         backref=backref('questionnaire'),
         cascade='all, delete-orphan',
         passive_deletes=True,
+        order_by='QuestionnaireResponse.created_at.desc()',
     )
 
     @classmethod
@@ -320,6 +338,22 @@ class Questionnaire(Base):
         data.update(possible_scores=scores)
         return cls(**data)
 
+    @property
+    def definition(self):
+        '''The immutable definition of this version, see DefinitionCache.'''
+        return definitions.get(self)
+
+    def build_definition(self):
+        session = object_session(self)
+        questions = session.query(Question).\
+            options(joinedload(Question.options)).\
+            filter(Question.questionnaire_id == self.id).\
+            order_by(Question.ordinal)
+        scores = session.query(Score).\
+            filter(Score.questionnaire_id == self.id).\
+            order_by(Score.range)
+        return QuestionnaireDefinition.build(self, questions, scores)
+
     def __repr__(self):
         return ('Questionnaire(id=%r, title=%r, description=%r, version=%r)' % (
             self.id,
@@ -338,6 +372,9 @@ class Score(Base):
         ForeignKey('questionnaire.id', ondelete='CASCADE'),
         nullable=False,
         primary_key=True,
+        # the primary key index leads with the name, responses look their
+        # score up by questionnaire.
+        index=True,
     )
 
     def __repr__(self):
@@ -359,7 +396,6 @@ class Question(Base):
         order_by='Option.value',
         cascade='all, delete-orphan',
         passive_deletes=True,
-        lazy='joined'
     )
     questionnaire_id = Column(
         ID_TYPE,
@@ -401,61 +437,36 @@ class Option(Base):
         )
 
 
-class Choice(Base):
-    value = Column(ID_TYPE, primary_key=True, autoincrement=False)
-    question_id = Column(ID_TYPE, primary_key=True, autoincrement=False)
-    response_id = Column(
-        ID_TYPE,
-        ForeignKey('questionnaire_response.id', ondelete='CASCADE'),
-        primary_key=True
-    )
-
-    __table_args__ = (
-        ForeignKeyConstraint(
-            ['value', 'question_id'],
-            ['option.value', 'option.question_id'],
-            ondelete='CASCADE'
-        ),
-        UniqueConstraint('question_id', 'response_id')
-    )
-
-    def __repr__(self):
-        return 'Choice(value=%r, question_id=%r, response_id=%r)' % (
-            self.value,
-            self.question_id,
-            self.response_id,
-        )
-
-
 class QuestionnaireResponse(Base, CreatedUpdatedMixin):
     __tablename__ = 'questionnaire_response'
 
     id = IDColumn()
 
+    # The values of the answers and the ids of their questions, in the order
+    # of the questions when the response was given, see `choices`. Responses
+    # of which the answers were lost have neither.
+    answers = Column(ARRAY(Integer))
+    question_ids = Column(ARRAY(ID_TYPE))
+    # The sum of the answers, set on insert.
+    total = Column(Integer, nullable=False)
+
     # This relationship joins to Score where the questionnaire ids match
-    # and where the sum of the choices values of this response are
-    # contained in the score range. Generates the following SQL clause.
+    # and where the total of this response is contained in the score range.
+    # It is joined eagerly, generating the following join clause.
     #
-    # FROM score
-    # WHERE score.questionnaire_id = %(param_1)s AND
-    # (score.range @> CAST((SELECT sum(choice.value) AS sum_1
-    #  FROM choice
-    #  WHERE choice.response_id = %(param_2)s) AS INTEGER))
+    # LEFT OUTER JOIN score AS score_1 ON
+    # score_1.questionnaire_id = questionnaire_response.questionnaire_id AND
+    # score_1.range @> questionnaire_response.total
     score = relationship(
         'Score',
         uselist=False,
+        viewonly=True,
+        lazy='joined',
         primaryjoin=('''
 and_(foreign(Score.questionnaire_id)==QuestionnaireResponse.questionnaire_id,
-Score.range.contains(cast(select([func.sum(Choice.value)]).
-where(Choice.response_id == QuestionnaireResponse.id).as_scalar(), Integer)))
+Score.range.contains(QuestionnaireResponse.total))
 '''))
 
-    choices = relationship(
-        'Choice',
-        cascade='all, delete-orphan',
-        passive_deletes=True,
-    )
-
     user_id = Column(
         ID_TYPE,
         ForeignKey('user.id', ondelete='CASCADE'),
@@ -468,10 +479,125 @@ where(Choice.response_id == QuestionnaireResponse.id).as_scalar(), Integer)))
         nullable=False
     )
 
+    # A key chosen by the client, responses submitted again with the same key
+    # are skipped. See `bulk_create`.
+    idempotency_key = Column(String(64))
+
+    __table_args__ = (
+        # the responses of a user to a questionnaire, newest last.
+        Index('ix_questionnaire_response_user_id_questionnaire_id',
+              'user_id', 'questionnaire_id', 'created_at'),
+        Index('ix_questionnaire_response_user_id_idempotency_key',
+              'user_id', 'idempotency_key', unique=True),
+    )
+
+    # Responses can be grouped per period of time for progress, see
+    # `progress`.
+    PROGRESS_BUCKETS = 'week', 'month'
+
+    @classmethod
+    def progress(cls, session, user_id, questionnaire_id, bucket=None,
+                 window=3):
+        '''Query the progress of a user on a questionnaire, the totals of
+        the responses in order with their score, the delta with the previous
+        total and the moving average over the last `window` totals. With a
+        `bucket` the responses are grouped per week or month and the average
+        total of every period is used.
+
+        Both the grouping and the window functions run in a single query.
+        '''
+        if bucket:
+            period = func.date_trunc(bucket, cls.created_at)
+            responses = session.query(period.label('period'),
+                                      func.avg(cls.total).label('total'),
+                                      func.count().label('responses')).\
+                group_by(period)
+        else:
+            responses = session.query(cls.created_at.label('period'),
+                                      cls.total.label('total'),
+                                      literal(1).label('responses'))
+        responses = responses.\
+            filter(cls.user_id == user_id).\
+            filter(cls.questionnaire_id == questionnaire_id).\
+            subquery('responses')
+
+        total = responses.c.total
+        previous = func.lag(total).over(order_by=responses.c.period)
+        # SQLAlchemy 1.0 can't express the frame of a window
+        moving_average = literal_column(
+            'avg(responses.total) OVER (ORDER BY responses.period '
+            'ROWS BETWEEN %d PRECEDING AND CURRENT ROW)' % (int(window) - 1))
+
+        return session.query(responses.c.period,
+                             total,
+                             responses.c.responses,
+                             (total - previous).label('delta'),
+                             moving_average.label('moving_average'),
+                             Score.name.label('score')).\
+            outerjoin(Score, and_(
+                Score.questionnaire_id == questionnaire_id,
+                Score.range.contains(cast(func.round(total), Integer)))).\
+            order_by(responses.c.period)
+
+    @classmethod
+    def bulk_create(cls, session, user_id, responses):
+        '''Insert the `responses` of a user in a single multi-row INSERT. Every
+        response has an idempotency key, responses whose key the user has
+        submitted before are skipped. A response without a `created_at` is
+        created now.
+
+        The questionnaires of the responses are best loaded up front, they are
+        looked up in the identity map. Returns a dict of the idempotency keys of
+        the inserted responses to their ids and one of the skipped ones.
+        '''
+        keys = [response['idempotency_key'] for response in responses]
+        existing = dict(session.query(cls.idempotency_key, cls.id).
+                        filter(cls.user_id == user_id).
+                        filter(cls.idempotency_key.in_(keys)))
+
+        now = datetime.utcnow()
+        rows = []
+        for response in responses:
+            if response['idempotency_key'] in existing:
+                continue
+            questionnaire = session.query(Questionnaire).\
+                get(response['questionnaire_id'])
+            definition = questionnaire.definition
+            answers = definition.answers(response['choices'])
+            created_at = response.get('created_at') or now
+            if created_at.utcoffset() is not None:
+                created_at = created_at.replace(tzinfo=None) - \
+                    created_at.utcoffset()
+            rows.append(dict(user_id=user_id,
+                             questionnaire_id=questionnaire.id,
+                             idempotency_key=response['idempotency_key'],
+                             answers=answers,
+                             question_ids=definition.question_order,
+                             total=sum(answers),
+                             created_at=created_at,
+                             updated_at=now))
+
+        created = {}
+        if rows:
+            insert = cls.__table__.insert().\
+                values(rows).\
+                returning(cls.idempotency_key, cls.id)
+            created = dict(session.execute(insert).fetchall())
+        return created, existing
+
+    @property
+    def choices(self):
+        '''The answers with the ids of their questions, None when the answers
+        were lost.'''
+        if self.answers is not None:
+            return pair_answers(self.question_ids, self.answers)
+
     @classmethod
     def create(cls, session, data):
-        choices = [Choice(**choice) for choice in data.pop('choices')]
-        data.update(choices=choices)
+        questionnaire = session.query(Questionnaire).get(data['questionnaire_id'])
+        definition = questionnaire.definition
+        data.update(answers=definition.answers(data.pop('choices')),
+                    question_ids=definition.question_order)
         return cls(**data)
 
     def __repr__(self):
@@ -483,6 +609,12 @@ where(Choice.response_id == QuestionnaireResponse.id).as_scalar(), Integer)))
                     self.updated_at,
                 ))
 
+
+@event.listens_for(QuestionnaireResponse, 'before_insert')
+def set_total(mapper, connection, target):
+    target.total = sum(target.answers)
+
+
 event.listen(Base.metadata, 'after_create', DDL(ddl.bayesian))
 event.listen(Base.metadata, 'after_drop', DDL(ddl.drop_bayesian))
 event.listen(Rating.__table__, 'after_create', DDL(ddl.post_create_rating))
@@ -493,7 +625,6 @@ event.listen(Exercise.__table__, 'before_drop', DDL(ddl.pre_drop_exercise))
 __all__ = [
     'Base',
     'Category',
-    'Choice',
     'db',
     'Exercise',
     'MaxEditTimeExpiredError',
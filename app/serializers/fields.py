@@ -1,10 +1,11 @@
-import bleach
 from marshmallow import fields, ValidationError
 from app import hashid
 
 
 class SafeStr(fields.Str):
     def _deserialize(self, value, attr, data):
+        import bleach
+
         return bleach.clean(value)
 
 
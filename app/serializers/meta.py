@@ -1,4 +1,35 @@
-from marshmallow import Schema as _Schema, SchemaOpts as _SchemaOpts, post_dump
+import re
+
+from marshmallow import (
+    Schema as _Schema,
+    SchemaOpts as _SchemaOpts,
+    post_dump,
+    ValidationError,
+)
+
+# An expand value with options such as `favorite_exercises[limit=5]`.
+EXPAND_OPTIONS = re.compile(r'^(?P<attribute>\w+)\[(?P<options>[^\]]*)\]$')
+# The largest limit of an expanded collection, the same as of a page.
+MAX_EXPAND_LIMIT = 100
+
+
+def parse_expand(expand):
+    '''Split expand values into the attributes and their options. Options are
+    separated by semicolons.
+
+    >>> parse_expand(['author', 'favorite_exercises[limit=5]'])
+    (['author', 'favorite_exercises'], {'favorite_exercises': {'limit': '5'}})
+    '''
+    attributes, options = [], {}
+    for value in expand:
+        match = EXPAND_OPTIONS.match(value)
+        if match:
+            value = match.group('attribute')
+            options[value] = dict(option.split('=', 1) for option
+                                  in match.group('options').split(';')
+                                  if '=' in option)
+        attributes.append(value)
+    return attributes, options
 
 
 class SchemaOpts(_SchemaOpts):
@@ -8,6 +39,8 @@ class SchemaOpts(_SchemaOpts):
         self.strict = True
         self.related = getattr(meta, 'related', None)
         self.meta = getattr(meta, 'meta', None)
+        # maps expandable attributes to the relationship path to load them.
+        self.expand_paths = getattr(meta, 'expand_paths', {})
 
 
 class Schema(_Schema):
@@ -15,9 +48,23 @@ class Schema(_Schema):
 
     def __init__(self, page=None, expand=None, *args, **kwargs):
         super(Schema, self).__init__(*args, **kwargs)
-        self.expand = expand or []
+        self.expand, self.expand_options = parse_expand(expand or [])
         self.page = page
 
+    def expand_limit(self, attribute):
+        '''The limit given for an expanded collection, or None.'''
+        limit = self.expand_options.get(attribute, {}).get('limit')
+        if limit is None:
+            return None
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= MAX_EXPAND_LIMIT:
+            raise ValidationError('The limit of %s must be from 1 to %s.' %
+                                  (attribute, MAX_EXPAND_LIMIT))
+        return limit
+
     @post_dump
     def format(self, data):
         if self.opts.wrap:
@@ -7,31 +7,47 @@ from marshmallow import (
     validates,
     ValidationError,
 )
+from werkzeug.local import LocalProxy
 
 from app import models
-from app.lib import parse_query_params, make_url
+from app.lib import HistogramMetric, parse_query_params, make_url, span
+from app.models.meta.loading import batch_load_path
 from fields import HashIDField
 from meta import Schema
 from validators import validate_unique
 
 
-def expandable(obj, attribute, expand, nested, route, route_kwargs, **kwargs):
+serialization_duration = HistogramMetric(
+    'serialization_duration_seconds', 'Time spent serializing responses.',
+    ['schema'])
+
+
+def expandable(obj, attribute, expand, nested, route, route_kwargs, limit=None,
+               **kwargs):
     '''Generate an external url if attribute is not in expand, otherwise
-    serialize the expandable attribute.'''
+    serialize the expandable attribute. A collection expanded with a limit is
+    incomplete, it is serialized with the url of the complete collection as
+    `{"items": [...], "href": url}`.'''
 
+    url = make_url(route, **{arg: getattr(obj, attribute) for arg, attribute
+                             in route_kwargs.iteritems()})
     if attribute not in expand:
-        url = make_url(route, **{arg: getattr(obj, attribute) for arg, attribute
-                                 in route_kwargs.iteritems()})
         return url
 
     field = fields.Nested(nested, **kwargs)
+    if limit:
+        return dict(items=field.serialize(attribute, obj), href=url)
     return field.serialize(attribute, obj)
 
 
 class Serializer(object):
-    def __init__(self, schema, query_params=None, context=None):
+    '''`expand_criteria` maps expandable attributes to a criterion that the
+    first relationship of their path is filtered by when it is loaded.'''
+    def __init__(self, schema, query_params=None, context=None,
+                 expand_criteria=None):
         self.schema = schema
         self.query_params = query_params
+        self.expand_criteria = expand_criteria or {}
         self._context = context or {}
 
     @property
@@ -46,20 +62,45 @@ class Serializer(object):
         if self.query_params:
             return parse_query_params(self.query_params, key='expand')
 
+    def preload(self, schema, objs):
+        '''Load the expanded relations of all objs, one query per relationship
+        instead of one per object. Limited collections get their first items
+        per object, in one query as well.
+        '''
+        for attribute in schema.expand:
+            path = schema.opts.expand_paths.get(attribute)
+            if path:
+                batch_load_path(objs, path,
+                                limit=schema.expand_limit(attribute),
+                                criterion=self.expand_criteria.get(attribute))
+
     def dump_page(self, page, **kwargs):
         schema = self.schema(page=page,
                              context=self.context,
                              expand=self.get_expand(),
                              **kwargs)
-        dumped_page = PaginationSchema().dump(page).data
-        dumped_items = schema.dump(page.items, many=True).data
+        self.preload(schema, page.items)
+        # Everything is loaded, hand the connection back before the CPU bound
+        # work of serializing.
+        models.db.release_read_only()
+        with serialization_duration.time(schema=self.schema.__name__), \
+                span('serialize'):
+            dumped_page = PaginationSchema().dump(page).data
+            dumped_items = schema.dump(page.items, many=True).data
         return dict(dumped_page, items=dumped_items)
 
     def dump(self, obj, **kwargs):
+        if isinstance(obj, LocalProxy):
+            # like auth.current_user, preloading needs the object itself
+            obj = obj._get_current_object()
         schema = self.schema(context=self.context,
                              expand=self.get_expand(),
                              **kwargs)
-        return schema.dump(obj).data
+        self.preload(schema, [obj])
+        models.db.release_read_only()
+        with serialization_duration.time(schema=self.schema.__name__), \
+                span('serialize'):
+            return schema.dump(obj).data
 
     def load(self, json, **kwargs):
         schema = self.schema(context=self.context, **kwargs)
@@ -127,6 +168,7 @@ class ExerciseSchema(Schema):
         additional = 'created_at', 'updated_at'
         dump_only = 'created_at', 'updated_at'
         related = 'author', 'rating',
+        expand_paths = dict(author='author')
         meta = 'id', 'user_rating', 'href', 'favorited', \
             'edit_allowed', 'created_at', 'updated_at', 'popularity', \
             'description_html', 'average_rating',
@@ -144,6 +186,7 @@ class UserSchema(Schema):
         return expandable(obj,
                           attribute='favorite_exercises',
                           expand=self.expand,
+                          limit=self.expand_limit('favorite_exercises'),
                           nested=ExerciseSchema,
                           route='v1.get_exercises',
                           route_kwargs={'favorited_by': 'id'},
@@ -155,6 +198,7 @@ class UserSchema(Schema):
         return expandable(obj,
                           attribute='authored_exercises',
                           expand=self.expand,
+                          limit=self.expand_limit('authored_exercises'),
                           nested=ExerciseSchema,
                           route='v1.get_exercises',
                           route_kwargs={'author': 'username'},
@@ -164,6 +208,10 @@ class UserSchema(Schema):
         wrap = True
         meta = 'id', 'href',
         related = 'authored_exercises', 'favorite_exercises',
+        expand_paths = dict(
+            authored_exercises='authored_exercises',
+            favorite_exercises='user_favorite_exercises.exercise',
+        )
 
 
 class ProfileSchema(UserSchema):
@@ -182,6 +230,7 @@ class ProfileSchema(UserSchema):
         dump_only = 'created_at', 'updated_at', 'last_login',
         meta = 'id', 'href', 'created_at', 'updated_at', 'last_login',
         related = 'authored_exercises', 'favorite_exercises',
+        expand_paths = UserSchema.Meta.expand_paths
 
 
 class ActionSchema(Schema):
@@ -241,23 +290,21 @@ class QuestionnaireSchema(Schema):
     id = HashIDField(dump_only=True)
     title = fields.Str(required=True)
     description = fields.Str(required=True)
-    questions = fields.Nested(QuestionSchema, many=True)
-    possible_scores = fields.Nested(ScoreSchema, many=True)
+    questions = fields.Nested(QuestionSchema, many=True, dump_only=True,
+                              attribute='definition.questions')
+    possible_scores = fields.Nested(ScoreSchema, many=True, dump_only=True,
+                                    attribute='definition.scores')
     href = fields.Function(lambda obj: make_url('v1.get_questionnaire', id=obj.id),
                            dump_only=True)
     responses = fields.Method('get_responses', dump_only=True)
-    max_score = fields.Method('get_max_score', dump_only=True)
-
-    def get_max_score(self, obj):
-        sum = 0
-        for question in obj.questions:
-            sum += max(o.value for o in question.options)
-        return sum
+    max_score = fields.Integer(attribute='definition.max_score',
+                               dump_only=True)
 
     def get_responses(self, obj):
         return expandable(obj,
                           attribute='responses',
                           expand=self.expand,
+                          limit=self.expand_limit('responses'),
                           nested=QuestionnaireResponseSchema,
                           route='v1.get_responses',
                           route_kwargs={'id': 'id'},
@@ -269,6 +316,7 @@ class QuestionnaireSchema(Schema):
         wrap = True
         meta = 'id', 'href', 'max_score'
         related = 'responses',
+        expand_paths = dict(responses='responses')
 
 
 class ChoiceSchema(Schema):
@@ -279,8 +327,7 @@ class ChoiceSchema(Schema):
 class QuestionnaireResponseSchema(Schema):
     choices = fields.Nested(ChoiceSchema, many=True, required=True)
     questionnaire = fields.Method('get_questionnaire', dump_only=True)
-    total = fields.Function(lambda obj: sum(c.value for c in obj.choices),
-                            dump_only=True)
+    total = fields.Integer(dump_only=True)
 
     def get_questionnaire(self, obj):
         return expandable(obj,
@@ -298,17 +345,76 @@ class QuestionnaireResponseSchema(Schema):
         dump_only = 'questionnaire', 'score'
         meta = 'score', 'total', 'created_at', 'updated_at'
         related = 'questionnaire',
+        expand_paths = dict(questionnaire='questionnaire')
 
     @validates('choices')
-    def validate_category(self, value):
-        questionnaire = self.context.get('questionnaire')
-        original_question_ids = [question.id
-                                 for question in questionnaire.questions]
-        given_question_ids = [choice['question_id'] for choice in value]
-        if set(original_question_ids) ^ set(given_question_ids):
-            raise ValidationError('Response is missing questions.')
-
-        # TODO valid values for choices
+    def validate_choices(self, value):
+        definition = self.context.get('questionnaire').definition
+        try:
+            definition.answers(value)
+        except ValueError as exc:
+            raise ValidationError(str(exc))
+
+
+class BulkResponseSchema(Schema):
+    questionnaire_id = HashIDField(required=True)
+    choices = fields.Nested(ChoiceSchema, many=True, required=True)
+    created_at = fields.DateTime()
+    idempotency_key = fields.Str(required=True,
+                                 validate=validate.Length(min=1, max=64))
+
+
+class BulkResponsesSchema(Schema):
+    '''Responses filled in offline, validated against the definitions of
+    their questionnaires.'''
+    responses = fields.Nested(BulkResponseSchema, many=True, required=True,
+                              validate=validate.Length(min=1, max=100))
+
+    @validates('responses')
+    def validate_responses(self, value):
+        ids = set(response['questionnaire_id'] for response in value)
+        questionnaires = {questionnaire.id: questionnaire for questionnaire in
+                          models.Questionnaire.query.
+                          filter(models.Questionnaire.id.in_(ids))}
+
+        errors, keys = {}, set()
+        for i, response in enumerate(value):
+            questionnaire = questionnaires.get(response['questionnaire_id'])
+            if response['idempotency_key'] in keys:
+                errors[i] = 'Duplicate idempotency key.'
+            elif not questionnaire:
+                errors[i] = 'Questionnaire does not exist.'
+            else:
+                try:
+                    questionnaire.definition.answers(response['choices'])
+                except ValueError as exc:
+                    errors[i] = str(exc)
+            keys.add(response['idempotency_key'])
+        if errors:
+            raise ValidationError(errors)
+
+
+class BulkResultSchema(Schema):
+    id = HashIDField()
+    idempotency_key = fields.Str()
+    created = fields.Bool()
+
+
+class ProgressSchema(Schema):
+    period = fields.DateTime()
+    total = fields.Float()
+    responses = fields.Integer()
+    delta = fields.Float()
+    moving_average = fields.Float()
+    score = fields.Str()
+
+
+class ProgressQuerySchema(Schema):
+    bucket = fields.Str(validate=validate.OneOf(
+        models.QuestionnaireResponse.PROGRESS_BUCKETS,
+        error='Must be one of {choices}'))
+    window = fields.Integer(validate=validate.Range(
+        min=1, max=52, error='Must be from {min} to {max}'))
 
 
 class PaginationSchema(Schema):
@@ -0,0 +1,61 @@
+'''Build what workers would otherwise build on their first requests.
+
+uwsgi creates the app in the master process and forks the workers from it,
+what `warmup` builds before the fork is shared by all workers, copy-on-write.
+The connections it opens are closed before it returns, a connection must not
+be shared by processes.
+'''
+import time
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import configure_mappers
+
+from app import db, hashid, models, serializers
+from app.models.models import render_description
+
+
+def subclasses(cls):
+    for subclass in cls.__subclasses__():
+        yield subclass
+        for subclass in subclasses(subclass):
+            yield subclass
+
+
+def compile_statements():
+    '''Compile a query of every model for the dialect of every engine, which
+    sets up the memoized attributes of the mappers, the columns and their
+    types.'''
+    session = db.session()
+    for model in subclasses(models.Base):
+        statement = session.query(model).with_labels().statement
+        for engine in db.engines:
+            statement.compile(dialect=engine.dialect)
+
+
+def load_reference_data():
+    '''Connect, which initializes the dialect, and cache the definitions of
+    all questionnaires.'''
+    for questionnaire in models.Questionnaire.query:
+        questionnaire.definition
+    models.Category.query.all()
+
+
+def warmup(app):
+    start = time.time()
+    with app.app_context():
+        configure_mappers()
+        compile_statements()
+        for schema in subclasses(serializers.Schema):
+            schema()
+        hashid.encode(1)
+        # imports markdown and bleach
+        render_description(u'')
+
+        try:
+            load_reference_data()
+        except DBAPIError:
+            app.logger.exception('Could not load the reference data.')
+        finally:
+            db.session.remove()
+            db.dispose()
+    app.logger.info('Warmed up in %.0f ms', (time.time() - start) * 1000)
@@ -18,9 +18,65 @@ class Config(object):
     # one month
     TOKEN_EXPIRATION = 3600 * 24 * 30
 
+    # The reads of GET requests are spread over these replicas. Replicas that
+    # lag more than SQLALCHEMY_REPLICA_MAX_LAG seconds are skipped, the lag is
+    # checked every SQLALCHEMY_REPLICA_CHECK_INTERVAL seconds.
+    SQLALCHEMY_REPLICA_URIS = []
+    SQLALCHEMY_REPLICA_MAX_LAG = 5
+    SQLALCHEMY_REPLICA_CHECK_INTERVAL = 10
+    # GET requests run in READ ONLY transactions, optionally DEFERRABLE.
+    SQLALCHEMY_READ_ONLY_DEFERRABLE = False
+    # Lazy loads that emit SQL during GET requests raise. Meant for staging,
+    # to catch N+1 queries.
+    SQLALCHEMY_STRICT_LOADING = False
+    # Send the time a request waited for database connections in the
+    # X-DB-Pool-Wait header, for load tests.
+    SQLALCHEMY_POOL_WAIT_HEADER = False
+    # Connections kept per engine and process. None is one per thread of a
+    # uwsgi worker plus one, at least 5. Up to SQLALCHEMY_MAX_OVERFLOW more
+    # are opened when they are all in use, after that checkouts wait up to
+    # SQLALCHEMY_POOL_TIMEOUT seconds.
+    SQLALCHEMY_POOL_SIZE = None
+    SQLALCHEMY_MAX_OVERFLOW = 10
+    SQLALCHEMY_POOL_TIMEOUT = 30
+
+    # Fraction of requests of which the SQL is profiled, see SQLProfiler.
+    SQL_PROFILER_SAMPLE_RATE = 0
+    SQL_PROFILER_HEADER = False
+    SQL_PROFILER_N_PLUS_ONE_THRESHOLD = 3
+    # Send the time of the phases of requests in the Server-Timing header and
+    # log it for a fraction of the requests, see RequestTimer.
+    SERVER_TIMING_HEADER = False
+    REQUEST_TIMING_LOG_RATE = 0
+    # Statements slower than SLOW_QUERY_THRESHOLD seconds are explained, see
+    # SlowQueryLog. None turns it off.
+    SLOW_QUERY_THRESHOLD = None
+    SLOW_QUERY_EXPLAINS_PER_MINUTE = 6
+    SLOW_QUERY_FINGERPRINT_INTERVAL = 300
+    SLOW_QUERY_TIMEOUT = 10
+    SLOW_QUERY_BUFFER = 100
+    SLOW_QUERY_DIR = os.path.join(basedir, 'slow_queries')
+    # Fraction of requests of which the stacks are sampled, requests with a
+    # token of `app profile token` in the X-Profile header always are. See
+    # SamplingProfiler.
+    SAMPLING_PROFILER_RATE = 0
+    SAMPLING_PROFILER_INTERVAL = 0.005
+    SAMPLING_PROFILER_DIR = os.path.join(basedir, 'profiles')
+    SAMPLING_PROFILER_FLUSH_INTERVAL = 10
+    # Every process writes its metrics here and /metrics adds them up, without
+    # it only the process serving /metrics is reported.
+    METRICS_DIR = None
+    # Records are written by a background thread, records that don't fit in
+    # the queue are dropped. Records below WARNING of the loggers in
+    # LOG_SAMPLE_RATES are kept at that rate, e.g. {'sqlalchemy.engine': 0.1}.
+    LOG_QUEUE_SIZE = 10000
+    LOG_SAMPLE_RATES = {}
+
     OBSCURE_ID_MODULUS = 2 ** 20 - -1
     # has to be coprime to OBSCURE_ID_MODULUS
     OBSCURE_ID_KEY = 542174
+    # values of the id sequence every connection reserves at once.
+    OBSCURE_ID_SEQUENCE_CACHE = 1
 
     # find a coprime by running this function
     def find_coprime(self, modulus=None):
@@ -32,17 +88,19 @@ class Config(object):
                 break
         return other
 
-    @staticmethod
-    def add_loghandler(logger, loglevel, logfile):
+    @classmethod
+    def add_loghandler(cls, logger, loglevel, logfile):
+        # imported here, the app imports the config
+        from app.lib import logs
+
         logger.setLevel(getattr(logging, loglevel, 'DEBUG'))
         log_handler = handlers.RotatingFileHandler(logfile,
                                                    maxBytes=5 * 1024 * 1024,
                                                    backupCount=2)
-        log_handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s '
-            '[in %(pathname)s:%(lineno)d]'
-        ))
-        logger.addHandler(log_handler)
+        log_handler.setFormatter(logs.JSONFormatter())
+        logs.log_queue.size = cls.LOG_QUEUE_SIZE
+        logger.addHandler(logs.QueueHandler(log_handler, logs.log_queue,
+                                            cls.LOG_SAMPLE_RATES))
 
     @classmethod
     def init_loggers(cls, app=None):
@@ -50,6 +108,15 @@ class Config(object):
         cls.add_loghandler(sqla_logger,
                            cls.LOGGING_LEVEL,
                            os.path.join(cls.BASEDIR, 'sqla.log'))
+        # Sampled request profiles are always logged, sampling keeps the
+        # volume down. They are children of the logger of the app, they
+        # don't propagate to app.log.
+        for name, logfile in [('app.sql', 'sql_profile.log'),
+                              ('app.timing', 'timing.log')]:
+            logger = logging.getLogger(name)
+            logger.propagate = False
+            cls.add_loghandler(logger, 'INFO',
+                               os.path.join(cls.BASEDIR, logfile))
         if app:
             cls.add_loghandler(app.logger,
                                cls.LOGGING_LEVEL,
@@ -62,25 +129,51 @@ class DevelopmentConfig(Config):
     HASHID_SALT = 'SaAaAalTy'
     BCRYPT_ROUNDS = 4
     SQLALCHEMY_DATABASE_URI = os.environ.get('DEV_DATABASE_URI')
+    SQL_PROFILER_SAMPLE_RATE = 1
+    SQL_PROFILER_HEADER = True
+    SQLALCHEMY_POOL_WAIT_HEADER = True
+    SLOW_QUERY_THRESHOLD = 0.1
+    SERVER_TIMING_HEADER = True
+    REQUEST_TIMING_LOG_RATE = 1
 
 
 class TestingConfig(DevelopmentConfig):
     TESTING = True
+    SLOW_QUERY_THRESHOLD = None
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URI')
 
 
 class ProductionConfig(Config):
     LOGGING_LEVEL = 'WARNING'
+    SQL_PROFILER_SAMPLE_RATE = 0.01
+    SLOW_QUERY_THRESHOLD = 0.5
+    REQUEST_TIMING_LOG_RATE = 0.05
     SECRET_KEY = os.environ.get('SECRET_KEY')
     OBSCURE_ID_KEY = os.environ.get('OBSCURE_ID_KEY')
+    OBSCURE_ID_SEQUENCE_CACHE = 20
     HASHID_SALT = os.environ.get('HASHID_SALT')
     SQLALCHEMY_DATABASE_URI = os.environ.get('PROD_DATABASE_URI')
+    METRICS_DIR = os.environ.get('METRICS_DIR',
+                                 os.path.join(basedir, 'metrics'))
+    # comma separated
+    SQLALCHEMY_REPLICA_URIS = filter(None, os.environ.get(
+        'PROD_REPLICA_URIS', '').split(','))
+
+
+# The read endpoints served by green.py. Greenlets wait for a connection of
+# the pool, its size is the concurrency of the process.
+class GeventConfig(ProductionConfig):
+    SQLALCHEMY_POOL_SIZE = 20
+    SQLALCHEMY_MAX_OVERFLOW = 0
+    # sys._current_frames only has the frames of threads, not of greenlets
+    SAMPLING_PROFILER_RATE = 0
 
 
 config = {
     'development': DevelopmentConfig,
     'testing': TestingConfig,
     'production': ProductionConfig,
+    'gevent': GeventConfig,
 
     'default': DevelopmentConfig
 }
@@ -0,0 +1,53 @@
+'''The read endpoints of the catalog served by gevent, for the GETs that
+spend most of their time waiting for postgres.
+
+It is the same app as wsgi.py, so the responses are the same byte for byte.
+Every request runs in a greenlet and psycogreen makes psycopg2 yield to the
+other greenlets while it waits for the database, a single process serves as
+many requests at once as the pools have connections. Requests for other
+endpoints are answered with 404, nginx sends only the reads here.
+
+    pip install -r green_requirements.txt
+    python green.py [host:port]
+
+Compare it with a uwsgi worker with `app load run --mix read`, see
+deployment.md.
+'''
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg  # noqa
+patch_psycopg()
+
+import sys  # noqa
+
+from flask import abort, request  # noqa
+from gevent.pywsgi import WSGIServer  # noqa
+
+from app import create_app  # noqa
+
+ENDPOINTS = frozenset([
+    'v1.get_categories',
+    'v1.get_exercise',
+    'v1.get_exercises',
+    'v1.get_questionnaire',
+    'v1.get_questionnaires',
+])
+
+
+def only(endpoints):
+    '''Answer requests for any other than `endpoints` with 404.'''
+    def check_endpoint():
+        if request.endpoint not in endpoints:
+            abort(404)
+    return check_endpoint
+
+
+application = create_app('gevent', warmup=True)
+application.before_request(only(ENDPOINTS))
+
+
+if __name__ == '__main__':
+    host, _, port = (sys.argv[1] if len(sys.argv) > 1 else
+                     '127.0.0.1:5001').rpartition(':')
+    WSGIServer((host, int(port)), application, log=None).serve_forever()
@@ -0,0 +1,208 @@
+import random
+import subprocess
+import time
+
+import click
+
+from app import db as db_
+from app.models.meta.columns import ID_FUNCTION_SIGNATURE, \
+    looping_id_function_ddl
+from scripts.cli import cli
+
+# Both ways of storing responses in temporary tables, so the benchmarks never
+# touch real data. `choice` is how responses used to be stored, one row per
+# answer referencing its option.
+RESPONSE_TABLES = '''
+CREATE TEMPORARY TABLE bench_option (
+    value INTEGER,
+    question_id INTEGER,
+    PRIMARY KEY (value, question_id)
+);
+CREATE TEMPORARY TABLE bench_response (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    questionnaire_id INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT now(),
+    total INTEGER NOT NULL,
+    answers INTEGER[]
+);
+CREATE INDEX ON bench_response (user_id, questionnaire_id, created_at);
+CREATE TEMPORARY TABLE bench_choice (
+    value INTEGER,
+    question_id INTEGER,
+    response_id INTEGER REFERENCES bench_response ON DELETE CASCADE,
+    PRIMARY KEY (value, question_id, response_id),
+    FOREIGN KEY (value, question_id) REFERENCES bench_option,
+    UNIQUE (question_id, response_id)
+);
+'''
+
+INSERT_RESPONSE = '''
+INSERT INTO bench_response (user_id, questionnaire_id, total, answers)
+VALUES (%s, 1, %s, %s) RETURNING id
+'''
+INSERT_CHOICE = 'INSERT INTO bench_choice VALUES (%s, %s, %s)'
+
+READ_CHOICES = '''
+SELECT bench_response.id, bench_choice.question_id, bench_choice.value
+FROM bench_response JOIN bench_choice ON bench_choice.response_id = bench_response.id
+WHERE user_id = %s AND questionnaire_id = 1
+ORDER BY created_at
+'''
+READ_ANSWERS = '''
+SELECT id, answers FROM bench_response
+WHERE user_id = %s AND questionnaire_id = 1
+ORDER BY created_at
+'''
+
+
+def timed(f, *args):
+    start = time.time()
+    f(*args)
+    return time.time() - start
+
+
+def percentile(values, fraction):
+    '''The value below which `fraction` of the sorted `values` fall, by the
+    nearest rank.'''
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def revision():
+    '''The git commit that is checked out, if any.'''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@cli.group()
+def bench():
+    '''Benchmarks against the configured database.'''
+
+
+@bench.command()
+@click.option('--responses', default=5000, help='Responses per layout.')
+@click.option('--questions', default=20, help='Questions per response.')
+@click.option('--users', default=50)
+def responses(responses, questions, users):
+    '''Compare storing responses as choice rows and as an answers array.'''
+    connection = db_.engine.connect()
+    connection.execute(RESPONSE_TABLES)
+    connection.execute('INSERT INTO bench_option '
+                       'SELECT v, q FROM generate_series(0, 4) AS v, '
+                       'generate_series(1, %s) AS q' % questions)
+    samples = [(random.randrange(users),
+                [random.randrange(5) for i in xrange(questions)])
+               for i in xrange(responses)]
+
+    def insert_choices():
+        with connection.begin():
+            for user_id, answers in samples:
+                response_id = connection.execute(
+                    INSERT_RESPONSE, user_id, sum(answers), None).scalar()
+                connection.execute(INSERT_CHOICE, [
+                    (value, question_id, response_id)
+                    for question_id, value in enumerate(answers, 1)])
+
+    def insert_answers():
+        with connection.begin():
+            for user_id, answers in samples:
+                connection.execute(INSERT_RESPONSE, user_id, sum(answers),
+                                   answers)
+
+    def size(*tables):
+        return sum(connection.execute('SELECT pg_total_relation_size(%s)',
+                                      table).scalar() for table in tables)
+
+    def read(statement):
+        for user_id in xrange(users):
+            connection.execute(statement, user_id).fetchall()
+
+    results = []
+    insert_time = timed(insert_choices)
+    results.append(('choice rows', insert_time, timed(read, READ_CHOICES),
+                    size('bench_response', 'bench_choice')))
+    connection.execute('TRUNCATE bench_response CASCADE')
+
+    insert_time = timed(insert_answers)
+    results.append(('answers array', insert_time, timed(read, READ_ANSWERS),
+                    size('bench_response', 'bench_choice')))
+    connection.close()
+
+    click.echo('{} responses of {} questions, {} users'.format(
+        responses, questions, users))
+    click.echo('{:<15}{:>12}{:>12}{:>14}'.format(
+        'layout', 'insert (s)', 'read (s)', 'storage (kB)'))
+    for name, insert_time, read_time, table_size in results:
+        click.echo('{:<15}{:>12.3f}{:>12.3f}{:>14}'.format(
+            name, insert_time, read_time, table_size / 1024))
+
+
+# Rows for the tables of which the ids are benchmarked, inserted in bulk so the
+# id function is a big part of the work.
+ID_INSERTS = [
+    ('exercise', '''
+     INSERT INTO exercise (title, description, description_html, author_id)
+     SELECT 'title', 'description', 'description', %(user_id)s
+     FROM generate_series(1, %(rows)s)
+     '''),
+    ('question', '''
+     INSERT INTO question (text, ordinal, questionnaire_id)
+     SELECT 'text', i, %(questionnaire_id)s
+     FROM generate_series(1, %(rows)s) AS i
+     '''),
+    ('questionnaire_response', '''
+     INSERT INTO questionnaire_response
+        (user_id, questionnaire_id, answers, total, created_at, updated_at)
+     SELECT %(user_id)s, %(questionnaire_id)s, '{1, 2, 3}', 6, now(), now()
+     FROM generate_series(1, %(rows)s)
+     '''),
+]
+
+
+@bench.command()
+@click.option('--rows', default=20000, help='Rows per table.')
+def ids(rows):
+    '''Compare insert throughput with the original obscure_id.
+
+    Everything happens in transactions that are rolled back, the original
+    function is only in place during its benchmark.
+    '''
+    from flask.globals import _app_ctx_stack
+    config = _app_ctx_stack.top.app.config
+    looping = looping_id_function_ddl.format(
+        id_function_signature=ID_FUNCTION_SIGNATURE,
+        coprime=config['OBSCURE_ID_KEY'],
+        modulus=config['OBSCURE_ID_MODULUS'])
+
+    def run(setup=None):
+        timings = []
+        connection = db_.engine.connect()
+        transaction = connection.begin()
+        if setup:
+            connection.execute(setup)
+        user_id = connection.execute(
+            "INSERT INTO \"user\" (username, password) VALUES ('bench', '') "
+            "RETURNING id").scalar()
+        questionnaire_id = connection.execute(
+            "INSERT INTO questionnaire (title, description) "
+            "VALUES ('bench', 'bench') RETURNING id").scalar()
+        for table, insert in ID_INSERTS:
+            timings.append(timed(connection.execute, insert, dict(
+                rows=rows, user_id=user_id, questionnaire_id=questionnaire_id)))
+        transaction.rollback()
+        connection.close()
+        return timings
+
+    results = [('original', run(looping)), ('current', run())]
+
+    click.echo('{} rows per table, rows per second'.format(rows))
+    click.echo('{:<10}'.format('function') + ''.join(
+        '{:>24}'.format(table) for table, insert in ID_INSERTS))
+    for name, timings in results:
+        click.echo('{:<10}'.format(name) + ''.join(
+            '{:>24.0f}'.format(rows / timing) for timing in timings))
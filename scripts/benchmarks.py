@@ -0,0 +1,321 @@
+'''Latency benchmarks of the main endpoints and of the components they are
+built from, against the configured database.
+
+The database has to be seeded first, with `app db fill` for the categories
+and questionnaires and `app db synth` for the users, exercises and ratings.
+The write benchmarks leave their ratings and responses behind.
+
+Results are written as JSON so runs can be compared, `--baseline` flags the
+benchmarks whose median got slower than the baseline by more than the
+threshold.
+'''
+import gc
+import itertools
+import json
+import time
+from datetime import datetime
+
+import click
+from flask import current_app, request
+
+from app import hashid
+from app.lib import Pagination
+from app.models import Category, Exercise, Questionnaire, Rating, User
+from app.models.models import mdtohtml
+from app.serializers import ExerciseSchema, Serializer
+from scripts.bench import bench, percentile, revision
+
+ORDER_BY = (None, 'popularity', 'average_rating', 'average_fun_rating',
+            'average_clear_rating', 'average_effective_rating', 'updated_at',
+            'user_rating', 'user_fun_rating', 'user_effective_rating',
+            'user_clear_rating', 'relevance')
+SEARCH = 'adem ontspanning'
+
+DESCRIPTION = '''Ga op een plek zitten waar u rustig de oefening kunt doen.
+Zit rechtop, schouders en buik ontspannen, hoofd rechtop.
+
+Als u het prettig vindt om thuis te oefenen met een stem erbij kunt u op
+internet verschillende oefeningen vinden op [ioconsult](http://www.ioconsult.nl/audio/)
+
+![Imgur](http://i.imgur.com/liZp6P0.png)
+'''
+
+CASES = []
+
+
+def case(name):
+    '''Register a benchmark. It is called with the `Subjects` once and
+    returns the function that is measured.'''
+    def decorator(f):
+        CASES.append((name, f))
+        return f
+    return decorator
+
+
+class Subjects(object):
+    '''The rows of the seeded database the benchmarks use and a client that
+    is logged in as one of the synthetic users.'''
+    def __init__(self, app, password):
+        self.user = User.query.filter(User.username.like('synth%')).first()
+        # get_exercise only finds exercises the user rated
+        self.exercise = Exercise.query.join(Rating).\
+            filter(Rating.user_id == (self.user and self.user.id)).\
+            first()
+        self.category = Category.query.first()
+        self.questionnaire = Questionnaire.query.first()
+        if not all((self.user, self.exercise, self.category,
+                    self.questionnaire)):
+            raise click.ClickException(
+                'Seed the database with `app db fill` and `app db synth`.')
+
+        self.password = password
+        self.client = app.test_client()
+        rv = self.login()
+        if rv.status_code != 200:
+            raise click.ClickException('Can not log in as %s with password '
+                                       '%s.' % (self.user.username, password))
+        self.headers = dict(Authorization='Bearer %s' %
+                            json.loads(rv.data)['access_token'])
+
+    def login(self):
+        return self.client.post('/v1/login', data=dict(
+            grant_type='password',
+            username=self.user.username,
+            password=self.password))
+
+    def get(self, url):
+        return self.client.get(url, headers=self.headers)
+
+    def post(self, url, data):
+        return self.client.post(url, data=json.dumps(data),
+                                headers=self.headers,
+                                content_type='application/json')
+
+
+def endpoint(name):
+    '''Register a benchmark of a request. The decorated function is called
+    with the `Subjects` once and returns the function that makes the request,
+    a request that fails stops the suite.'''
+    def decorator(f):
+        def benchmark(subjects):
+            make_request = f(subjects)
+
+            def checked():
+                rv = make_request()
+                if rv.status_code >= 400:
+                    raise click.ClickException('%s responded with %s: %s' % (
+                        name, rv.status_code, rv.data))
+            return checked
+        CASES.append((name, benchmark))
+        return f
+    return decorator
+
+
+def get_exercises(order_by, search, category):
+    def benchmark(subjects):
+        params = [('order_by', order_by), ('search', search),
+                  ('category', category and subjects.category.name)]
+        url = '/v1/exercises?' + '&'.join('%s=%s' % (key, value)
+                                          for key, value in params if value)
+        return lambda: subjects.get(url)
+    return benchmark
+
+
+for order_by, search, category in itertools.product(
+        ORDER_BY, (None, SEARCH), (False, True)):
+    name = ' '.join(['get_exercises'] +
+                    (['order_by=%s' % order_by] if order_by else []) +
+                    (['search'] if search else []) +
+                    (['category'] if category else []))
+    endpoint(name)(get_exercises(order_by, search, category))
+
+
+@endpoint('get_exercise')
+def get_exercise(subjects):
+    url = '/v1/exercises/%s' % hashid.encode(subjects.exercise.id)
+    return lambda: subjects.get(url)
+
+
+@endpoint('get_favorites')
+def get_favorites(subjects):
+    url = '/v1/users/%s/favorites' % hashid.encode(subjects.user.id)
+    return lambda: subjects.get(url)
+
+
+@endpoint('rate_exercise')
+def rate_exercise(subjects):
+    url = '/v1/exercises/%s/ratings' % hashid.encode(subjects.exercise.id)
+    return lambda: subjects.post(url, dict(fun=4, clear=3, effective=5))
+
+
+@endpoint('login')
+def login(subjects):
+    return subjects.login
+
+
+@endpoint('get_questionnaires')
+def get_questionnaires(subjects):
+    return lambda: subjects.get('/v1/questionnaires')
+
+
+@endpoint('post_response')
+def post_response(subjects):
+    definition = subjects.questionnaire.definition
+    choices = [dict(question_id=hashid.encode(question.id),
+                    value=min(question.values))
+               for question in definition.questions]
+    url = '/v1/questionnaires/%s/responses' % hashid.encode(
+        subjects.questionnaire.id)
+    return lambda: subjects.post(url, dict(choices=choices))
+
+
+@case('HashID.encode')
+def hashid_encode(subjects):
+    return lambda: hashid.encode(subjects.exercise.id)
+
+
+@case('HashID.decode')
+def hashid_decode(subjects):
+    value = hashid.encode(subjects.exercise.id)
+    return lambda: hashid.decode(value)
+
+
+@case('mdtohtml')
+def render_markdown(subjects):
+    return lambda: mdtohtml(Exercise(), DESCRIPTION, None, None)
+
+
+def in_request(url, f):
+    '''Run `f` in a request context of `url`.'''
+    def wrapper():
+        with current_app.test_request_context(url):
+            return f()
+    return wrapper
+
+
+@case('Pagination')
+def pagination(subjects):
+    def f():
+        page = Pagination(request, query=Exercise.query.order_by(
+            Exercise.created_at.desc()))
+        return page.first_page_url, page.next_page_url, page.last_page_url
+    return in_request('/v1/exercises', f)
+
+
+@case('Serializer.dump_page')
+def dump_page(subjects):
+    pages = []
+
+    def f():
+        # the page is queried once, it is the serializing that is measured
+        if not pages:
+            pages.append(Pagination(request, query=Exercise.query))
+        return Serializer(ExerciseSchema, request.args).dump_page(pages[0])
+    return in_request('/v1/exercises', f)
+
+
+def measure(f, rounds, warmup):
+    '''Time `rounds` calls of `f` after `warmup` calls.
+
+    Python 2 has no tracemalloc to count allocations. Instead the objects
+    that are left after a few more calls, with the garbage collector off, are
+    counted. Those are the cycles only the garbage collector frees and the
+    objects that are kept, so it shows both the work for the collector and
+    leaks.'''
+    for i in xrange(warmup):
+        f()
+
+    timings = []
+    for i in xrange(rounds):
+        start = time.time()
+        f()
+        timings.append((time.time() - start) * 1000)
+
+    calls = min(rounds, 10)
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        for i in xrange(calls):
+            f()
+        objects = (gc.get_count()[0] - before) / float(calls)
+    finally:
+        gc.enable()
+
+    timings.sort()
+    return dict(rounds=rounds,
+                min=timings[0],
+                median=percentile(timings, 0.5),
+                p95=percentile(timings, 0.95),
+                mean=sum(timings) / len(timings),
+                objects=objects)
+
+
+def compare(results, baseline, threshold):
+    '''Pair the medians of the benchmarks in both `results` and `baseline`.
+    Returns tuples of the name, both medians and whether it regressed.'''
+    rv = []
+    for name in sorted(set(results) & set(baseline)):
+        before, after = baseline[name]['median'], results[name]['median']
+        rv.append((name, before, after, after > before * (1 + threshold)))
+    return rv
+
+
+def echo_comparison(comparison):
+    click.echo('{:<64}{:>12}{:>12}{:>9}'.format(
+        'benchmark', 'base (ms)', 'now (ms)', 'change'))
+    for name, before, after, regressed in comparison:
+        click.echo('{:<64}{:>12.3f}{:>12.3f}{:>8.0%} {}'.format(
+            name, before, after, after / before - 1 if before else 0,
+            'REGRESSION' if regressed else ''))
+
+
+@bench.command()
+@click.option('--rounds', default=30, help='Measured calls per benchmark.')
+@click.option('--warmup', default=3, help='Calls before measuring.')
+@click.option('--match', default='', help='Only run benchmarks whose name '
+              'contains this.')
+@click.option('--password', default='00000000',
+              help='Password of the synthetic users.')
+@click.option('--output', type=click.Path(), help='Write the results here.')
+@click.option('--baseline', type=click.File(), help='Results to compare with.')
+@click.option('--threshold', default=0.1,
+              help='Slowdown of the median that is a regression.')
+def suite(rounds, warmup, match, password, output, baseline, threshold):
+    '''Benchmark the endpoints and their components.'''
+    subjects = Subjects(current_app, password)
+    results = {}
+    for name, benchmark in CASES:
+        if match not in name:
+            continue
+        results[name] = measure(benchmark(subjects), rounds, warmup)
+        click.echo('{:<64}{:>10.3f} ms {:>10.1f} objects'.format(
+            name, results[name]['median'], results[name]['objects']))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(dict(meta=dict(created_at=datetime.utcnow().isoformat(),
+                                     revision=revision(),
+                                     rounds=rounds),
+                           results=results), f, indent=2, sort_keys=True)
+
+    if baseline:
+        comparison = compare(results, json.load(baseline)['results'],
+                             threshold)
+        echo_comparison(comparison)
+        if any(regressed for name, before, after, regressed in comparison):
+            raise SystemExit(1)
+
+
+@bench.command('compare')
+@click.argument('baseline', type=click.File())
+@click.argument('results', type=click.File())
+@click.option('--threshold', default=0.1,
+              help='Slowdown of the median that is a regression.')
+def compare_results(baseline, results, threshold):
+    '''Compare two results of the benchmark suite.'''
+    comparison = compare(json.load(results)['results'],
+                         json.load(baseline)['results'], threshold)
+    echo_comparison(comparison)
+    if any(regressed for name, before, after, regressed in comparison):
+        raise SystemExit(1)
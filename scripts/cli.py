@@ -1,6 +1,20 @@
+import importlib
+
 import click
 from flask.cli import FlaskGroup, script_info_option
 
+# The modules that define each command, imported when the command is run.
+# Commands can add subcommands to another command's group from their own
+# module, like `db synth`.
+COMMANDS = {
+    'bench': ('scripts.bench', 'scripts.benchmarks'),
+    'db': ('scripts.db', 'scripts.synth'),
+    'ishell': ('scripts.flask_app',),
+    'load': ('scripts.load',),
+    'profile': ('scripts.profile',),
+    'startup-profile': ('scripts.startup',),
+}
+
 
 def create_app(info):
     from app import create_app, db, models
@@ -17,11 +31,21 @@ def create_app(info):
     return app
 
 
-@click.group(cls=FlaskGroup, create_app=create_app)
+class LazyGroup(FlaskGroup):
+    '''Imports the module of a command only when it is run, so a command
+    doesn't pay for the imports of all the others.'''
+    def list_commands(self, ctx):
+        return sorted(set(super(LazyGroup, self).list_commands(ctx)) |
+                      set(COMMANDS))
+
+    def get_command(self, ctx, name):
+        for module in COMMANDS.get(name, ()):
+            importlib.import_module(module)
+        return super(LazyGroup, self).get_command(ctx, name)
+
+
+@click.group(cls=LazyGroup, create_app=create_app)
 @script_info_option('--config', script_info_key='config')
 def cli(**params):
     '''This is an entry point for scripts that require the app context.
     '''
-
-import scripts.flask_app  # noqa
-import scripts.db  # noqa
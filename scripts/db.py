@@ -6,9 +6,9 @@ import json
 import click
 from psycopg2.extras import NumericRange
 from flask.cli import pass_script_info
-from pgcli.main import PGCli
 
 from app import db as db_, models
+from app.models.meta import columns, ddl
 from scripts.cli import cli
 
 
@@ -80,6 +80,18 @@ def create(ctx, d):
     click.echo('Created all tables')
 
 
+@db.command()
+def migrate():
+    '''Bring the tables of an existing database up to date.'''
+    with db_.engine.begin() as connection:
+        for migration in ddl.MIGRATIONS:
+            connection.execute(migration)
+        # the id function and sequence depend on the configuration
+        columns.create_id(models.Base.metadata, connection)
+        columns.set_sequence_cache(models.Base.metadata, connection)
+    click.echo('Ran {} migrations'.format(len(ddl.MIGRATIONS)))
+
+
 @db.command()
 @click.pass_obj
 def fill(obj):
@@ -199,6 +211,7 @@ def fill(obj):
 def pgcli(info, pgclirc):
     '''Start a pgcli session.'''
     from flask.globals import _app_ctx_stack
+    from pgcli.main import PGCli
     app = _app_ctx_stack.top.app
     pgcli = PGCli(pgclirc_file=pgclirc)
     pgcli.connect_uri(app.config['SQLALCHEMY_DATABASE_URI'])
@@ -0,0 +1,89 @@
+'''Times the imports of a new interpreter, for `app startup-profile`. Only
+the standard library is imported before the timer is in place.
+
+    python -m scripts.importtimer [config]
+'''
+import imp
+import importlib
+import json
+import pkgutil
+import sys
+import time
+
+
+class TimedLoader(pkgutil.ImpLoader):
+    def __init__(self, timer, fullname, f, pathname, description):
+        pkgutil.ImpLoader.__init__(self, fullname, f, pathname, description)
+        self.timer = timer
+
+    def load_module(self, fullname):
+        timer = self.timer
+        timer.nested.append(0.0)
+        start = time.time()
+        try:
+            return pkgutil.ImpLoader.load_module(self, fullname)
+        finally:
+            elapsed = time.time() - start
+            timer.times[fullname] = elapsed - timer.nested.pop()
+            timer.cumulative[fullname] = elapsed
+            if timer.nested:
+                timer.nested[-1] += elapsed
+
+
+class ImportTimer(object):
+    '''Times the modules loaded while it is on `sys.meta_path`. A module is
+    charged the time of its own body, the modules it imports are charged
+    theirs. Modules that `imp` can't find, like those in zipped eggs, are left
+    to the other importers and are not timed.
+    '''
+    def __init__(self):
+        self.times = {}
+        self.cumulative = {}
+        self.nested = []
+
+    def __enter__(self):
+        sys.meta_path.insert(0, self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sys.meta_path.remove(self)
+
+    def find_module(self, fullname, path=None):
+        try:
+            found = imp.find_module(fullname.rpartition('.')[2], path)
+        except ImportError:
+            return None
+        return TimedLoader(self, fullname, *found)
+
+
+def measure(config_name):
+    '''Start the app with an `ImportTimer` and print what it measured as
+    JSON.'''
+    phases = []
+    with ImportTimer() as timer:
+        start = time.time()
+        from app import create_app
+        phases.append(('import app', time.time() - start))
+
+        start = time.time()
+        create_app(config_name)
+        phases.append(('create_app', time.time() - start))
+
+        start = time.time()
+        from scripts.cli import COMMANDS
+        phases.append(('import cli', time.time() - start))
+
+        for name in sorted(COMMANDS):
+            start = time.time()
+            for module in COMMANDS[name]:
+                importlib.import_module(module)
+            phases.append(('command %s' % name, time.time() - start))
+
+    json.dump(dict(phases=phases,
+                   modules=[(name, timer.times[name], timer.cumulative[name])
+                            for name in timer.times]),
+              sys.stdout)
+
+
+if __name__ == '__main__':
+    measure(sys.argv[1] if len(sys.argv) > 1 else 'default')
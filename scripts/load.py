@@ -0,0 +1,380 @@
+'''Load tests against a running app.
+
+Requests are either replayed from an nginx access log or drawn from a
+synthetic mix of the `/v1` endpoints. They are sent by concurrent workers,
+each as one of the synthetic users of `app db synth` with a token like the
+app issues on login. Run it with the same configuration as the app, the users
+and the ids in the synthetic requests come from its database.
+
+The time requests waited for a database connection is read from the
+`X-DB-Pool-Wait` header, the app sends it with `SQLALCHEMY_POOL_WAIT_HEADER`.
+'''
+import httplib
+import itertools
+import json
+import random
+import re
+import socket
+import threading
+import time
+import urllib
+import urlparse
+from collections import defaultdict
+from datetime import datetime
+
+import click
+from flask import current_app
+from werkzeug.exceptions import HTTPException
+
+from app import db as db_, hashid
+from app.models import Exercise, Questionnaire, User
+from scripts.bench import percentile, revision
+from scripts.benchmarks import ORDER_BY, SEARCH
+from scripts.cli import cli
+
+# A request of nginx's combined log format.
+LOG_LINE = re.compile(r'^\S+ \S+ \S+ \[[^\]]*\] "(?P<method>[A-Z]+) '
+                      r'(?P<path>/v1/\S*) [^"]*"')
+REPLAY_METHODS = frozenset(['GET', 'HEAD'])
+FAVORITES = re.compile(r'^/v1/users/[^/?]+/favorites')
+
+
+class VirtualUser(object):
+    '''A synthetic user and the headers of its requests.'''
+    def __init__(self, user):
+        self.hashid = hashid.encode(user.id)
+        self.headers = {
+            'Authorization': 'Bearer %s' %
+            user.generate_auth_token()['access_token'],
+            'Content-Type': 'application/json',
+        }
+
+
+class Subjects(object):
+    '''The users, exercises and questionnaires of the synthetic requests.'''
+    def __init__(self, users):
+        self.users = [VirtualUser(user) for user in User.query.filter(
+            User.username.like('synth%')).limit(users)]
+        self.exercises = [hashid.encode(id) for id, in
+                          db_.session.query(Exercise.id).limit(1000)]
+        self.questionnaires = [
+            (hashid.encode(questionnaire.id),
+             [(hashid.encode(question.id), sorted(question.values))
+              for question in questionnaire.definition.questions])
+            for questionnaire in Questionnaire.query]
+        if not self.users or not self.exercises or not self.questionnaires:
+            raise click.ClickException(
+                'Seed the database with `app db fill` and `app db synth`.')
+
+
+def list_exercises(random, user, subjects):
+    params = dict(order_by=random.choice(ORDER_BY),
+                  search=random.random() < 0.2 and SEARCH,
+                  page=random.choice((1, 1, 1, 2, 3)))
+    return 'GET', '/v1/exercises?' + urllib.urlencode(
+        [(key, value) for key, value in params.iteritems() if value]), None
+
+
+def get_exercise(random, user, subjects):
+    return 'GET', '/v1/exercises/%s' % random.choice(subjects.exercises), None
+
+
+def get_favorites(random, user, subjects):
+    return 'GET', '/v1/users/%s/favorites' % user.hashid, None
+
+
+def rate_exercise(random, user, subjects):
+    rating = dict(fun=random.randint(1, 5), clear=random.randint(1, 5),
+                  effective=random.randint(1, 5))
+    return ('POST',
+            '/v1/exercises/%s/ratings' % random.choice(subjects.exercises),
+            json.dumps(rating))
+
+
+def get_questionnaires(random, user, subjects):
+    return 'GET', '/v1/questionnaires', None
+
+
+def post_response(random, user, subjects):
+    id, questions = random.choice(subjects.questionnaires)
+    choices = [dict(question_id=question_id, value=random.choice(values))
+               for question_id, values in questions]
+    return ('POST', '/v1/questionnaires/%s/responses' % id,
+            json.dumps(dict(choices=choices)))
+
+
+def get_progress(random, user, subjects):
+    id, questions = random.choice(subjects.questionnaires)
+    return 'GET', '/v1/questionnaires/%s/progress' % id, None
+
+
+def get_profile(random, user, subjects):
+    return 'GET', '/v1/users/profile', None
+
+
+def get_categories(random, user, subjects):
+    return 'GET', '/v1/exercises/categories', None
+
+
+# The synthetic mix, weights and the functions that make the requests.
+MIX = [
+    (30, list_exercises),
+    (20, get_exercise),
+    (10, get_favorites),
+    (5, rate_exercise),
+    (10, get_questionnaires),
+    (5, post_response),
+    (5, get_progress),
+    (5, get_profile),
+]
+# The reads of the catalog, the endpoints green.py serves.
+READ_MIX = [
+    (40, list_exercises),
+    (30, get_exercise),
+    (10, get_categories),
+    (20, get_questionnaires),
+]
+MIXES = dict(full=MIX, read=READ_MIX)
+
+
+class SyntheticRequests(object):
+    '''Draws requests from a weighted mix, `MIX` by default.'''
+    def __init__(self, subjects, mix=MIX):
+        self.subjects = subjects
+        self.mix = mix
+        self.cumulative = []
+        for weight, f in mix:
+            self.cumulative.append(weight + (self.cumulative or [0])[-1])
+
+    def next(self, random, user):
+        draw = random.uniform(0, self.cumulative[-1])
+        for total, (weight, f) in zip(self.cumulative, self.mix):
+            if draw <= total:
+                return f(random, user, self.subjects)
+
+
+class ReplayedRequests(object):
+    '''Cycles through the requests of an nginx access log. Only reads are
+    replayed, the log doesn't have the bodies of writes. Favorites are those
+    of the user that replays them, others are not allowed.'''
+    def __init__(self, log):
+        self.requests = []
+        self.skipped = 0
+        for line in log:
+            match = LOG_LINE.match(line)
+            if match and match.group('method') in REPLAY_METHODS:
+                self.requests.append((match.group('method'),
+                                      match.group('path')))
+            else:
+                self.skipped += 1
+        if not self.requests:
+            raise click.ClickException('The log has no requests to replay.')
+        self.lock = threading.Lock()
+        self.cycle = itertools.cycle(self.requests)
+
+    def next(self, random, user):
+        with self.lock:
+            method, path = next(self.cycle)
+        path = FAVORITES.sub('/v1/users/%s/favorites' % user.hashid, path)
+        return method, path, None
+
+
+class Run(object):
+    '''Sends requests from `source` with `concurrency` workers until
+    `duration` seconds have passed or `limit` requests are sent. A sample is
+    the endpoint, status, latency and pool wait of a request, the status is
+    None when the request failed.'''
+    def __init__(self, url, source, users, concurrency, duration, limit=None,
+                 seed=None):
+        url = urlparse.urlsplit(url)
+        self.host, self.port = url.hostname, url.port
+        self.prefix = url.path.rstrip('/')
+        self.source = source
+        self.users = users
+        self.concurrency = concurrency
+        self.duration = duration
+        self.limit = limit
+        self.seed = seed
+        self.samples = []
+        self.sent = itertools.count()
+        self.adapter = current_app.url_map.bind(self.host)
+        self.stopped = threading.Event()
+
+    def endpoint(self, method, path):
+        '''The method and url rule of a request.'''
+        try:
+            rule, args = self.adapter.match(path.split('?')[0], method,
+                                            return_rule=True)
+        except HTTPException:
+            return '%s unknown' % method
+        return '%s %s' % (method, rule.rule)
+
+    def connect(self):
+        return httplib.HTTPConnection(self.host, self.port, timeout=30)
+
+    def work(self, number):
+        rng = random.Random(None if self.seed is None else self.seed + number)
+        user = self.users[number % len(self.users)]
+        connection = self.connect()
+        while not self.stopped.is_set():
+            if self.limit is not None and next(self.sent) >= self.limit:
+                break
+            method, path, body = self.source.next(rng, user)
+            status, pool_wait = None, None
+            start = time.time()
+            try:
+                connection.request(method, self.prefix + path, body,
+                                   user.headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+                pool_wait = response.getheader(db_.POOL_WAIT_HEADER)
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                connection = self.connect()
+            self.samples.append((self.endpoint(method, path), status,
+                                 time.time() - start,
+                                 pool_wait and float(pool_wait)))
+        connection.close()
+
+    def __call__(self):
+        workers = [threading.Thread(target=self.work, args=(number,))
+                   for number in xrange(self.concurrency)]
+        start = time.time()
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        deadline = start + self.duration
+        while any(worker.is_alive() for worker in workers) and \
+                time.time() < deadline:
+            time.sleep(0.1)
+        self.stopped.set()
+        for worker in workers:
+            worker.join()
+        return time.time() - start
+
+
+def summarize(samples, elapsed):
+    '''Throughput, latency percentiles in milliseconds, errors and pool waits
+    of `samples`.'''
+    latencies = sorted(latency * 1000 for endpoint, status, latency, wait
+                       in samples)
+    waits = sorted(wait for endpoint, status, latency, wait in samples
+                   if wait is not None)
+    errors = sum(1 for endpoint, status, latency, wait in samples
+                 if status is None or status >= 500)
+    return dict(requests=len(samples),
+                throughput=len(samples) / elapsed,
+                p50=percentile(latencies, 0.5),
+                p95=percentile(latencies, 0.95),
+                p99=percentile(latencies, 0.99),
+                errors=errors,
+                error_rate=float(errors) / len(samples),
+                client_errors=sum(1 for endpoint, status, latency, wait
+                                  in samples if 400 <= (status or 0) < 500),
+                pool_wait_mean=sum(waits) / len(waits) if waits else None,
+                pool_wait_p95=percentile(waits, 0.95))
+
+
+def report(samples, elapsed):
+    by_endpoint = defaultdict(list)
+    for sample in samples:
+        by_endpoint[sample[0]].append(sample)
+    return dict(total=summarize(samples, elapsed),
+                endpoints={endpoint: summarize(endpoint_samples, elapsed)
+                           for endpoint, endpoint_samples
+                           in by_endpoint.iteritems()})
+
+
+def format_ms(value):
+    return '-' if value is None else '%.1f' % value
+
+
+def echo_report(result):
+    click.echo('{:<50}{:>9}{:>9}{:>9}{:>9}{:>9}{:>8}{:>8}{:>11}'.format(
+        'endpoint', 'requests', 'req/s', 'p50', 'p95', 'p99', 'errors',
+        '4xx', 'pool p95'))
+    rows = sorted(result['endpoints'].items()) + [('total', result['total'])]
+    for endpoint, stats in rows:
+        click.echo('{:<50}{:>9}{:>9.1f}{:>9}{:>9}{:>9}{:>8.1%}{:>8}{:>11}'.format(
+            endpoint, stats['requests'], stats['throughput'],
+            format_ms(stats['p50']), format_ms(stats['p95']),
+            format_ms(stats['p99']), stats['error_rate'],
+            stats['client_errors'], format_ms(stats['pool_wait_p95'])))
+
+
+@cli.group()
+def load():
+    '''Load tests against a running app.'''
+
+
+@load.command()
+@click.argument('url')
+@click.option('--log', type=click.File(), help='nginx access log to replay '
+              'instead of the synthetic mix.')
+@click.option('--concurrency', default=10, help='Concurrent requests.')
+@click.option('--duration', default=30, help='Seconds to run.')
+@click.option('--requests', type=int, help='Stop after this many requests.')
+@click.option('--users', default=100, help='Synthetic users to send the '
+              'requests as.')
+@click.option('--seed', type=int, help='Seed of the synthetic mix.')
+@click.option('--mix', type=click.Choice(sorted(MIXES)), default='full',
+              help='The synthetic mix, read is only the catalog reads.')
+@click.option('--output', type=click.Path(), help='Write the results here.')
+def run(url, log, concurrency, duration, requests, users, seed, mix, output):
+    '''Send requests to the app at URL, for example http://localhost:5000.'''
+    subjects = Subjects(users)
+    if log:
+        source = ReplayedRequests(log)
+        click.echo('Replaying {} requests, skipped {} lines'.format(
+            len(source.requests), source.skipped))
+    else:
+        source = SyntheticRequests(subjects, MIXES[mix])
+    # the users are known, the rest of the run doesn't need the database
+    db_.session.remove()
+
+    load_run = Run(url, source, subjects.users, concurrency, duration,
+                   limit=requests, seed=seed)
+    elapsed = load_run()
+    if not load_run.samples:
+        raise click.ClickException('No requests were sent.')
+    result = dict(report(load_run.samples, elapsed),
+                  meta=dict(url=url,
+                            source=log.name if log else 'synthetic ' + mix,
+                            concurrency=concurrency,
+                            duration=elapsed,
+                            started_at=datetime.utcnow().isoformat(),
+                            revision=revision()))
+    echo_report(result)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+COMPARED = [('requests', '{:>12}'), ('throughput', '{:>12.1f}'),
+            ('p50', '{:>12.1f}'), ('p95', '{:>12.1f}'), ('p99', '{:>12.1f}'),
+            ('error_rate', '{:>12.1%}'), ('pool_wait_p95', '{:>12.1f}')]
+
+
+@load.command()
+@click.argument('results', type=click.File(), nargs=-1, required=True)
+def compare(results):
+    '''Compare the results of runs side by side.'''
+    runs = [json.load(result) for result in results]
+    click.echo('{:<50}{:<15}'.format('endpoint', 'metric') + ''.join(
+        '{:>12}'.format('run %s' % i) for i, run in enumerate(runs, 1)))
+    endpoints = sorted(set(endpoint for run in runs
+                           for endpoint in run['endpoints']))
+    for endpoint in endpoints + ['total']:
+        stats = [run['total'] if endpoint == 'total' else
+                 run['endpoints'].get(endpoint) for run in runs]
+        for i, (metric, template) in enumerate(COMPARED):
+            click.echo('{:<50}{:<15}'.format(endpoint if i == 0 else '',
+                                             metric) + ''.join(
+                '{:>12}'.format('-') if not s or s[metric] is None else
+                template.format(s[metric]) for s in stats))
+    for i, (run, result) in enumerate(zip(runs, results), 1):
+        click.echo('run {}: {} ({}, concurrency {}, revision {})'.format(
+            i, result.name, run['meta']['source'], run['meta']['concurrency'],
+            run['meta']['revision']))
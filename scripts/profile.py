@@ -0,0 +1,119 @@
+import glob
+import json
+import os
+from collections import Counter
+
+import click
+from flask import current_app
+
+from app import sampling_profiler
+from app.lib import SlowQueryLog
+from scripts.cli import cli
+
+
+def read_stacks(directory):
+    '''The collapsed stacks of all processes in `directory`, merged.'''
+    stacks = Counter()
+    for path in glob.glob(os.path.join(directory, 'profile.*.collapsed')):
+        with open(path) as f:
+            for line in f:
+                stack, count = line.rsplit(' ', 1)
+                stacks[stack] += int(count)
+    return stacks
+
+
+def directory_option(f):
+    return click.option('--directory', type=click.Path(file_okay=False),
+                        help='Defaults to SAMPLING_PROFILER_DIR.')(f)
+
+
+@cli.group()
+def profile():
+    '''Sampled stacks and slow statements of live requests.'''
+
+
+@profile.command()
+@click.option('--expiration', default=3600,
+              help='Seconds the token profiles requests.')
+def token(expiration):
+    '''Print a value of the X-Profile header that profiles requests.'''
+    click.echo(sampling_profiler.token(expiration))
+
+
+@profile.command()
+@directory_option
+def endpoints(directory):
+    '''The endpoints that were sampled, most samples first.'''
+    stacks = read_stacks(directory or
+                         current_app.config['SAMPLING_PROFILER_DIR'])
+    samples = Counter()
+    for stack, count in stacks.iteritems():
+        samples[stack.split(';', 1)[0]] += count
+    for endpoint, count in samples.most_common():
+        click.echo('{:>10} {}'.format(count, endpoint))
+
+
+@profile.command()
+@directory_option
+@click.option('--endpoint', help='Only the stacks of this endpoint, without '
+              'the endpoint as the root frame.')
+def stacks(directory, endpoint):
+    '''Print the collapsed stacks of all processes, for flamegraph.pl or
+    speedscope.
+
+    Processes keep counting the stacks they sampled until they restart.
+    '''
+    directory = directory or current_app.config['SAMPLING_PROFILER_DIR']
+    for stack, count in sorted(read_stacks(directory).iteritems()):
+        if endpoint:
+            root, _, stack = stack.partition(';')
+            if root != endpoint:
+                continue
+        click.echo('%s %s' % (stack, count))
+
+
+def captures(directory):
+    return SlowQueryLog.captures(directory or
+                                 current_app.config['SLOW_QUERY_DIR'])
+
+
+@profile.command()
+@click.option('--directory', type=click.Path(file_okay=False),
+              help='Defaults to SLOW_QUERY_DIR.')
+@click.option('--limit', default=20, help='The newest this many.')
+@click.option('--match', default='', help='Only statements that contain this.')
+def queries(directory, limit, match):
+    '''List the slow statements that were explained, newest first.'''
+    matching = [capture for capture in captures(directory)
+                if match in capture['statement']]
+    click.echo('{:<24}{:>12}  {:<28}{}'.format(
+        'id', 'time (ms)', 'endpoint', 'fingerprint'))
+    for capture in reversed(matching[-limit:]):
+        click.echo('{:<24}{:>12.1f}  {:<28}{}'.format(
+            capture['id'], capture['duration_ms'],
+            capture.get('endpoint') or '-', capture['fingerprint'][:80]))
+
+
+@profile.command()
+@click.option('--directory', type=click.Path(file_okay=False),
+              help='Defaults to SLOW_QUERY_DIR.')
+@click.argument('id')
+def plan(directory, id):
+    '''Show a slow statement, its parameters and its plan.'''
+    for capture in captures(directory):
+        if capture['id'] == id:
+            break
+    else:
+        raise click.ClickException('No capture %s, it might have been '
+                                   'rotated out.' % id)
+
+    click.echo('%s %s (%s) took %.1f ms' % (
+        capture.get('method', ''), capture.get('path', ''),
+        capture.get('endpoint'), capture['duration_ms']))
+    click.echo()
+    click.echo(capture['statement'].strip())
+    click.echo()
+    click.echo('parameters: %s' % json.dumps(capture['parameters'],
+                                             sort_keys=True))
+    click.echo()
+    click.echo(capture.get('plan') or 'EXPLAIN failed: %s' % capture['error'])
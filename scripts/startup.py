@@ -0,0 +1,52 @@
+'''Where the time goes when the app starts.
+
+`app startup-profile` starts a new interpreter that times every import while
+it imports the app, creates it and imports the modules of the CLI commands,
+and reports the phases, the packages and the modules that took longest.
+'''
+import json
+import subprocess
+import sys
+from collections import defaultdict
+
+import click
+from flask.cli import pass_script_info
+
+from scripts.cli import cli
+
+
+@cli.command('startup-profile')
+@click.option('--limit', default=20, help='Show this many packages and '
+              'modules.')
+@pass_script_info
+def startup_profile(info, limit):
+    '''Show where the time goes when the app starts.
+
+    The commands are imported after the app is created, a command imports
+    only what the app didn't.
+    '''
+    output = subprocess.check_output([
+        sys.executable, '-m', 'scripts.importtimer',
+        info.data.get('config') or 'default'])
+    profile = json.loads(output)
+
+    click.echo('{:<32}{:>10}'.format('phase', 'time (ms)'))
+    for name, seconds in profile['phases']:
+        click.echo('{:<32}{:>10.1f}'.format(name, seconds * 1000))
+
+    packages = defaultdict(float)
+    for name, seconds, cumulative in profile['modules']:
+        packages[name.split('.', 1)[0]] += seconds
+    click.echo()
+    click.echo('{:<32}{:>10}'.format('package', 'time (ms)'))
+    for name, seconds in sorted(packages.iteritems(),
+                                key=lambda item: -item[1])[:limit]:
+        click.echo('{:<32}{:>10.1f}'.format(name, seconds * 1000))
+
+    click.echo()
+    click.echo('{:<48}{:>10}{:>16}'.format('module', 'time (ms)',
+                                           'with imports'))
+    for name, seconds, cumulative in sorted(profile['modules'],
+                                            key=lambda item: -item[1])[:limit]:
+        click.echo('{:<48}{:>10.1f}{:>16.1f}'.format(name, seconds * 1000,
+                                                     cumulative * 1000))
@@ -0,0 +1,212 @@
+import fractions
+import time
+from datetime import datetime
+
+import click
+import numpy as np
+
+from app import db as db_
+from app.models.meta import ddl
+from app.models.meta.columns import BcryptStr, Password
+from app.models.meta.ids import copy_text, copy_value, reserve_ids
+from app.models.models import render_description
+from scripts.db import db
+
+CATEGORIES = 'relaxatie concentratie associatie confrontatie overig'.split()
+DURATIONS = '[0,5)', '[5,15)', '[15,)'
+WORDS = ('adem', 'aandacht', 'ontspanning', 'spanning', 'geluid', 'lichaam',
+         'rust', 'oefening', 'gedachte', 'gevoel', 'moodboard', 'associatie',
+         'concentratie', 'buik', 'schouders', 'ogen', 'minuten', 'positief',
+         'emotie', 'kleur', 'vorm', 'beeld', 'stem', 'tempo', 'ruimte')
+# Exercises share a pool of descriptions, their html is rendered once.
+DESCRIPTIONS = 50
+ROWS_PER_CHUNK = 10000
+
+# Triggers that do per row what is recomputed once at the end. The triggers of
+# the full text search are cheap and stay.
+DISABLE_TRIGGERS = '''
+ALTER TABLE exercise DISABLE TRIGGER set_default_popularity;
+ALTER TABLE rating DISABLE TRIGGER set_ratings;
+ALTER TABLE rating DISABLE TRIGGER set_avg_trigger;
+'''
+ENABLE_TRIGGERS = DISABLE_TRIGGERS.replace('DISABLE', 'ENABLE')
+
+# The primary and foreign keys of the ratings are checked row by row while
+# copying, it is a lot faster to drop them and check all rows at once when they
+# are added back.
+RATING_CONSTRAINTS = '''
+SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+WHERE conrelid = 'rating'::regclass AND contype IN ('p', 'f')
+'''
+
+USER_COLUMNS = ('id', 'username', 'email', 'password', 'created_at',
+                'updated_at')
+EXERCISE_COLUMNS = ('id', 'title', 'description', 'description_html',
+                    'author_id', 'category_id', 'duration', 'difficulty',
+                    'created_at', 'updated_at')
+RATING_COLUMNS = ('user_id', 'exercise_id', 'fun', 'clear', 'effective',
+                  'rating', 'created_at', 'updated_at')
+
+
+def chunks(amount, size=ROWS_PER_CHUNK):
+    for start in xrange(0, amount, size):
+        yield start, min(start + size, amount)
+
+
+def sentence(random, length):
+    return ' '.join(WORDS[i] for i in random.randint(len(WORDS), size=length))
+
+
+def rating_values():
+    '''The text of every combination of fun, clear and effective and the
+    rating the trigger would give it, indexed by
+    `25 * (fun - 1) + 5 * (clear - 1) + effective - 1`.'''
+    return ['%d\t%d\t%d\t%r' % (fun, clear, effective,
+                                (fun + clear + effective) / 3.0)
+            for fun in xrange(1, 6)
+            for clear in xrange(1, 6)
+            for effective in xrange(1, 6)]
+
+
+def strides(amount):
+    '''Steps coprime to `amount`, each visits every index of a collection of
+    `amount` items before repeating one.'''
+    return np.array([step for step in xrange(1, min(amount, 10 ** 4) + 1)
+                     if fractions.gcd(step, amount) == 1], dtype=np.int64)
+
+
+def synth_categories(connection):
+    connection.execute(
+        'INSERT INTO category (name) SELECT unnest(%(names)s) '
+        'ON CONFLICT (name) DO NOTHING', names=CATEGORIES)
+    return np.array([id for id, in connection.execute(
+        'SELECT id FROM category WHERE name = ANY(%(names)s)',
+        names=CATEGORIES)], dtype=np.int64)
+
+
+def synth_users(connection, amount, password, now):
+    user_ids = reserve_ids(connection, amount)
+    line = '%d\tsynth%d\tsynth%d@example.com\t{}\t{}\t{}\n'.format(
+        copy_value(password), now, now)
+
+    def generate():
+        for start, stop in chunks(amount):
+            yield ''.join(line % (id, id, id)
+                          for id in user_ids[start:stop].tolist())
+
+    copy_text(connection, 'user', USER_COLUMNS, generate())
+    return user_ids
+
+
+def synth_exercises(connection, random, amount, user_ids, category_ids, now):
+    exercise_ids = reserve_ids(connection, amount)
+    descriptions = []
+    for i in xrange(DESCRIPTIONS):
+        description, html = render_description(sentence(random, 60))
+        descriptions.append(copy_value(description) + '\t' + copy_value(html))
+    description = random.randint(DESCRIPTIONS, size=amount).tolist()
+    author_id = user_ids[random.randint(len(user_ids), size=amount)].tolist()
+    category_id = category_ids[random.randint(len(category_ids),
+                                              size=amount)].tolist()
+    duration = random.randint(len(DURATIONS), size=amount).tolist()
+    difficulty = random.randint(3, size=amount).tolist()
+
+    def generate():
+        for i, id in enumerate(exercise_ids.tolist()):
+            yield '\t'.join((str(id),
+                             copy_value(sentence(random, 3)),
+                             descriptions[description[i]],
+                             str(author_id[i]),
+                             str(category_id[i]),
+                             DURATIONS[duration[i]],
+                             str(difficulty[i]),
+                             now, now)) + '\n'
+
+    copy_text(connection, 'exercise', EXERCISE_COLUMNS, generate())
+    return exercise_ids
+
+
+def synth_ratings(connection, random, user_ids, exercise_ids, per_user, now):
+    '''Every user rates `per_user` different exercises. A user rates the
+    exercises at a random start and stride, so no pair is drawn twice.'''
+    values = rating_values()
+    steps = strides(len(exercise_ids))
+    offsets = np.arange(per_user, dtype=np.int64)
+    line = '%d\t%d\t%s\t{}\t{}\n'.format(now, now)
+
+    def generate():
+        users_per_chunk = max(1, ROWS_PER_CHUNK // per_user)
+        for start, stop in chunks(len(user_ids), users_per_chunk):
+            users = user_ids[start:stop]
+            first = random.randint(len(exercise_ids), size=len(users))
+            step = steps[random.randint(len(steps), size=len(users))]
+            rated = exercise_ids[(first[:, None] + offsets * step[:, None]) %
+                                 len(exercise_ids)]
+            combinations = random.randint(len(values), size=rated.size)
+            yield ''.join(line % (user, exercise, values[combination])
+                          for user, exercise, combination in zip(
+                              np.repeat(users, per_user).tolist(),
+                              rated.ravel().tolist(),
+                              combinations.tolist()))
+
+    constraints = connection.execute(RATING_CONSTRAINTS).fetchall()
+    for name, definition in constraints:
+        connection.execute('ALTER TABLE rating DROP CONSTRAINT "%s"' % name)
+    copy_text(connection, 'rating', RATING_COLUMNS, generate())
+    for name, definition in constraints:
+        connection.execute('ALTER TABLE rating ADD CONSTRAINT "%s" %s' %
+                           (name, definition))
+
+
+@db.command()
+@click.option('--users', default=1000, help='Users to create.')
+@click.option('--exercises', default=100, help='Exercises to create.')
+@click.option('--ratings-per-user', default=10,
+              help='Exercises every user rates.')
+@click.option('--password', default='00000000',
+              help='Password of every user.')
+@click.option('--seed', type=int, help='Seed of the random generator.')
+def synth(users, exercises, ratings_per_user, password, seed):
+    '''Add a synthetic dataset of users, exercises and ratings.
+
+    Rows are streamed into the tables with COPY. The triggers that keep the
+    ratings of exercises up to date are disabled and the keys of the ratings
+    dropped while the ratings are copied, the ratings of the exercises are
+    computed and the keys checked once at the end. Run it when nothing else
+    writes to the database, the tables are locked until it is done.
+    '''
+    if ratings_per_user > exercises:
+        raise click.BadParameter('can not be more than the exercises.',
+                                 param_hint='ratings-per-user')
+
+    random = np.random.RandomState(seed)
+    now = datetime.utcnow().isoformat()
+    # one hash for everyone, a hash per user would take days
+    password = BcryptStr(password, rounds=Password.BCRYPT_ROUNDS)
+    start = time.time()
+
+    def done(message, *args):
+        click.echo('{:>8.1f}s {}'.format(time.time() - start,
+                                         message.format(*args)))
+
+    with db_.engine.begin() as connection:
+        connection.execute(DISABLE_TRIGGERS)
+        category_ids = synth_categories(connection)
+        user_ids = synth_users(connection, users, password, now)
+        done('Copied {} users', users)
+        exercise_ids = synth_exercises(connection, random, exercises,
+                                       user_ids, category_ids, now)
+        done('Copied {} exercises', exercises)
+        synth_ratings(connection, random, user_ids, exercise_ids,
+                      ratings_per_user, now)
+        done('Copied {} ratings', users * ratings_per_user)
+        connection.execute(ddl.recompute_exercise_ratings,
+                           ids=exercise_ids.tolist())
+        connection.execute(ENABLE_TRIGGERS)
+        done('Computed the ratings of the exercises')
+
+    connection = db_.engine.connect()
+    connection.execution_options(isolation_level='AUTOCOMMIT').execute(
+        'ANALYZE "user", exercise, rating')
+    connection.close()
+    done('Analyzed the tables')
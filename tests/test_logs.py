@@ -0,0 +1,114 @@
+import json
+import logging
+import threading
+import time
+
+from flask import Flask
+
+from app.lib.logs import JSONFormatter, LogQueue, QueueHandler, RequestId
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.unblock = threading.Event()
+        self.unblock.set()
+        self.writing = threading.Event()
+
+    def emit(self, record):
+        self.writing.set()
+        self.unblock.wait()
+        self.records.append(record)
+
+    def wait_for(self, n):
+        for _ in xrange(500):
+            if len(self.records) >= n:
+                break
+            time.sleep(0.01)
+        return self.records
+
+
+def make_logger(name, handler):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.handlers = [handler]
+    return logger
+
+
+def test_sampling():
+    target = ListHandler()
+    logger = make_logger(__name__ + '.sampled', QueueHandler(
+        target, LogQueue(), {__name__: 0}))
+
+    logger.info('sampled out')
+    logger.warning('kept')
+
+    assert [r.getMessage() for r in target.wait_for(1)] == ['kept']
+
+
+def test_drops_when_full():
+    target = ListHandler()
+    target.unblock.clear()
+    logger = make_logger(__name__ + '.full',
+                         QueueHandler(target, LogQueue(size=1)))
+
+    logger.info('written')
+    # the writer waits in the target with the queue empty
+    assert target.writing.wait(5)
+    logger.info('queued')
+    logger.info('dropped')
+    logger.info('dropped')
+    target.unblock.set()
+
+    messages = [r.getMessage() for r in target.wait_for(3)]
+    assert messages == ['written',
+                        'Dropped 2 log records, the log queue was full.',
+                        'queued']
+
+
+def test_arguments_merged_by_caller():
+    class Thread(object):
+        def __repr__(self):
+            return threading.current_thread().name
+
+    target = ListHandler()
+    logger = make_logger(__name__ + '.arguments',
+                         QueueHandler(target, LogQueue()))
+
+    logger.info('logged by %r', Thread())
+
+    record, = target.wait_for(1)
+    assert record.args is None
+    assert record.getMessage() == \
+        'logged by %s' % threading.current_thread().name
+
+
+def test_request_id():
+    app = Flask(__name__)
+    RequestId(app)
+    target = ListHandler()
+    target.setFormatter(JSONFormatter())
+    logger = make_logger(__name__ + '.request', QueueHandler(target,
+                                                             LogQueue()))
+
+    @app.route('/')
+    def index():
+        logger.info('in a request', extra=dict(data=dict(answer=42)))
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.exception('failed')
+        return ''
+
+    rv = app.test_client().get('/', headers={'X-Request-Id': 'abc'})
+    assert rv.headers['X-Request-Id'] == 'abc'
+    info, error = [json.loads(target.format(r)) for r in target.wait_for(2)]
+    assert info['request_id'] == error['request_id'] == 'abc'
+    assert info['elapsed_ms'] >= 0
+    assert info['data'] == dict(answer=42)
+    assert 'ZeroDivisionError' in error['exception']
+
+    rv = app.test_client().get('/')
+    assert len(rv.headers['X-Request-Id']) == 32
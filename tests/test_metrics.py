@@ -0,0 +1,64 @@
+import os
+
+from app.lib.metrics import (
+    CounterMetric,
+    GaugeMetric,
+    HistogramMetric,
+    Registry,
+    ValueFile,
+)
+
+
+def test_value_file(tmpdir):
+    path = str(tmpdir.join('metrics.1.db'))
+    values = ValueFile(path)
+    keys = ['key%s' % i * 100 for i in xrange(1000)]
+    for i, key in enumerate(keys):
+        values.set(key, i)
+    values.set(keys[0], values.get(keys[0]) + 0.5)
+
+    assert values.size > ValueFile.INITIAL_SIZE
+    expected = [(key, float(i)) for i, key in enumerate(keys)]
+    expected[0] = (keys[0], 0.5)
+    assert ValueFile.read(path) == expected
+    # a restarted process continues where it was
+    assert ValueFile(path).get(keys[1]) == 1.0
+
+
+def test_processes_are_added_up(tmpdir):
+    registry = Registry()
+    registry.directory = str(tmpdir)
+    requests = CounterMetric('requests_total', 'Requests.', ['status'],
+                             registry=registry)
+    connections = GaugeMetric('connections', 'Connections.', registry=registry)
+    requests.inc(status=200)
+    connections.inc(2)
+
+    # a process that exited
+    pid = 2 ** 22 + 1
+    assert not os.path.exists('/proc/%s' % pid)
+    values = ValueFile(str(tmpdir.join('metrics.%s.db' % pid)))
+    values.set(requests.keys(dict(status=200)), 3)
+    values.set(connections.keys({}), 5)
+
+    lines = registry.render().splitlines()
+    assert 'requests_total{status="200"} 4.0' in lines
+    assert 'connections 2.0' in lines
+
+
+def test_histogram():
+    registry = Registry()
+    latency = HistogramMetric('latency_seconds', 'Latency.', ['endpoint'],
+                              buckets=(0.1, 1), registry=registry)
+    for value in (0.05, 0.5, 0.5, 5):
+        latency.observe(value, endpoint='get')
+
+    assert registry.render().splitlines() == [
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{endpoint="get",le="0.1"} 1.0',
+        'latency_seconds_bucket{endpoint="get",le="1"} 3.0',
+        'latency_seconds_bucket{endpoint="get",le="+Inf"} 4.0',
+        'latency_seconds_sum{endpoint="get"} 6.05',
+        'latency_seconds_count{endpoint="get"} 4.0',
+    ]
@@ -0,0 +1,32 @@
+from app.lib.profiler import fingerprint, Profile
+
+
+def test_fingerprint_parameters():
+    a = fingerprint('SELECT * FROM user WHERE user.id = %(param_1)s')
+    b = fingerprint('SELECT * FROM user\nWHERE user.id =  %(param_2)s')
+    assert a == b == 'SELECT * FROM user WHERE user.id = ?'
+
+
+def test_fingerprint_literals():
+    a = fingerprint("SELECT * FROM user WHERE id = 1 AND name = 'it''s'")
+    b = fingerprint("SELECT * FROM user WHERE id = 22 AND name = 'x'")
+    assert a == b
+
+
+def test_fingerprint_in_list():
+    a = fingerprint('SELECT * FROM user WHERE id IN (%(id_1)s, %(id_2)s)')
+    b = fingerprint('SELECT * FROM user WHERE id IN (%(id_1)s)')
+    assert a == b == 'SELECT * FROM user WHERE id IN (...)'
+
+
+def test_n_plus_one():
+    profile = Profile()
+    for i in xrange(3):
+        profile.add('SELECT * FROM user WHERE id = %s' % i, 0.001)
+    profile.add('SELECT * FROM exercise', 0.001)
+    profile.add('UPDATE user SET x = 1', 0.001)
+    profile.add('UPDATE user SET x = 2', 0.001)
+    profile.add('UPDATE user SET x = 3', 0.001)
+
+    assert profile.statements == 7
+    assert profile.n_plus_one(3) == [('SELECT * FROM user WHERE id = ?', 3)]
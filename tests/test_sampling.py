@@ -0,0 +1,70 @@
+import sys
+import time
+
+from flask import Flask
+
+from app.lib.sampling import collapse, SamplingProfiler
+
+
+def busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+def make_app(tmpdir, **config):
+    app = Flask(__name__)
+    app.config.update(SECRET_KEY='secret',
+                      SAMPLING_PROFILER_INTERVAL=0.001,
+                      SAMPLING_PROFILER_DIR=str(tmpdir),
+                      **config)
+
+    @app.route('/busy')
+    def work():
+        busy(0.05)
+        return ''
+    return app, SamplingProfiler(app)
+
+
+def test_collapse():
+    def inner():
+        return collapse(sys._getframe(), outer.__code__)
+
+    def outer():
+        return middle()
+
+    def middle():
+        return inner()
+
+    assert outer() == '{0}:middle;{0}:inner'.format(__name__)
+
+
+def test_unsampled_requests(tmpdir):
+    app, profiler = make_app(tmpdir)
+    app.test_client().get('/busy')
+    app.test_client().get('/busy', headers={SamplingProfiler.HEADER: 'bad'})
+    assert not profiler.stacks
+
+
+def test_signed_requests(tmpdir):
+    app, profiler = make_app(tmpdir)
+    rv = app.test_client().get('/busy', headers={
+        SamplingProfiler.HEADER: profiler.token()})
+    assert rv.status_code == 200
+
+    stacks = profiler.stacks['work']
+    assert stacks
+    assert all(stack.startswith('flask.app:wsgi_app;') for stack in stacks)
+    assert any(stack.endswith('{0}:work;{0}:busy'.format(__name__))
+               for stack in stacks)
+
+    profiler.flush()
+    lines = tmpdir.join('profile.%s.collapsed' % profiler.pid).readlines()
+    assert sorted(line.strip() for line in lines) == \
+        sorted(profiler.collapsed())
+
+
+def test_sample_rate(tmpdir):
+    app, profiler = make_app(tmpdir, SAMPLING_PROFILER_RATE=1)
+    app.test_client().get('/busy')
+    assert profiler.stacks['work']
@@ -0,0 +1,36 @@
+import time
+
+from flask import Flask, g
+
+from app.lib.timing import span, timed, Timings
+
+
+def test_nested_spans():
+    app = Flask(__name__)
+
+    @timed('inner')
+    def inner():
+        time.sleep(0.02)
+
+    with app.app_context():
+        g.timings = timings = Timings()
+        with span('outer'):
+            time.sleep(0.01)
+            inner()
+            inner()
+        summary = dict(timings.summary(0.1))
+
+    # the outer phase doesn't count the time of the inner one
+    assert 10 <= summary['outer'] < 20
+    assert 40 <= summary['inner'] < 50
+    assert abs(summary['other'] + summary['outer'] + summary['inner'] -
+               100) < 1e-6
+
+
+def test_without_timings():
+    app = Flask(__name__)
+    with span('outside'):
+        pass
+    with app.app_context():
+        with span('untimed'):
+            pass
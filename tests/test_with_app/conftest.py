@@ -6,6 +6,7 @@ import pytest
 from app import (
     create_app,
     db,
+    lib,
     models,
 )
 
@@ -37,6 +38,23 @@ def session(connection, request):
     transaction.rollback()
 
 
+@pytest.fixture(scope='function')
+def query_budget(session):
+    '''Fails a block that executes more statements than its budget.
+
+    >>> with query_budget(2):
+    >>>     client.get('/v1/users')
+    '''
+    return lib.query_budget
+
+
+@pytest.yield_fixture(scope='function')
+def strict_loading(session):
+    '''Lazy loads that emit SQL raise a StrictLoadingError.'''
+    with db.strict_loading():
+        yield
+
+
 @pytest.yield_fixture(scope='function')
 def user(session):
     user = models.User(
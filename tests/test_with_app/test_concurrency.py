@@ -0,0 +1,88 @@
+'''Requests served by many threads of one process at once, like a uwsgi
+worker with `threads`. The data is committed for real, every thread needs a
+connection of its own.'''
+import json
+import threading
+
+import pytest
+
+from app import db, hashid, models
+
+THREADS = 8
+ROUNDS = 10
+
+
+@pytest.yield_fixture(scope='function')
+def committed(connection):
+    db.session.configure(bind=db.engine)
+    users = [models.User(username='worker%s' % i, password='00000000')
+             for i in xrange(THREADS)]
+    exercise = models.Exercise(title='shared', description='shared',
+                               author=users[0])
+    db.session.add_all(users + [exercise])
+    db.session.commit()
+    tokens = [user.generate_auth_token()['access_token'] for user in users]
+    yield tokens, hashid.encode(exercise.id)
+
+    db.session.remove()
+    with db.engine.begin() as conn:
+        conn.execute('TRUNCATE %s CASCADE' % ', '.join(
+            '"%s"' % table.name
+            for table in models.Base.metadata.sorted_tables))
+
+
+def hammer(app, target):
+    '''Run `target(client, i)` in THREADS threads, return the exceptions.'''
+    errors = []
+
+    def run(i):
+        try:
+            target(app.test_client(), i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in xrange(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def test_current_user_per_thread(app, committed):
+    tokens, exercise_id = committed
+
+    def target(client, i):
+        headers = {'Authorization': 'Bearer %s' % tokens[i]}
+        for _ in xrange(ROUNDS):
+            rv = client.get('/v1/users/profile', headers=headers)
+            assert rv.status_code == 200
+            assert json.loads(rv.data)['data']['username'] == 'worker%s' % i
+
+    assert hammer(app, target) == []
+
+
+def test_concurrent_writes(app, committed):
+    tokens, exercise_id = committed
+
+    def target(client, i):
+        headers = {'Authorization': 'Bearer %s' % tokens[i]}
+        for round in xrange(ROUNDS):
+            fun = (i + round) % 5 + 1
+            rv = client.post('/v1/exercises/%s/ratings' % exercise_id,
+                             data=json.dumps(dict(fun=fun, clear=1,
+                                                  effective=1)),
+                             headers=headers,
+                             content_type='application/json')
+            assert rv.status_code == 204
+            rv = client.get('/v1/exercises/%s' % exercise_id, headers=headers)
+            assert rv.status_code == 200
+            assert json.loads(rv.data)['meta']['user_rating']['fun'] == fun
+            assert client.get('/v1/exercises').status_code == 200
+
+    checked_out = db.engine.pool.checkedout()
+    assert hammer(app, target) == []
+    # every thread returned its connection
+    assert db.engine.pool.checkedout() == checked_out
+    assert models.Rating.query.count() == THREADS
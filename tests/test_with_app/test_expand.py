@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from app import models
+from app.models.meta.loading import batch_load
+from app.serializers.meta import parse_expand
+
+
+@pytest.yield_fixture(scope='function')
+def favorites(session):
+    users = [models.User(username='user%s' % i, password='00000000')
+             for i in xrange(3)]
+    exercises = [models.Exercise(title='title', description='description',
+                                 author=users[0]) for i in xrange(3)]
+    session.add_all(users + exercises)
+    session.flush()
+    for user in users:
+        user.favorite_exercises = exercises
+    session.commit()
+    yield users
+
+
+def test_parse_expand():
+    assert parse_expand(['author', 'favorite_exercises[limit=5]']) == \
+        (['author', 'favorite_exercises'], {'favorite_exercises': {'limit': '5'}})
+
+
+def test_expand_limit(app, favorites, query_budget):
+    # count, users, favorites and their exercises
+    with query_budget(4), app.test_client() as client:
+        rv = client.get('/v1/users?expand=favorite_exercises[limit=2]')
+    assert rv.status_code == 200
+
+    for user in json.loads(rv.data)['items']:
+        favorites = user['related']['favorite_exercises']
+        assert len(favorites['items']) == 2
+        assert favorites['href'].endswith('/favorites')
+
+
+def test_expand_without_limit(app, favorites):
+    with app.test_client() as client:
+        rv = client.get('/v1/users?expand=favorite_exercises')
+    for user in json.loads(rv.data)['items']:
+        assert len(user['related']['favorite_exercises']) == 3
+
+
+def test_expand_invalid_limit(app, favorites):
+    with app.test_client() as client:
+        rv = client.get('/v1/users?expand=favorite_exercises[limit=0]')
+    assert rv.status_code == 400
+
+
+def test_batch_load_criterion(favorites, session):
+    author = favorites[0]
+    author.authored_exercises[0].title = 'other'
+    session.commit()
+    session.expire_all()
+
+    users = models.User.query.all()
+    batch_load(users, 'authored_exercises', limit=1,
+               criterion=models.Exercise.title == 'title')
+    authored = [user for user in users if user.id == author.id][0].__dict__
+    assert [e.title for e in authored['authored_exercises']] == ['title']
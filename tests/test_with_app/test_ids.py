@@ -0,0 +1,66 @@
+from StringIO import StringIO
+
+import numpy as np
+
+from app import models
+from app.models.meta.columns import looping_id_function_ddl
+from app.models.meta.ids import copy_rows, obscure_ids, reserve_ids
+
+DIFFERENT_IDS = '''
+SELECT count(*) FROM generate_series(:start, :stop) AS value
+WHERE obscure_id(value) <> pg_temp.looping_obscure_id(value)
+'''
+
+
+def test_obscure_id_unchanged(app, session):
+    session.connection().execute(looping_id_function_ddl.format(
+        id_function_signature='pg_temp.looping_obscure_id(value bigint)',
+        coprime=app.config['OBSCURE_ID_KEY'],
+        modulus=app.config['OBSCURE_ID_MODULUS']))
+    # ids are integers, the sequence never goes beyond 2 ** 31 - 1
+    for start, stop in ((0, 100000), (2 ** 31 - 100000, 2 ** 31 - 1)):
+        assert session.execute(DIFFERENT_IDS, dict(
+            start=start, stop=stop)).scalar() == 0
+
+
+def test_sequence_cache(app, session):
+    cache = session.execute('SELECT cache_size FROM pg_sequences '
+                            "WHERE sequencename = 'global_id_seq'").scalar()
+    assert cache == app.config['OBSCURE_ID_SEQUENCE_CACHE']
+
+
+def sql_obscure_ids(session, start, stop):
+    '''Fetch `obscure_id` of a range of values, with COPY because millions
+    of rows are too slow to fetch as result rows.'''
+    stream = StringIO()
+    cursor = session.connection().connection.cursor()
+    cursor.copy_expert('COPY (SELECT obscure_id(value) FROM generate_series('
+                       '%s, %s) AS value) TO STDOUT' % (start, stop), stream)
+    return np.fromstring(stream.getvalue(), dtype=np.int64, sep='\n')
+
+
+def test_obscure_ids(app, session):
+    for start, stop in ((0, 2 * 10 ** 6), (2 ** 31 - 10 ** 6, 2 ** 31 - 1)):
+        values = np.arange(start, stop + 1, dtype=np.int64)
+        assert np.array_equal(obscure_ids(values),
+                              sql_obscure_ids(session, start, stop))
+
+
+def test_reserve_ids(session):
+    connection = session.connection()
+    last = connection.execute("SELECT nextval('global_id_seq')").scalar()
+    ids = reserve_ids(connection, 3)
+    assert list(ids) == list(obscure_ids([last + 1, last + 2, last + 3]))
+
+
+def test_copy_rows(session):
+    connection = session.connection()
+    user_ids = reserve_ids(connection, 2)
+    copy_rows(connection, 'user', ('id', 'username', 'password', 'email'), [
+        (user_ids[0], 'tab\tnew\nline', 'password', None),
+        (user_ids[1], 'back\\slash', 'password', 'email'),
+    ])
+    users = {user.id: user for user in models.User.query}
+    assert users[user_ids[0]].username == 'tab\tnew\nline'
+    assert users[user_ids[0]].email is None
+    assert users[user_ids[1]].username == 'back\\slash'
@@ -0,0 +1,12 @@
+def test_metrics(app, user):
+    with app.test_client() as client:
+        client.get('/v1/users')
+        rv = client.get('/metrics')
+    assert rv.status_code == 200
+    lines = rv.data.splitlines()
+    assert any(line.startswith('http_request_duration_seconds_count{'
+                               'endpoint="v1.get_users",status="200"}')
+               for line in lines)
+    assert any(line.startswith('db_statement_duration_seconds_count ')
+               for line in lines)
+    assert 'db_pool_checked_out' in rv.data
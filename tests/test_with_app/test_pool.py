@@ -0,0 +1,27 @@
+import threading
+
+from flask import g
+from sqlalchemy import create_engine
+
+from app import db
+from app.models.meta.orm import TimedQueuePool
+
+
+def test_pool_wait_header(app, user, session):
+    with app.test_client() as client:
+        rv = client.get('/v1/users')
+    assert float(rv.headers[db.POOL_WAIT_HEADER]) >= 0
+
+
+def test_pool_wait(app):
+    engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'],
+                           poolclass=TimedQueuePool,
+                           pool_size=1,
+                           max_overflow=0)
+    connection = engine.connect()
+    threading.Timer(0.2, connection.close).start()
+    with app.app_context():
+        # waits for the connection that is closed by the timer
+        engine.connect().close()
+        assert g.db_pool_wait >= 0.2
+    engine.dispose()
@@ -0,0 +1,22 @@
+from app import models, sql_profiler
+from app.lib import SQLProfiler
+
+
+def test_profile_header(app, user, session):
+    with app.test_client() as client:
+        rv = client.get('/v1/users')
+    assert rv.headers[SQLProfiler.HEADER].startswith('statements=2;')
+
+
+def test_n_plus_one_header(app, session):
+    users = [models.User(username='user%s' % i, password='00000000')
+             for i in xrange(3)]
+    session.add_all(users)
+    session.commit()
+
+    with app.test_request_context('/'):
+        sql_profiler.start()
+        for user in models.User.query.all():
+            user.authored_exercises
+        rv = sql_profiler.finish(app.response_class())
+    assert rv.headers[SQLProfiler.HEADER].endswith('n+1=1')
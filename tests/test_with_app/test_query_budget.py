@@ -0,0 +1,64 @@
+import pytest
+
+from app import db, models
+from app.lib import QueryBudgetExceeded
+from app.models.meta.loading import StrictLoadingError
+
+
+@pytest.yield_fixture(scope='function')
+def authors(session):
+    users = [models.User(username='user%s' % i, password='00000000')
+             for i in xrange(3)]
+    session.add_all(users)
+    session.add_all(models.Exercise(title='title', description='description',
+                                    author=user) for user in users)
+    session.commit()
+    yield users
+
+
+def test_budget_exceeded(session, query_budget):
+    with pytest.raises(QueryBudgetExceeded):
+        with query_budget(1):
+            models.User.query.all()
+            models.User.query.all()
+
+
+def test_get_users_budget(app, authors, query_budget):
+    with query_budget(2), app.test_client() as client:
+        rv = client.get('/v1/users')
+    assert rv.status_code == 200
+
+
+def test_get_exercises_budget(app, authors, query_budget):
+    with query_budget(2), app.test_client() as client:
+        rv = client.get('/v1/exercises?expand=author')
+    assert rv.status_code == 200
+
+
+def test_get_users_expanded_budget(app, authors, query_budget):
+    with query_budget(3), app.test_client() as client:
+        rv = client.get('/v1/users?expand=authored_exercises')
+    assert rv.status_code == 200
+
+
+def test_get_users_expanded_favorites_budget(app, authors, session,
+                                             query_budget):
+    exercises = models.Exercise.query.all()
+    for user in authors:
+        user.favorite_exercises = exercises
+    session.commit()
+
+    with query_budget(5), db.strict_loading(), app.test_client() as client:
+        rv = client.get('/v1/users?expand=favorite_exercises,authored_exercises')
+    assert rv.status_code == 200
+
+
+def test_strict_loading_raises(user, exercise, strict_loading):
+    with pytest.raises(StrictLoadingError):
+        user.authored_exercises
+
+
+def test_strict_loading_allows_identity_map(user, exercise, strict_loading):
+    # column loads are fine, refresh the expired ids.
+    exercise.author_id, user.id
+    assert exercise.author is user
@@ -1,11 +1,11 @@
+import json
+from datetime import datetime
 import random
 
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.sql import func
-
 import pytest
 
-from app import models
+from app import hashid, models
+from app.models.meta import ddl
 
 
 def generate_response(questionnaire):
@@ -20,23 +20,73 @@ def generate_response(questionnaire):
 def test_no_two_answers_for_one_question(amisos, user, session):
     resp = generate_response(amisos)
     resp['choices'][1]['question_id'] = resp['choices'][0]['question_id']
-    user.fill_in_questionnaire(amisos, **resp)
-    with pytest.raises(IntegrityError):
-        session.commit()
+    with pytest.raises(ValueError):
+        user.fill_in_questionnaire(amisos, **resp)
 
 
-def test_response_score(amisos, user, session):
+def test_response_answers(amisos, user, session):
     resp = generate_response(amisos)
-    user.fill_in_questionnaire(amisos, **resp)
+    response = user.fill_in_questionnaire(amisos, **resp)
     session.commit()
 
-    score = session.query(func.sum(models.Choice.value)).\
-        join(models.QuestionnaireResponse).\
+    answers = session.query(models.QuestionnaireResponse.answers).\
         filter(models.QuestionnaireResponse.user_id == user.id).\
-        group_by(models.QuestionnaireResponse.id).\
         scalar()
 
-    assert score == sum(c['value'] for c in resp['choices'])
+    assert answers == [c['value'] for c in resp['choices']]
+    assert [c._asdict() for c in response.choices] == resp['choices']
+
+
+def test_response_keeps_its_questions(amisos, user, session):
+    resp = generate_response(amisos)
+    response = user.fill_in_questionnaire(amisos, **resp)
+    session.commit()
+
+    # a new version without the first question
+    amisos.questions.pop(0)
+    amisos.version += 1
+    session.commit()
+    assert len(amisos.definition.questions) == len(resp['choices']) - 1
+    assert [c._asdict() for c in response.choices] == resp['choices']
+    assert response.total == sum(c['value'] for c in resp['choices'])
+
+
+def test_response_answers_mismatch(amisos, user, session):
+    response = user.fill_in_questionnaire(amisos, **generate_response(amisos))
+    response.question_ids = response.question_ids[1:]
+    with pytest.raises(ValueError):
+        response.choices
+
+
+def test_response_without_answers(amisos, user, session):
+    response = models.QuestionnaireResponse(user_id=user.id,
+                                            questionnaire_id=amisos.id)
+    assert response.choices is None
+
+
+def test_choices_to_answers(amisos, user, session):
+    '''The migration of choice rows, in the test transaction.'''
+    answered = user.fill_in_questionnaire(amisos, **generate_response(amisos))
+    unanswered = user.fill_in_questionnaire(amisos,
+                                            **generate_response(amisos))
+    session.flush()
+    session.execute('CREATE TABLE choice '
+                    '(response_id integer, question_id integer, value integer)')
+    # the rows in reverse order of the questions
+    for choice in reversed(answered.choices):
+        session.execute('INSERT INTO choice VALUES (:id, :question, :value)',
+                        dict(id=answered.id, question=choice.question_id,
+                             value=choice.value))
+    expected = answered.answers, answered.question_ids
+    session.execute(models.QuestionnaireResponse.__table__.update().values(
+        answers=None, question_ids=None))
+
+    session.connection().execute(ddl.choices_to_answers)
+    rows = dict((id, (answers, question_ids)) for id, answers, question_ids in
+                session.execute('SELECT id, answers, question_ids '
+                                'FROM questionnaire_response'))
+    assert rows == {answered.id: expected, unanswered.id: (None, None)}
+    assert session.execute("SELECT to_regclass('choice_backup')").scalar()
 
 
 def test_delete_questionnaire(user, amisos, session):
@@ -75,3 +125,168 @@ def test_questionnaire_response_score(user, amisos, session):
     assert [resp1.score.name,
             resp2.score.name,
             resp3.score.name] == ['subklinisch', 'ernstig', 'matig']
+
+
+def test_response_total(user, amisos, session):
+    resp = generate_response(amisos)
+    response = user.fill_in_questionnaire(amisos, **resp)
+    session.commit()
+    assert response.total == sum(c['value'] for c in resp['choices'])
+
+
+def test_get_responses_budget(app, user, amisos, session, query_budget):
+    for i in xrange(3):
+        user.fill_in_questionnaire(amisos, **generate_response(amisos))
+    session.commit()
+    token = user.generate_auth_token()['access_token']
+    url = '/v1/questionnaires/%s/responses' % hashid.encode(amisos.id)
+
+    # the questionnaire, the count and the page with the scores
+    with query_budget(3), app.test_client() as client:
+        rv = client.get(url, headers=dict(Authorization='Bearer %s' % token))
+    assert rv.status_code == 200
+    assert all(item['meta']['score'] for item in json.loads(rv.data)['items'])
+
+
+def test_definition(amisos):
+    definition = amisos.definition
+    assert definition is amisos.definition
+    assert [q.id for q in definition.questions] == [q.id for q in amisos.questions]
+    assert definition.max_score == sum(max(o.value for o in q.options)
+                                       for q in amisos.questions)
+
+
+def test_get_questionnaires_budget(app, user, amisos, session, query_budget):
+    user.fill_in_questionnaire(amisos, **generate_response(amisos))
+    session.commit()
+    headers = dict(Authorization='Bearer %s' %
+                   user.generate_auth_token()['access_token'])
+    url = '/v1/questionnaires?expand=responses'
+
+    with app.test_client() as client:
+        client.get(url, headers=headers)
+        # the definitions are cached, the count, the page and the responses
+        with query_budget(3):
+            rv = client.get(url, headers=headers)
+    questionnaire, = json.loads(rv.data)['items']
+    assert len(questionnaire['related']['responses']) == 1
+
+
+def test_post_response_invalid_value(app, user, amisos, session):
+    resp = generate_response(amisos)
+    for choice in resp['choices']:
+        choice['question_id'] = hashid.encode(choice['question_id'])
+    resp['choices'][0]['value'] = 100
+    headers = {'Authorization': 'Bearer %s' %
+               user.generate_auth_token()['access_token'],
+               'Content-Type': 'application/json'}
+    url = '/v1/questionnaires/%s/responses' % hashid.encode(amisos.id)
+
+    with app.test_client() as client:
+        rv = client.post(url, data=json.dumps(resp), headers=headers)
+    assert rv.status_code == 400
+
+
+@pytest.yield_fixture(scope='function')
+def history(user, amisos, session):
+    '''Responses with totals 0, 10 and 20, two in january and one in march.'''
+    dates = [datetime(2016, 1, 1), datetime(2016, 1, 20), datetime(2016, 3, 1)]
+    for created_at, value in zip(dates, [0, 1, 2]):
+        choices = [dict(question_id=question.id, value=value)
+                   for question in amisos.questions]
+        user.fill_in_questionnaire(amisos, choices=choices,
+                                   created_at=created_at)
+    session.commit()
+    yield amisos
+
+
+def get_progress(app, user, questionnaire, query=''):
+    token = user.generate_auth_token()['access_token']
+    url = '/v1/questionnaires/%s/progress%s' % (hashid.encode(questionnaire.id),
+                                                query)
+    with app.test_client() as client:
+        return client.get(url, headers=dict(Authorization='Bearer %s' % token))
+
+
+def test_progress(app, user, history, query_budget):
+    # the expired user, the questionnaire and the progress
+    with query_budget(3):
+        rv = get_progress(app, user, history, '?window=2')
+    items = json.loads(rv.data)['items']
+    assert [item['total'] for item in items] == [0, 10, 20]
+    assert [item['delta'] for item in items] == [None, 10, 10]
+    assert [item['moving_average'] for item in items] == [0, 5, 15]
+    assert [item['score'] for item in items] == ['subklinisch', 'matig', 'ernstig']
+
+
+def test_progress_per_month(app, user, history):
+    rv = get_progress(app, user, history, '?bucket=month')
+    items = json.loads(rv.data)['items']
+    assert [(item['total'], item['responses']) for item in items] == \
+        [(5, 2), (20, 1)]
+
+
+def test_progress_invalid_bucket(app, user, history):
+    rv = get_progress(app, user, history, '?bucket=day')
+    assert rv.status_code == 400
+
+
+def post_responses(app, user, responses):
+    headers = {'Authorization': 'Bearer %s' %
+               user.generate_auth_token()['access_token'],
+               'Content-Type': 'application/json'}
+    with app.test_client() as client:
+        return client.post('/v1/questionnaires/responses', headers=headers,
+                           data=json.dumps(dict(responses=responses)))
+
+
+def offline_response(questionnaire, key, created_at=None):
+    response = generate_response(questionnaire)
+    for choice in response['choices']:
+        choice['question_id'] = hashid.encode(choice['question_id'])
+    response.update(questionnaire_id=hashid.encode(questionnaire.id),
+                    idempotency_key=key)
+    if created_at:
+        response.update(created_at=created_at)
+    return response
+
+
+def test_post_responses(app, user, amisos, session, query_budget):
+    responses = [offline_response(amisos, 'a', '2016-01-01T12:00:00+02:00'),
+                 offline_response(amisos, 'b')]
+    amisos.definition
+    # the expired user, the questionnaires, the known keys and the insert
+    with query_budget(4):
+        rv = post_responses(app, user, responses)
+    assert rv.status_code == 201
+    assert all(item['created'] for item in json.loads(rv.data)['items'])
+    response = session.query(models.QuestionnaireResponse).\
+        filter_by(idempotency_key='b').one()
+    assert [c._asdict() for c in response.choices] == [
+        dict(question_id=hashid.decode(c['question_id'])[0], value=c['value'])
+        for c in responses[1]['choices']]
+
+    created_at = session.query(models.QuestionnaireResponse.created_at).\
+        filter_by(idempotency_key='a').scalar()
+    assert created_at == datetime(2016, 1, 1, 10)
+
+
+def test_post_responses_idempotent(app, user, amisos, session):
+    responses = [offline_response(amisos, 'a')]
+    first = json.loads(post_responses(app, user, responses).data)['items']
+
+    responses.append(offline_response(amisos, 'b'))
+    rv = post_responses(app, user, responses)
+    second = json.loads(rv.data)['items']
+    assert rv.status_code == 201
+    assert second[0] == dict(first[0], created=False)
+    assert second[1]['created']
+    assert session.query(models.QuestionnaireResponse).count() == 2
+
+
+def test_post_responses_invalid(app, user, amisos, session):
+    invalid = offline_response(amisos, 'b')
+    invalid['choices'].pop()
+    rv = post_responses(app, user, [offline_response(amisos, 'a'), invalid])
+    assert rv.status_code == 400
+    assert session.query(models.QuestionnaireResponse).count() == 0
@@ -1,4 +1,5 @@
 from app.models import Exercise, User, Rating
+from app.models.meta import ddl
 
 
 def test_give_rating(session):
@@ -69,3 +70,29 @@ def test_avarage_rating(session):
     # ghetto way of ignoring the last bunch of decimal points. SQL
     # rounds differently than python.
     assert ex_id == ex.id and int(avg_rating * 1000) == int(AV * 1000)
+
+
+def test_recompute_exercise_ratings(session):
+    users = [User(username='user%s' % i, password='00000000')
+             for i in xrange(6)]
+    exercises = [Exercise(title='title%s' % i, description='desc')
+                 for i in xrange(3)]
+    session.add_all(users + exercises)
+    session.flush()
+    for i, user in enumerate(users):
+        for exercise in exercises[:i % 3]:
+            session.add(Rating(fun=i % 5 + 1, clear=(i * 2) % 5 + 1,
+                               effective=(i * 3) % 5 + 1,
+                               user_id=user.id, exercise_id=exercise.id))
+    session.commit()
+
+    columns = (Exercise.popularity, Exercise.avg_rating, Exercise.avg_fun_rating,
+               Exercise.avg_clear_rating, Exercise.avg_effective_rating)
+    ids = [exercise.id for exercise in exercises]
+    # what the triggers computed, exercises without ratings only have a
+    # popularity
+    by_triggers = session.query(Exercise.id, *columns).order_by(Exercise.id).all()
+
+    session.connection().execute(ddl.recompute_exercise_ratings, ids=ids)
+    recomputed = session.query(Exercise.id, *columns).order_by(Exercise.id).all()
+    assert recomputed == by_triggers
@@ -0,0 +1,60 @@
+import pytest
+
+from app import db, models
+from app.lib import query_budget
+from app.models.meta.loading import StrictLoadingError
+
+
+@pytest.yield_fixture(scope='function')
+def engine_session(connection):
+    '''A session bound to the engine instead of the test transaction, so it
+    starts and ends its own transactions.'''
+    db.session.remove()
+    db.session.configure(bind=db.engine)
+    yield db.session
+    db.session.remove()
+
+
+def test_get_is_read_only(app, engine_session):
+    with app.test_request_context('/', method='GET'):
+        assert engine_session.execute('SHOW transaction_read_only').scalar() == 'on'
+
+
+def test_post_is_not_read_only(app, engine_session):
+    with app.test_request_context('/', method='POST'):
+        assert engine_session.execute('SHOW transaction_read_only').scalar() == 'off'
+
+
+def test_release_returns_connection(app, engine_session):
+    pool = db.engine.pool
+    with app.test_request_context('/', method='GET'):
+        checkedout = pool.checkedout()
+        engine_session.execute('SELECT 1')
+        assert pool.checkedout() == checkedout + 1
+        db.release_read_only()
+        assert pool.checkedout() == checkedout
+
+
+def test_release_keeps_loaded_state(app, user, session):
+    with app.test_request_context('/', method='GET'):
+        user = session.query(type(user)).get(user.id)
+        db.release_read_only()
+        assert 'username' in user.__dict__
+
+
+def test_lazy_load_after_release_raises(app, user, exercise, session):
+    session.expire_all()
+    # the fixtures flushed, a request starts with a new session
+    session().use_primary = False
+    with app.test_request_context('/', method='GET'):
+        user = session.query(models.User).get(user.id)
+        db.release_read_only()
+        with pytest.raises(StrictLoadingError):
+            user.authored_exercises
+    # outside of the request it loads
+    assert user.authored_exercises == [exercise]
+
+
+def test_set_transaction_not_in_budget(app, engine_session):
+    with app.test_request_context('/', method='GET'), query_budget(1):
+        engine_session.execute('SELECT 1')
@@ -0,0 +1,126 @@
+import threading
+
+import pytest
+
+from app import db
+from app.models import User
+from app.models.meta.orm import Replica, RoutingSession
+
+
+class FakeDatabase(object):
+    def __init__(self, engine, replicas):
+        self.engine = engine
+        self.replicas = replicas
+
+    def choose_replica(self):
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if healthy:
+            return healthy[0]
+
+
+@pytest.yield_fixture(scope='function')
+def replica(connection):
+    # the test database is its own replica, it is not in recovery so it never
+    # lags.
+    replica = Replica(db.create_engine())
+    yield replica
+    replica.engine.dispose()
+
+
+@pytest.yield_fixture(scope='function')
+def routing_session(replica):
+    session = RoutingSession(db=FakeDatabase(db.engine, [replica]),
+                             bind=db.engine)
+    yield session
+    session.rollback()
+    session.close()
+
+
+def test_get_reads_from_replica(app, replica, routing_session):
+    with app.test_request_context('/', method='GET'):
+        assert routing_session.get_bind(User.__mapper__) is replica.engine
+
+
+def test_post_reads_from_primary(app, routing_session):
+    with app.test_request_context('/', method='POST'):
+        assert routing_session.get_bind(User.__mapper__) is db.engine
+
+
+def test_outside_request_reads_from_primary(routing_session):
+    assert routing_session.get_bind(User.__mapper__) is db.engine
+
+
+def test_read_after_write_from_primary(app, routing_session):
+    with app.test_request_context('/', method='GET'):
+        routing_session.add(User(username='user0', password='00000000'))
+        routing_session.flush()
+        assert routing_session.get_bind(User.__mapper__) is db.engine
+
+
+def test_unhealthy_replica_falls_back_to_primary(app, routing_session):
+    broken = Replica(db.create_engine('postgresql://nobody@/doesnotexist'))
+    routing_session.db.replicas = [broken]
+    with app.test_request_context('/', method='GET'):
+        assert not broken.healthy
+        assert routing_session.get_bind(User.__mapper__) is db.engine
+
+
+@pytest.yield_fixture(scope='function')
+def replicas(connection, monkeypatch):
+    replicas = [Replica(db.create_engine()), Replica(db.create_engine())]
+    monkeypatch.setattr(db, 'replicas', replicas)
+    yield replicas
+    for replica in replicas:
+        replica.engine.dispose()
+
+
+def test_replica_is_kept_until_unhealthy(app, replicas):
+    session = RoutingSession(db=db, bind=db.engine)
+    with app.test_request_context('/', method='GET'):
+        engine = session.get_bind(User.__mapper__)
+        # the replicas are chosen at random
+        for _ in xrange(20):
+            session.execute('SELECT 1', mapper=User.__mapper__)
+            assert session.get_bind(User.__mapper__) is engine
+            session.rollback()
+
+        pinned, = [r for r in replicas if r.engine is engine]
+        other, = [r for r in replicas if r is not pinned]
+        session.execute('SELECT 1', mapper=User.__mapper__)
+        pinned.check = lambda: False
+        pinned.checked_at = None
+        # not during a transaction
+        assert session.get_bind(User.__mapper__) is engine
+        session.rollback()
+        assert session.get_bind(User.__mapper__) is other.engine
+
+        session.close()
+        assert session.replica is None
+
+
+def test_lagging_replica_is_unhealthy(replica):
+    replica.max_lag = -1
+    assert not replica.healthy
+
+
+def test_one_thread_checks_at_a_time(replica):
+    checking = threading.Event()
+    done = threading.Event()
+    checks = []
+
+    def check():
+        checks.append(1)
+        checking.set()
+        done.wait(5)
+        return True
+
+    replica.check = check
+    thread = threading.Thread(target=lambda: replica.healthy)
+    thread.start()
+    checking.wait(5)
+    # the previous result while the other thread checks
+    assert not replica.healthy
+    done.set()
+    thread.join()
+    assert replica.healthy
+    assert len(checks) == 1
@@ -0,0 +1,70 @@
+import time
+
+from app import db
+from app.lib import SlowQueryLog
+
+
+class Context(object):
+    '''Stands in for the execution context of a statement.'''
+
+
+def make_log(tmpdir, **attributes):
+    log = SlowQueryLog()
+    log.threshold = 0
+    log.directory = str(tmpdir)
+    for name, value in attributes.iteritems():
+        setattr(log, name, value)
+    return log
+
+
+def test_explain(session, tmpdir):
+    log = make_log(tmpdir)
+    plan = log.explain(db.engine,
+                       'SELECT * FROM "user" WHERE username = %(username)s',
+                       dict(username='user0'))
+    assert 'actual time' in plan
+
+    # only planned, ANALYZE would insert
+    plan = log.explain(db.engine,
+                       'INSERT INTO category (name) VALUES (%(name)s)',
+                       dict(name='category0'))
+    assert plan.startswith('Insert on category') and 'actual time' not in plan
+
+
+def test_rate_limit(tmpdir):
+    log = make_log(tmpdir, interval=10, fingerprint_interval=300)
+    assert log.allow('a', 0)
+    assert not log.allow('b', 5)
+    assert log.allow('b', 10)
+    assert not log.allow('a', 20)
+    assert log.allow('a', 300)
+
+
+def test_ring_buffer(tmpdir):
+    log = make_log(tmpdir, size=2)
+    for i in xrange(3):
+        log.write(dict(fingerprint='SELECT ?', statement='SELECT %s' % i,
+                       duration_ms=1, captured_at=i))
+    assert [capture['statement'] for capture in log.captures(str(tmpdir))] == \
+        ['SELECT 1', 'SELECT 2']
+
+
+def test_slow_statement(session, tmpdir):
+    log = make_log(tmpdir)
+    connection = session.connection()
+    statement = 'SELECT id FROM "user" ' \
+        'WHERE username = %(username)s AND password = %(password)s'
+    parameters = dict(username='user0', password='00000000')
+    context = Context()
+    log.before_execute(connection, None, statement, parameters, context,
+                       False)
+    log.after_execute(connection, None, statement, parameters, context, False)
+
+    for i in xrange(50):
+        captures = log.captures(str(tmpdir))
+        if captures:
+            break
+        time.sleep(0.1)
+    capture, = captures
+    assert capture['parameters'] == dict(username="'user0'", password='***')
+    assert 'actual time' in capture['plan']
@@ -0,0 +1,37 @@
+import time
+
+import pytest
+from flask import g
+from sqlalchemy import func, select
+from sqlalchemy.exc import DBAPIError
+
+from app import request_timer
+from app.lib import RequestTimer
+
+
+def test_server_timing(app, exercise):
+    with app.test_client() as client:
+        rv = client.get('/v1/exercises')
+    phases = dict(phase.split(';dur=')
+                  for phase in rv.headers[RequestTimer.HEADER].split(', '))
+    assert set(phases) == {'query', 'db', 'merge', 'url', 'serialize', 'json',
+                           'other', 'total'}
+    # the phases and the rest add up to the total
+    assert float(phases['other']) >= 0
+    assert abs(float(phases['total']) - sum(float(ms) for name, ms in
+                                            phases.items()
+                                            if name != 'total')) < 0.1
+
+
+def test_failed_statement(app, connection):
+    with app.test_request_context('/'):
+        request_timer.start()
+        with pytest.raises(DBAPIError):
+            connection.execute(select([func.no_such_function()]))
+        # nothing of the failed statement is left on the connection
+        assert 'timing_compile' not in connection.info
+
+        time.sleep(0.1)
+        connection.execute(select([1]))
+        assert g.timings.phases['db'] < 0.1
+        assert g.timings.phases['query'] < 0.1
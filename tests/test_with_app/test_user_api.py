@@ -46,6 +46,16 @@ def test_get_user(app, session):
     assert rv.status_code == 200
 
 
+def test_get_profile_expanded(app, session):
+    register(app, **user_data)
+    token = get_token(app, user_data['username'], user_data['password'])
+
+    with app.test_client() as client:
+        rv = client.get('/v1/users/profile?expand=favorite_exercises',
+                        headers={'Authorization': 'Bearer %s' % token})
+    assert rv.status_code == 200
+
+
 def test_put_other_user(app, session):
     register(app, **user_data)
     resp2 = register(app, **user_data2)
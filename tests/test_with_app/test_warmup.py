@@ -0,0 +1,27 @@
+import os
+
+from app import db
+from app.models.definitions import definitions
+from app.warmup import warmup
+
+
+def test_warmup(app, amisos):
+    definitions.clear()
+    warmup(app)
+    assert (amisos.id, amisos.version) in definitions._definitions
+    assert db.engine.pool.checkedin() == 0
+
+
+def test_connection_of_parent_is_dropped(app):
+    engine = db.create_engine()
+    connection = engine.connect()
+    parents = connection.connection.connection
+    connection.connection._connection_record.info['pid'] = -1
+    connection.close()
+
+    connection = engine.connect()
+    assert connection.connection.connection is not parents
+    assert connection.connection._connection_record.info['pid'] == \
+        os.getpid()
+    connection.close()
+    engine.dispose()
@@ -0,0 +1,5 @@
+'''The app as uwsgi loads it, see misofome.ini. It is created and warmed up
+in the master process, before the workers are forked.'''
+from app import create_app
+
+application = create_app('production', warmup=True)